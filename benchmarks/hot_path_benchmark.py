@@ -0,0 +1,286 @@
+import os, sys, argparse, json, logging, platform, shutil, socket, statistics, subprocess, tempfile, time
+
+module_path = os.path.realpath(__file__)
+benchmarks_directory = os.path.dirname(module_path)
+rnaseq_utilities_directory = os.path.dirname(benchmarks_directory)
+sys.path.insert(0, rnaseq_utilities_directory)
+
+import synthetic_data
+import cruk_downloader, rna_seq_lane_merger, rRNA_remover
+import tpm_standard_deviation_mean_calculator as tpm_calculator
+
+SCENARIOS = ['lane_merger_shell', 'lane_merger_python', 'rrna_removal', 'output_file_creator', 'file_md5_check']
+PAIR_TAGS = ['r_1', 'r_2']
+
+
+def generate_data(data_directory, settings):
+  '''Writes every synthetic input the scenarios need into one folder
+
+  Parameters
+  ----------
+  data_directory (string / os.path):
+    Folder for the synthetic data
+
+  settings (dictionary):
+    Data sizes (samples, lanes, reads_per_lane, read_length, genes, tpm_samples, conditions)
+
+  '''
+
+  synthetic_data.write_fastq_lanes(data_directory, settings['samples'], settings['lanes'], settings['reads_per_lane'], settings['read_length'])
+  synthetic_data.write_rrna_fasta(os.path.join(data_directory, 'synthetic_rRNA.fa'))
+  synthetic_data.write_tpm_files(data_directory, settings['genes'], settings['tpm_samples'], settings['conditions'])
+  try:
+    synthetic_data.write_submission_form(data_directory, settings['samples'])
+  except ImportError:
+    pass # Only used by the tools' own glob_lister, none of the timed scenarios read it
+
+
+def lane_files(data_directory, settings):
+  '''Groups the synthetic lane files by sample and pair tag as the lane merger does'''
+
+  indexes = synthetic_data.sample_indexes(settings['samples'])
+  indexed_files = rna_seq_lane_merger.globber(data_directory, indexes)
+  return(rna_seq_lane_merger.lane_merger_preparation(indexed_files, 'paired', PAIR_TAGS))
+
+
+def lane_merger_scenario(data_directory, settings, engine):
+  '''Prepares a lane merger run; returns the timed step and the bytes it reads'''
+
+  files_to_merge = lane_files(data_directory, settings)
+  lane_tags = ['s_{0}'.format(lane) for lane in range(1, settings['lanes'] + 1)]
+  input_bytes = sum(os.path.getsize(file_path) for files in files_to_merge.values() for file_path in files)
+
+  def run():
+    shutil.rmtree(os.path.join(data_directory, 'lane_merged'), ignore_errors = True)
+    rna_seq_lane_merger.lane_merger(data_directory, files_to_merge, lane_tags, engine, settings['threads'])
+
+  return(run, input_bytes)
+
+
+def rrna_removal_scenario(data_directory, settings):
+  '''Prepares an rRNA removal run on merged files with the bowtie2 stub first on the PATH,
+  so the timing covers rRNA_remover's own file handling and process management'''
+
+  merged_directory = os.path.join(data_directory, 'lane_merged')
+  if not os.path.isdir(merged_directory):
+    lane_merger_scenario(data_directory, settings, 'python')[0]()
+
+  os.environ['PATH'] = os.path.join(benchmarks_directory, 'bowtie2_stub') + os.pathsep + os.environ['PATH']
+  fastq_gz_files = rRNA_remover.gzip_file_list(merged_directory)
+  sample_reads = rRNA_remover.paired_reads_finder(fastq_gz_files, 'paired', PAIR_TAGS)
+  sample_reads = rRNA_remover.absolute_sample_reads(sample_reads, merged_directory, 'paired')
+  input_bytes = sum(os.path.getsize(os.path.join(merged_directory, file_name)) for file_name in fastq_gz_files)
+  rRNA_library = os.path.join(data_directory, 'synthetic_rRNA')
+
+  def run():
+    shutil.rmtree(os.path.join(merged_directory, 'rRNA_processed'), ignore_errors = True)
+    output_subdirectory = rRNA_remover.output_preperation(merged_directory)
+    rRNA_remover.rrna_removal(rRNA_library, sample_reads, output_subdirectory, 'paired', settings['threads'], settings['jobs'])
+
+  return(run, input_bytes)
+
+
+def output_file_creator_scenario(data_directory, settings):
+  '''Prepares a TPM mean and standard deviation run; needs pandas and openpyxl'''
+
+  import openpyxl # The scenario writes .xlsx files; fail early so it is reported as skipped
+
+  tpm_file = os.path.join(data_directory, 'samples.csv_tpm.txt')
+  tpm_read = tpm_calculator.read_in_tpm(tpm_file)
+  gene_ids = tpm_calculator.gene_name_converter(os.path.join(data_directory, 'geneIDs.txt'))
+  sample_conditions = tpm_calculator.samples_file_conditions_finder(data_directory, os.path.basename(tpm_file))
+
+  def run():
+    tpm_calculator.output_file_creator(data_directory, tpm_read, sample_conditions, gene_ids)
+
+  return(run, os.path.getsize(tpm_file))
+
+
+def file_md5_check_scenario(data_directory, settings):
+  '''Prepares an MD5 check of every synthetic lane file'''
+
+  downloaded_files = [os.path.join(data_directory, file_name) for file_name in sorted(os.listdir(data_directory))]
+  input_bytes = sum(os.path.getsize(file_path) for file_path in downloaded_files if file_path.endswith('.fq.gz'))
+
+  def run():
+    if not cruk_downloader.file_md5_check(downloaded_files):
+      raise RuntimeError('Synthetic lane files failed their MD5 check')
+
+  return(run, input_bytes)
+
+
+def prepare_scenario(scenario, data_directory, settings):
+  '''Gives the timed step and the bytes it processes for a scenario'''
+
+  if scenario == 'lane_merger_shell':
+    return(lane_merger_scenario(data_directory, settings, 'shell'))
+  elif scenario == 'lane_merger_python':
+    return(lane_merger_scenario(data_directory, settings, 'python'))
+  elif scenario == 'rrna_removal':
+    return(rrna_removal_scenario(data_directory, settings))
+  elif scenario == 'output_file_creator':
+    return(output_file_creator_scenario(data_directory, settings))
+  elif scenario == 'file_md5_check':
+    return(file_md5_check_scenario(data_directory, settings))
+
+
+def missing_programs(scenario):
+  '''Lists external programs a scenario needs that are not on the PATH'''
+
+  needed = {'lane_merger_shell': ['zcat', 'pigz']}.get(scenario, [])
+  return([program for program in needed if shutil.which(program) is None])
+
+
+def git_commit():
+  '''Gives the current commit of the repository, if known'''
+
+  try:
+    return(subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = rnaseq_utilities_directory,
+                                   stderr = subprocess.DEVNULL).decode().strip())
+  except (OSError, subprocess.CalledProcessError):
+    return(None)
+
+
+def previous_result(history_file, record):
+  '''Finds the latest earlier result for the same scenario, data sizes and host
+
+  Returns
+  -------
+  previous (dictionary / None):
+    Matching history record
+  '''
+
+  if not os.path.isfile(history_file):
+    return(None)
+
+  previous = None
+  with open(history_file, 'r') as history:
+    for line in history:
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        continue
+      if (entry.get('scenario'), entry.get('settings'), entry.get('host')) == (record['scenario'], record['settings'], record['host']):
+        previous = entry
+
+  return(previous)
+
+
+def hot_path_benchmark(settings, scenarios, repeats, history_file, tolerance, data_directory = None):
+  '''Times every scenario on freshly generated synthetic data and appends the results to the history file
+
+  Parameters
+  ----------
+  settings (dictionary):
+    Data sizes plus "threads" and "jobs"
+
+  scenarios (list):
+    Scenario names, see SCENARIOS
+
+  repeats (int):
+    Timed runs per scenario
+
+  history_file (string / os.path):
+    JSON lines file the results are appended to
+
+  tolerance (float):
+    Allowed slowdown against the previous matching result, e.g. 0.2 for 20%
+
+  data_directory (string / os.path / None):
+    Folder for the synthetic data; a temporary folder (removed afterwards) if None
+
+  Returns
+  -------
+  Boolean (True/False)
+    Were all scenarios within the tolerance of their previous result?
+
+  '''
+
+  temporary = data_directory is None
+  if temporary:
+    data_directory = tempfile.mkdtemp(prefix = 'rnaseq_benchmark_')
+  os.makedirs(data_directory, exist_ok = True)
+
+  start = time.perf_counter()
+  generate_data(data_directory, settings)
+  print('Synthetic data generated in {0:.1f} s: {1}'.format(time.perf_counter() - start, data_directory))
+
+  commit = git_commit()
+  within_tolerance = True
+  try:
+    for scenario in scenarios:
+      programs = missing_programs(scenario)
+      if programs:
+        print('{0:<22} skipped, not on PATH: {1}'.format(scenario, ', '.join(programs)))
+        continue
+      try:
+        run, input_bytes = prepare_scenario(scenario, data_directory, settings)
+      except ImportError as error:
+        print('{0:<22} skipped, {1}'.format(scenario, error))
+        continue
+
+      timings = []
+      for repeat in range(repeats):
+        run_start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - run_start)
+
+      median_seconds = statistics.median(timings)
+      record = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'host': socket.gethostname(),
+                'python': platform.python_version(), 'cpus': os.cpu_count(), 'scenario': scenario, 'settings': settings,
+                'repeats': repeats, 'median_seconds': round(median_seconds, 6), 'min_seconds': round(min(timings), 6),
+                'input_bytes': input_bytes, 'mb_per_second': round(input_bytes / 1048576.0 / max(median_seconds, 1e-9), 3)}
+
+      previous = previous_result(history_file, record)
+      comparison = ''
+      if previous is not None:
+        change = median_seconds / max(previous['median_seconds'], 1e-9) - 1
+        record['change_from_previous'] = round(change, 4)
+        comparison = '  {0:+.1%} vs {1}'.format(change, previous.get('commit') or previous['timestamp'])
+        if change > tolerance:
+          within_tolerance = False
+          comparison += '  REGRESSION'
+
+      print('{0:<22} {1:>9.3f} s  {2:>9.1f} MB/s{3}'.format(scenario, median_seconds, record['mb_per_second'], comparison))
+      with open(history_file, 'a') as history:
+        history.write(json.dumps(record, sort_keys = True) + '\n')
+  finally:
+    if temporary:
+      shutil.rmtree(data_directory, ignore_errors = True)
+
+  return(within_tolerance)
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description = 'Time the hot path of every tool on synthetic data and record the results')
+  parser.add_argument('--scenarios', nargs = '+', choices = SCENARIOS, default = SCENARIOS, metavar = '<SCENARIO>',
+                      help = 'Scenarios to run: {0} (default all)'.format(', '.join(SCENARIOS)))
+  parser.add_argument('--samples', type = int, default = 4, help = 'Number of sequenced samples (default 4)')
+  parser.add_argument('--lanes', type = int, default = 2, help = 'Lanes per sample (default 2)')
+  parser.add_argument('--reads_per_lane', type = int, default = 100000, help = 'Read pairs per lane (default 100000)')
+  parser.add_argument('--read_length', type = int, default = 50, help = 'Read length (default 50)')
+  parser.add_argument('--genes', type = int, default = 20000, help = 'Genes in the TPM file (default 20000)')
+  parser.add_argument('--tpm_samples', type = int, default = 12, help = 'Samples in the TPM file (default 12)')
+  parser.add_argument('--conditions', type = int, default = 4, help = 'Conditions in samples.csv (default 4)')
+  parser.add_argument('-t', '--threads', type = int, default = 4, help = 'Compression / bowtie2 threads (default 4)')
+  parser.add_argument('-j', '--jobs', type = int, default = 1, help = 'Samples processed at the same time by rrna_removal (default 1)')
+  parser.add_argument('-r', '--repeats', type = int, default = 3, metavar = '<REPEATS>', help = 'Timed runs per scenario (default 3)')
+  parser.add_argument('--history', type = str, default = os.path.join(benchmarks_directory, 'history.jsonl'), metavar = '<FILE>',
+                      help = 'JSON lines file the results are appended to (default benchmarks/history.jsonl)')
+  parser.add_argument('--tolerance', type = float, default = 0.2,
+                      help = 'Allowed slowdown against the previous result for the same scenario, sizes and host (default 0.2, i.e. 20%%)')
+  parser.add_argument('--data_directory', type = str, metavar = '<DIRECTORY>', help = 'Keep the synthetic data in this folder instead of a temporary one')
+  parser.add_argument('-v', '--verbose', action = 'store_true', help = 'Show the tools\' own log messages')
+
+  args = parser.parse_args()
+  if not args.verbose:
+    logging.disable(logging.INFO)
+
+  settings = {'samples': args.samples, 'lanes': args.lanes, 'reads_per_lane': args.reads_per_lane, 'read_length': args.read_length,
+              'genes': args.genes, 'tpm_samples': args.tpm_samples, 'conditions': args.conditions,
+              'threads': args.threads, 'jobs': args.jobs}
+  data_directory = os.path.abspath(args.data_directory) if args.data_directory is not None else None
+
+  if not hot_path_benchmark(settings, args.scenarios, args.repeats, os.path.abspath(args.history), args.tolerance, data_directory):
+    sys.exit(1)
@@ -0,0 +1,77 @@
+import os, sys, argparse, statistics, subprocess, time
+
+module_path = os.path.realpath(__file__)
+benchmarks_directory = os.path.dirname(module_path)
+rnaseq_utilities_directory = os.path.dirname(benchmarks_directory)
+
+TOOLS = ['cruk_downloader.py', 'rna_seq_lane_merger.py', 'rRNA_remover.py', 'tpm_standard_deviation_mean_calculator.py',
+         'fastq_qc.py', 'fastq_subsampler.py', 'pipeline_runner.py']
+
+
+def time_command(command, repeats):
+  '''Runs a command several times and returns the median wall time
+
+  Parameters
+  ----------
+  command (list):
+    Command to be timed
+
+  repeats (int):
+    Number of runs
+
+  Returns
+  -------
+  median_ms (float):
+    Median wall time in milliseconds
+
+  '''
+
+  timings = []
+  for repeat in range(repeats):
+    start = time.perf_counter()
+    subprocess.run(command, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, stdin = subprocess.DEVNULL, check = True)
+    timings.append((time.perf_counter() - start) * 1000)
+
+  return(statistics.median(timings))
+
+
+def startup_benchmark(repeats = 10, limit_ms = 100):
+  '''Times "--help" for every tool against a bare interpreter start
+
+  Parameters
+  ----------
+  repeats (int):
+    Number of runs per tool
+
+  limit_ms (float):
+    Maximum acceptable median time for "--help"
+
+  Returns
+  -------
+  Boolean (True/False)
+    Did every tool finish "--help" within the limit?
+
+  '''
+
+  interpreter_ms = time_command([sys.executable, '-c', 'pass'], repeats)
+  print('{0:<45} {1:>8.1f} ms'.format('python (interpreter start only)', interpreter_ms))
+
+  within_limit = True
+  for tool in TOOLS:
+    tool_ms = time_command([sys.executable, os.path.join(rnaseq_utilities_directory, tool), '--help'], repeats)
+    within_limit = within_limit and tool_ms < limit_ms
+    print('{0:<45} {1:>8.1f} ms  ({2:+.1f} ms over interpreter){3}'.format(tool + ' --help', tool_ms, tool_ms - interpreter_ms,
+                                                                             '' if tool_ms < limit_ms else '  SLOW'))
+
+  return(within_limit)
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description = 'Time "--help" for every command-line tool')
+  parser.add_argument('-r', '--repeats', type = int, default = 10, metavar = '<REPEATS>', help = 'Runs per tool (default 10)')
+  parser.add_argument('-l', '--limit_ms', type = float, default = 100, metavar = '<MS>', help = 'Maximum acceptable median time (default 100 ms)')
+
+  args = parser.parse_args()
+  if not startup_benchmark(args.repeats, args.limit_ms):
+    sys.exit(1)
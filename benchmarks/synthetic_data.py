@@ -0,0 +1,236 @@
+import os, argparse, gzip, hashlib, random
+
+SLX_ID = 'SLX-99999'
+FLOWCELL = 'HSYNTHXX'
+
+
+def sample_indexes(samples):
+  '''Gives CRUK style index names (as they appear in file names) for a number of samples'''
+
+  return(['D7{0:02d}_D5{1:02d}'.format(sample_number // 8 + 1, sample_number % 8 + 1) for sample_number in range(samples)])
+
+
+def random_reads(random_generator, reads, read_length, read_number):
+  '''Creates FASTQ records with random bases and qualities
+
+  Parameters
+  ----------
+  random_generator (random.Random):
+    Seeded random number generator
+
+  reads (int):
+    Number of reads
+
+  read_length (int):
+    Length of every read
+
+  read_number (int):
+    Mate number (1 or 2) used in the read names
+
+  Returns
+  -------
+  fastq (bytes):
+    FASTQ formatted reads
+
+  '''
+
+  records = []
+  for read in range(reads):
+    bases = ''.join(random_generator.choice('ACGT') for base in range(read_length))
+    qualities = ''.join(chr(33 + random_generator.randint(20, 40)) for base in range(read_length))
+    records.append('@SYNTH:{0} {1}:N:0\n{2}\n+\n{3}\n'.format(read, read_number, bases, qualities))
+
+  return(''.join(records).encode())
+
+
+def write_fastq_lanes(directory, samples = 4, lanes = 2, reads_per_lane = 10000, read_length = 50, paired = True, seed = 11):
+  '''Writes CRUK named .fq.gz lane files (e.g. SLX-99999.D701_D501.HSYNTHXX.s_1.r_1.fq.gz) and a matching .md5sums.txt file
+
+  Parameters
+  ----------
+  directory (string / os.path):
+    Output folder
+
+  samples (int):
+    Number of samples
+
+  lanes (int):
+    Number of lanes per sample
+
+  reads_per_lane (int):
+    Reads (or pairs) per lane file
+
+  read_length (int):
+    Length of every read
+
+  paired (Boolean):
+    Write r_1 and r_2 files
+
+  seed (int):
+    Random seed
+
+  Returns
+  -------
+  fastq_files (list):
+    Full paths of the files written
+
+  '''
+
+  random_generator = random.Random(seed)
+  block = {read_number: random_reads(random_generator, min(reads_per_lane, 1000), read_length, read_number) for read_number in [1, 2]}
+  repeats, remainder = divmod(reads_per_lane, 1000)
+
+  fastq_files = []
+  md5_lines = []
+  for index in sample_indexes(samples):
+    for lane in range(1, lanes + 1):
+      for read_number in ([1, 2] if paired else [1]):
+        file_name = '{0}.{1}.{2}.s_{3}.r_{4}.fq.gz'.format(SLX_ID, index, FLOWCELL, lane, read_number)
+        file_path = os.path.join(directory, file_name)
+        with gzip.open(file_path, 'wb', compresslevel = 1) as fastq_file: # Repeating a block of reads keeps generation fast at large sizes
+          for repeat in range(repeats):
+            fastq_file.write(block[read_number])
+          if remainder:
+            fastq_file.write(b''.join(block[read_number].splitlines(True)[:remainder * 4]))
+        with open(file_path, 'rb') as written_file:
+          md5_lines.append('{0}  {1}\n'.format(hashlib.md5(written_file.read()).hexdigest(), file_name))
+        fastq_files.append(file_path)
+
+  with open(os.path.join(directory, '{0}.{1}.md5sums.txt'.format(SLX_ID, FLOWCELL)), 'w') as md5_file:
+    md5_file.writelines(md5_lines)
+
+  return(fastq_files)
+
+
+def write_submission_form(directory, samples = 4):
+  '''Writes a CRUKCI_SLX_Submission.xlsx form that both "glob_lister" functions can read.
+  "Name" is written in the first two columns of the sample table's header because the lane
+  merger looks for it in the first column and the downloader in the second. Needs pandas and openpyxl.
+
+  Parameters
+  ----------
+  directory (string / os.path):
+    Output folder
+
+  samples (int):
+    Number of samples
+
+  Returns
+  -------
+  submission_form (string / os.path):
+    Full path of the form
+
+  '''
+
+  import pandas
+
+  rows = [['', 'SLX Identifier', SLX_ID.replace('SLX-', '')], ['', '', ''], ['Name', 'Name', 'Index']]
+  for sample_number, index in enumerate(sample_indexes(samples)):
+    rows.append(['sample_{0}'.format(sample_number + 1), 'sample_{0}'.format(sample_number + 1), index.replace('_', '-')])
+
+  submission_form = os.path.join(directory, 'CRUKCI_SLX_Submission.xlsx')
+  pandas.DataFrame(rows, columns = [0, 1, '']).to_excel(submission_form, index = False)
+  return(submission_form)
+
+
+def write_rrna_fasta(file_path, sequences = 4, length = 2000, seed = 11):
+  '''Writes a small rRNA library .fa file
+
+  Returns
+  -------
+  file_path (string / os.path):
+    Full path of the .fa file
+
+  '''
+
+  random_generator = random.Random(seed)
+  with open(file_path, 'w') as fasta_file:
+    for sequence in range(sequences):
+      bases = ''.join(random_generator.choice('ACGT') for base in range(length))
+      fasta_file.write('>synthetic_rRNA_{0}\n'.format(sequence + 1))
+      for start in range(0, length, 60):
+        fasta_file.write(bases[start:start + 60] + '\n')
+
+  return(file_path)
+
+
+def write_tpm_files(directory, genes = 20000, samples = 12, conditions = 4, seed = 11):
+  '''Writes a PRAGUI style samples.csv and samples.csv_tpm.txt, plus a gene ID reference
+  in the format read by "gene_name_converter"
+
+  Parameters
+  ----------
+  directory (string / os.path):
+    Output folder
+
+  genes (int):
+    Number of genes
+
+  samples (int):
+    Number of samples, spread evenly over the conditions
+
+  conditions (int):
+    Number of conditions
+
+  seed (int):
+    Random seed
+
+  Returns
+  -------
+  tpm_file (string / os.path):
+    Full path of the samples.csv_tpm.txt file
+
+  gene_id_file (string / os.path):
+    Full path of the gene ID reference
+
+  '''
+
+  random_generator = random.Random(seed)
+  sample_names = ['sample_{0}'.format(sample_number + 1) for sample_number in range(samples)]
+
+  with open(os.path.join(directory, 'samples.csv'), 'w') as samples_file:
+    samples_file.write('samples\tread1\tread2\tcondition\n')
+    for sample_number, sample_name in enumerate(sample_names):
+      samples_file.write('{0}\t{0}_r_1.fq.gz\t{0}_r_2.fq.gz\tCondition {1}\n'.format(sample_name, sample_number % conditions + 1))
+
+  tpm_file = os.path.join(directory, 'samples.csv_tpm.txt')
+  with open(tpm_file, 'w') as tpm_output:
+    tpm_output.write('geneName\t' + '\t'.join(sample_names) + '\n')
+    for gene in range(genes):
+      values = ['{0:.3f}'.format(random_generator.lognormvariate(1, 2)) for sample_name in sample_names]
+      tpm_output.write('WBGene{0:08d}\t{1}\n'.format(gene + 1, '\t'.join(values)))
+
+  gene_id_file = os.path.join(directory, 'geneIDs.txt')
+  with open(gene_id_file, 'w') as gene_id_output:
+    for gene in range(genes):
+      gene_id_output.write('6239,WBGene{0:08d},gene-{0},T{0}.1,Live\n'.format(gene + 1))
+
+  return(tpm_file, gene_id_file)
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description = 'Generate synthetic RNA-Seq utilities input data')
+  parser.add_argument('-d', '--directory', type = str, required = True, metavar = '<DIRECTORY>', help = 'Output folder')
+  parser.add_argument('--samples', type = int, default = 4, help = 'Number of sequenced samples (default 4)')
+  parser.add_argument('--lanes', type = int, default = 2, help = 'Lanes per sample (default 2)')
+  parser.add_argument('--reads_per_lane', type = int, default = 10000, help = 'Reads (or pairs) per lane file (default 10000)')
+  parser.add_argument('--read_length', type = int, default = 50, help = 'Read length (default 50)')
+  parser.add_argument('--single_end', action = 'store_true', help = 'Write single end lanes only')
+  parser.add_argument('--genes', type = int, default = 20000, help = 'Genes in the TPM file (default 20000)')
+  parser.add_argument('--tpm_samples', type = int, default = 12, help = 'Samples in the TPM file (default 12)')
+  parser.add_argument('--conditions', type = int, default = 4, help = 'Conditions in samples.csv (default 4)')
+  parser.add_argument('--seed', type = int, default = 11, help = 'Random seed (default 11)')
+
+  args = parser.parse_args()
+  directory = os.path.abspath(args.directory)
+  os.makedirs(directory, exist_ok = True)
+
+  write_fastq_lanes(directory, args.samples, args.lanes, args.reads_per_lane, args.read_length, not args.single_end, args.seed)
+  write_rrna_fasta(os.path.join(directory, 'synthetic_rRNA.fa'), seed = args.seed)
+  write_tpm_files(directory, args.genes, args.tpm_samples, args.conditions, args.seed)
+  try:
+    write_submission_form(directory, args.samples)
+  except ImportError:
+    print('pandas and openpyxl are needed to write CRUKCI_SLX_Submission.xlsx, skipped')
+  print('Synthetic data written to {0}'.format(directory))
@@ -1,11 +1,7 @@
-import os, glob, argparse, sys, pandas, ftplib, hashlib
-
-module_path = os.path.realpath(__file__)
-rnaseq_utilities_directory = os.path.dirname(module_path)
-utilities_directory = os.path.split(rnaseq_utilities_directory)[0]
-sys.path.append(utilities_directory)
-
-from cell_bio_util import cell_bio_util as util
+import os, glob, time, argparse, hashlib
+import rnaseq_util as util
+import instrumentation, io_governor, run_history
+import rna_seq_lane_merger, rRNA_remover
 
 
 def check_directory(directory, check_type):
@@ -35,6 +31,7 @@ def check_directory(directory, check_type):
     util.critical(message)
 
 
+@instrumentation.timed
 def glob_lister(submission_form):
   '''Reads in the CRUKCI_SLX_Submission.xlsx file and returns the SLX number and fq.gz file prefixes.
   
@@ -57,9 +54,11 @@ def glob_lister(submission_form):
   if file_check == True:
     util.info('Submission form found at {0}'.format(submission_form))
   else:
-    error_message = 'Submission form not found, please ensure this file is in\n-->\t{0}'.format(working_directory)
+    error_message = 'Submission form not found, please ensure this file is in\n-->\t{0}'.format(os.path.dirname(submission_form))
     util.critical(error_message)
 
+  import pandas # Imported here so the FTP steps and --help do not pay for it
+
   util.info('Reading in index file')
   excel_file = pandas.read_excel(submission_form) # Find the start row to skip passed the header information
   util.info('Index file read')
@@ -79,6 +78,7 @@ def glob_lister(submission_form):
   return(samples_information, slx_id)
 
 
+@instrumentation.timed
 def ftp_server_connection(username, password):
   ''' Establishes connection to the CRUK FTP server.
   This version uses the de Bono lab's user log credentials
@@ -89,6 +89,8 @@ def ftp_server_connection(username, password):
   
   '''
 
+  import ftplib
+
   ftp_server_url = 'ftp1.cruk.cam.ac.uk'
   util.info('Accessing FTP server {0}'.format(ftp_server_url))
   ftp_server = ftplib.FTP(ftp_server_url)
@@ -98,17 +100,320 @@ def ftp_server_connection(username, password):
   return(ftp_server)
 
 
-def ftp_download_files(ftp_server, slx_id):
+@instrumentation.timed
+def ftp_server_listing(ftp_server, slx_id):
+  '''Lists the SLX's files on the FTP server with their sizes and modification times.
+  MLSD returns these for every file in one round trip; servers without MLSD are
+  listed with NLST instead, without sizes or times.
+  
+  Parameters
+  ----------
+  ftp_server (ftplib object):
+    connection to FTP server
+  
+  slx_id (string)
+    The user's SLX ID for the wanted files
+  
+  Returns
+  -------
+  server_files (dictionary):
+    Keys are the file names and values are dictionaries with the "size" (int / None) and "modify" (string / None) of the file
+  
+  '''
+
+  import ftplib
+
+  server_files = {}
+  try:
+    for file, facts in ftp_server.mlsd(facts = ['type', 'size', 'modify']):
+      if file.startswith(slx_id) and facts.get('type', 'file') == 'file':
+        size = facts.get('size')
+        server_files[file] = {'size': int(size) if size is not None else None, 'modify': facts.get('modify')}
+  except ftplib.error_perm:
+    util.info('FTP server does not support MLSD, listing file names only')
+    for file in ftp_server.nlst():
+      if file.startswith(slx_id):
+        server_files[file] = {'size': None, 'modify': None}
+
+  util.info('{0} files found on the FTP server for {1}'.format(len(server_files), slx_id))
+  return(server_files)
+
+
+def selected_indexes(samples_information, samples = None):
+  '''Gives the file indexes of the wanted samples, warning about any not on the submission form
+  
+  Parameters
+  ----------
+  samples_information (pandas dataframe):
+    Pandas dataframe containing the sample names and file index (prefix)
+  
+  samples (list / None):
+    Sample names or indexes, None or empty for every sample on the submission form
+  
+  Returns
+  -------
+  indexes (list):
+    File indexes, in submission form order
+  
+  '''
+
+  names = [str(name) for name in samples_information['Name']]
+  indexes = list(samples_information['Index'])
+
+  if samples:
+    wanted = set(samples) | set(sample.replace('-', '_') for sample in samples)
+    for sample in samples:
+      if sample not in names and sample.replace('-', '_') not in indexes:
+        util.warn('Sample {0} is not on the submission form, ignoring it'.format(sample))
+    indexes = [index for name, index in zip(names, indexes) if name in wanted or index in wanted]
+
+  return(indexes)
+
+
+def sample_file_selection(server_files, samples_information, samples = None):
+  '''Selects the .fq.gz files of the samples on the submission form, optionally only
+  some of them, plus the .md5sums.txt files. Anything else on the server is left out.
+  
+  Parameters
+  ----------
+  server_files (dictionary):
+    Output of "ftp_server_listing"
+  
+  samples_information (pandas dataframe):
+    Pandas dataframe containing the sample names and file index (prefix)
+  
+  samples (list / None):
+    Sample names or indexes to download, None or empty for every sample on the submission form
+  
+  Returns
+  -------
+  selected_files (list):
+    File names to download
+  
+  '''
+
+  indexes = selected_indexes(samples_information, samples)
+
+  selected_files = [file for file in sorted(server_files) if file.endswith('.md5sums.txt')]
+  for index in indexes:
+    index_files = [file for file in sorted(server_files) if file.endswith('.fq.gz') and '.{0}.'.format(index) in file]
+    if len(index_files) == 0:
+      util.warn('No files found on the FTP server for index {0}'.format(index))
+    selected_files += index_files
+
+  util.info('{0} of {1} files on the FTP server selected for {2} samples'.format(len(selected_files), len(server_files), len(indexes)))
+  return(selected_files)
+
+
+def cache_file_index(cache_directory):
+  '''Finds every file within a cache of earlier deliveries, searching sub-folders too
+  
+  Returns
+  -------
+  cached_files (dictionary):
+    Keys are the file names and values are their full paths (the first copy found)
+  
+  '''
+
+  cached_files = {}
+  for root, directories, files in os.walk(cache_directory):
+    for file in files:
+      cached_files.setdefault(file, os.path.join(root, file))
+
+  return(cached_files)
+
+
+@instrumentation.timed
+def cache_link_files(working_directory, selected_files, server_files, cache_directory):
+  '''Hard-links files already held in a cache of earlier deliveries into the working directory,
+  so they are not downloaded again. A cached copy is only used if its size matches the server
+  listing (when known); linked files are MD5 checked like downloaded ones, and a failed check
+  only removes the link. .md5sums.txt files are always taken from the server.
+  
+  Parameters
+  ----------
+  working_directory (string / os.path):
+    Folder the files are downloaded to
+  
+  selected_files (list):
+    File names to download
+  
+  server_files (dictionary):
+    Output of "ftp_server_listing"
+  
+  cache_directory (string / os.path):
+    Folder holding earlier deliveries
+  
+  Returns
+  -------
+  linked_files (list):
+    Full paths of the files linked from the cache
+  
+  '''
+
+  cached_files = cache_file_index(cache_directory)
+  linked_files = []
+
+  for file in selected_files:
+    file_path = os.path.join(working_directory, file)
+    if file.endswith('.md5sums.txt') or file not in cached_files or os.path.exists(file_path):
+      continue
+
+    size = server_files.get(file, {}).get('size')
+    if size is not None and os.path.getsize(cached_files[file]) != size:
+      util.info('Cached copy of {0} differs in size from the server copy, it will be downloaded'.format(file))
+      continue
+
+    try:
+      os.link(cached_files[file], file_path)
+    except OSError:
+      util.warn('Unable to hard-link {0} from the cache (is it on another file system?), it will be downloaded'.format(file))
+      continue
+    linked_files.append(file_path)
+
+  util.info('{0} files hard-linked from cache {1}'.format(len(linked_files), cache_directory))
+  return(linked_files)
+
+
+@instrumentation.timed
+def ftp_file_selection(working_directory, ftp_server, slx_id, samples_information, samples = None, cache_directory = None):
+  '''Lists the SLX on the FTP server and works out which files to fetch. With samples given
+  only those samples' files (plus the .md5sums.txt files) are selected, otherwise every file.
+  Selected files found in the cache directory are hard-linked instead of downloaded.
+  
+  Parameters
+  ----------
+  working_directory (string / os.path):
+    Folder the files are downloaded to
+  
+  ftp_server (ftplib object):
+    connection to FTP server
+  
+  slx_id (string)
+    The user's SLX ID for the wanted files
+  
+  samples_information (pandas dataframe):
+    Pandas dataframe containing the sample names and file index (prefix)
+  
+  samples (list / None):
+    Sample names or indexes to download; empty for every sample on the submission form, None for every file of the SLX
+  
+  cache_directory (string / os.path / None):
+    Folder holding earlier deliveries
+  
+  Returns
+  -------
+  server_files (dictionary):
+    Output of "ftp_server_listing"
+  
+  selected_files (list):
+    File names to download
+  
+  '''
+
+  server_files = ftp_server_listing(ftp_server, slx_id)
+
+  if samples is None:
+    selected_files = sorted(server_files)
+  else:
+    selected_files = sample_file_selection(server_files, samples_information, samples)
+
+  if cache_directory is not None:
+    cache_link_files(working_directory, selected_files, server_files, cache_directory)
+
+  return(server_files, selected_files)
+
+
+@instrumentation.timed
+def download_space_check(working_directory, server_files, selected_files, processing = False):
+  '''Stops the script before any download starts if the files still to be fetched (missing, or a different
+  size from the server copy) would not fit in the working directory
+  
+  Parameters
+  ----------
+  working_directory (string / os.path):
+    Folder the files are downloaded to
+  
+  server_files (dictionary):
+    Output of "ftp_server_listing"
+  
+  selected_files (list):
+    File names to download
+  
+  processing (Boolean):
+    Also leave room for the merged files (pipeline mode)
+  
+  '''
+
+  download_bytes = 0
+  for file in selected_files:
+    file_path = os.path.join(working_directory, file)
+    size = server_files.get(file, {}).get('size') or 0
+    if not os.path.isfile(file_path) or os.path.getsize(file_path) != size:
+      download_bytes += size
+
+  estimated_bytes = download_bytes * io_governor.OUTPUT_RATIOS['download']
+  if processing == True:
+    estimated_bytes += sum(server_files.get(file, {}).get('size') or 0 for file in selected_files) * io_governor.OUTPUT_RATIOS['lane_merge']
+  io_governor.space_check(working_directory, int(estimated_bytes), '{0} files from the FTP server'.format(len(selected_files)))
+
+
+def download_time(download_times, file, seconds, size):
+  '''Adds one download of a file to the "download_times" of "ftp_download_files" / "ftp_download_verified", if given'''
+
+  if download_times is not None:
+    file_time = download_times.setdefault(file, [0.0, 0])
+    file_time[0] += seconds
+    file_time[1] += size
+
+
+def record_downloads(samples_information, download_times):
+  '''Records the download of each sample in the run history, adding up its lane files by submission form index,
+  so downloads can be compared per sample with the other stages. Files of no sample (.md5sums.txt) are left out.
+  
+  Parameters
+  ----------
+  samples_information (pandas dataframe):
+    Pandas dataframe containing the file index (prefix)
+  
+  download_times (dictionary):
+    Filled in by "ftp_download_files" / "ftp_download_verified"
+  
+  '''
+
+  for index in samples_information['Index']:
+    sample_times = [download_times[file] for file in sorted(download_times) if '.{0}.'.format(index) in file]
+    if len(sample_times) > 0:
+      downloaded_bytes = sum(size for seconds, size in sample_times)
+      run_history.record_sample(index, 'download', sum(seconds for seconds, size in sample_times), downloaded_bytes, downloaded_bytes, engine = 'ftp')
+
+
+@instrumentation.timed
+def ftp_download_files(working_directory, ftp_server, slx_id, selected_files = None, server_files = None, download_times = None):
   '''Downloads the fastq (.fq.gz files).
+  Files already present are kept unless their size differs from the server copy;
+  .md5sums.txt files are always downloaded again as they may have changed.
   
   Parameters
   ----------
+  working_directory (string / os.path):
+    Folder the files are downloaded to
+  
   ftp_server (ftblib object):
     connection to FTP server
   
   slx_id (string)
     The user's SLX ID for the wanted files
   
+  selected_files (list / None):
+    File names to download (from "ftp_file_selection"), None for every file beginning with the SLX ID
+  
+  server_files (dictionary / None):
+    Output of "ftp_server_listing", listed here if None
+  
+  download_times (dictionary / None):
+    If given, each downloaded file's name is added with its download [seconds, bytes], summed over attempts
+  
   Returns
   -------
   downloaded_files (list):
@@ -117,29 +422,63 @@ def ftp_download_files(ftp_server, slx_id):
   
   '''
 
-  file_prefix = slx_id
-  ftp_list_dir = ftp_server.nlst()
+  if server_files is None:
+    server_files = ftp_server_listing(ftp_server, slx_id)
+  if selected_files is None:
+    selected_files = sorted(server_files)
   downloaded_files = []
 
-  util.info('Downloading files beginning with {0}'.format(file_prefix))
-
-  for file in ftp_list_dir:
-    if file.startswith(file_prefix):
-      file_path = os.path.join(working_directory, '{0}'.format(file))
-      util.info('Attempting to download file {0}'.format(file))
+  util.info('Downloading {0} files beginning with {1}'.format(len(selected_files), slx_id))
+  download_space_check(working_directory, server_files, selected_files)
 
-      if os.path.isfile(file_path) == True:
-        util.info('File already exists, skipping'.format(file))
-      else:
-        with open(file_path, 'wb') as download_file:
-          ftp_server.retrbinary('RETR ' + file, download_file.write, 1024)
-        util.info('File downloaded to {0}'.format(file_path))
+  for file in selected_files:
+    file_path = os.path.join(working_directory, '{0}'.format(file))
+    util.info('Attempting to download file {0}'.format(file))
 
-      downloaded_files.append(file_path)
+    size = server_files.get(file, {}).get('size')
+    if os.path.isfile(file_path) == True and not file.endswith('.md5sums.txt') and (size is None or os.path.getsize(file_path) == size):
+      util.info('File already exists, skipping'.format(file))
+    else:
+      if os.path.isfile(file_path):
+        os.remove(file_path) # Never write through a hard link into the cache
+      start = time.perf_counter()
+      with io_governor.heavy_write(working_directory, size or 0, file), open(file_path, 'wb') as download_file:
+        def write_block(block):
+          io_governor.throttle(len(block))
+          download_file.write(block)
+        ftp_server.retrbinary('RETR ' + file, write_block, 1048576)
+      download_time(download_times, file, time.perf_counter() - start, os.path.getsize(file_path))
+      util.info('File downloaded to {0}'.format(file_path))
+
+    downloaded_files.append(file_path)
 
   return(downloaded_files)
 
 
+def file_md5(file_path):
+  '''Computes the MD5 checksum of a file
+  
+  Parameters
+  ----------
+  file_path (string / os.path):
+    File to be hashed
+  
+  Returns
+  -------
+  md5_hash (string):
+    Hexadecimal MD5 digest of the file
+  
+  '''
+
+  file_hashing = hashlib.md5()
+  with open(file_path, 'rb') as file_to_check:
+    for chunks in iter(lambda: file_to_check.read(1048576), b""):
+      file_hashing.update(chunks)
+
+  return(file_hashing.hexdigest())
+
+
+@instrumentation.timed
 def file_md5_check(downloaded_files_list):
   '''Performs a check to see if MD5 checksum matches with expected MD5 hash
   
@@ -152,10 +491,12 @@ def file_md5_check(downloaded_files_list):
   -------
   Boolean (True/False)
     Does expected MD5 hash values (within CRUK provided .md5sums.txt files match with computed MD5 checksums?
+    Only files in downloaded_files_list are checked, so a selective download is not failed by the samples it left out.
   
   '''
 
   list_directory = downloaded_files_list
+  downloaded_file_paths = {os.path.basename(file): file for file in list_directory}
   md5_hash_value_files = []
   md5_check_hash_dictionary = {}
   failed_downloads = []
@@ -165,23 +506,20 @@ def file_md5_check(downloaded_files_list):
       md5_hash_value_files.append(file)
 
   for md5_checksum_file in md5_hash_value_files:
-    md5_checksum_file_path = os.path.join(working_directory, md5_checksum_file)
-    with open(md5_checksum_file_path, 'r') as check_file:
+    with open(md5_checksum_file, 'r') as check_file:
       file_read = check_file.readlines()
       for line in file_read:
         md5_hash, file = line.strip().split('  ')
         md5_check_hash_dictionary[file] = md5_hash
 
   for sample_file in md5_check_hash_dictionary:
+    if sample_file not in downloaded_file_paths:
+      continue
 
-    file_path = os.path.join(working_directory, sample_file)
-    file_hashing = hashlib.md5()
-    with open(file_path, 'rb') as file_to_check:
-      for chunks in iter(lambda: file_to_check.read(4096), b""):
-        file_hashing.update(chunks)
+    file_path = downloaded_file_paths[sample_file]
 
     util.info('Performing MD5 hash check')
-    hashing_value_calculated = file_hashing.hexdigest()
+    hashing_value_calculated = file_md5(file_path)
     hashing_value_expected = md5_check_hash_dictionary[sample_file]
     util.info('Computed MD5 hash value = {0}'.format(hashing_value_calculated))
     util.info('Expected MD5 hash value = {0}'.format(hashing_value_expected))
@@ -199,11 +537,322 @@ def file_md5_check(downloaded_files_list):
     util.warn('{0} files did not pass MD5 checksum test'.format(len(failed_downloads)))
     for failed in failed_downloads:
       util.info('Deleting file {0}'.format(failed))
-      failed_file = os.path.join(working_directory, failed)
-      os.remove(failed_file)
+      os.remove(downloaded_file_paths[failed])
     return(False)
 
 
+def md5_expected_hashes(md5_files):
+  '''Reads CRUK provided .md5sums.txt files into a dictionary of expected MD5 hashes
+  
+  Parameters
+  ----------
+  md5_files (list):
+    Full paths of the .md5sums.txt files
+  
+  Returns
+  -------
+  md5_check_hash_dictionary (dictionary):
+    Keys are the file names and values are the expected MD5 hashes
+  
+  '''
+
+  md5_check_hash_dictionary = {}
+  for md5_checksum_file in md5_files:
+    with open(md5_checksum_file, 'r') as check_file:
+      for line in check_file:
+        if line.strip():
+          md5_hash, file = line.strip().split('  ')
+          md5_check_hash_dictionary[file] = md5_hash
+
+  return(md5_check_hash_dictionary)
+
+
+@instrumentation.timed
+def ftp_download_verified(working_directory, ftp_server, file, expected_md5, retries = 3, expected_size = None, overwrite = False,
+                          download_times = None):
+  '''Downloads a single file and checks its MD5 hash. The hash is computed as the data
+  arrives so a freshly downloaded file does not need to be read a second time.
+  A file already present (e.g. hard-linked from the cache) is only hashed if its size
+  matches the server listing, otherwise it is replaced straight away.
+  
+  Parameters
+  ----------
+  working_directory (string / os.path):
+    Folder the files are downloaded to
+  
+  ftp_server (ftplib object):
+    connection to FTP server
+  
+  file (string):
+    File name on the FTP server
+  
+  expected_md5 (string / None):
+    Expected MD5 hash, None if the file is not listed in any .md5sums.txt file
+  
+  retries (int):
+    Number of download attempts before giving up
+  
+  expected_size (int / None):
+    Size of the file on the FTP server, None if not known
+  
+  overwrite (Boolean):
+    Download the file even if it is already present (used for the .md5sums.txt files)
+  
+  download_times (dictionary / None):
+    If given, each downloaded file's name is added with its download [seconds, bytes], summed over attempts
+  
+  Returns
+  -------
+  file_path (string / os.path):
+    Location of the downloaded file
+  
+  Boolean (True/False)
+    Does the computed MD5 hash match the expected MD5 hash?
+  
+  '''
+
+  file_path = os.path.join(working_directory, file)
+
+  if os.path.isfile(file_path) and (overwrite or (expected_size is not None and os.path.getsize(file_path) != expected_size)):
+    util.info('Local copy of {0} is out of date, replacing it'.format(file))
+    os.remove(file_path) # Never write through a hard link into the cache
+
+  for attempt in range(retries):
+    if os.path.isfile(file_path):
+      util.info('File already exists, checking {0}'.format(file))
+      hashing_value_calculated = file_md5(file_path)
+    else:
+      util.info('Attempting to download file {0}'.format(file))
+      file_hashing = hashlib.md5()
+      start = time.perf_counter()
+      with io_governor.heavy_write(working_directory, expected_size or 0, file), open(file_path, 'wb') as download_file:
+        def write_block(block):
+          io_governor.throttle(len(block))
+          download_file.write(block)
+          file_hashing.update(block)
+        ftp_server.retrbinary('RETR ' + file, write_block, 1048576)
+      hashing_value_calculated = file_hashing.hexdigest()
+      download_time(download_times, file, time.perf_counter() - start, os.path.getsize(file_path))
+      util.info('File downloaded to {0}'.format(file_path))
+
+    if expected_md5 is None:
+      return(file_path, True)
+    elif hashing_value_calculated == expected_md5:
+      util.info('Computed and expected MD5 hash values match for {0}'.format(file))
+      return(file_path, True)
+    else:
+      util.warn('Computed and expected MD5 hash values do not match for {0}, deleting file'.format(file))
+      os.remove(file_path)
+
+  return(file_path, False)
+
+
+@instrumentation.timed
+def sample_processor(working_directory, sample_index, sample_files, lane_tags, paired_single, paired_tags, rRNA_library, rRNA_output_subdirectory, engine = 'shell'):
+  '''Merges the lanes of a single sample and optionally removes its rRNA reads.
+  Called by the pipeline as soon as all of the sample's files are downloaded and verified.
+  
+  Parameters
+  ----------
+  working_directory (string / os.path):
+    Folder holding the downloaded files; merged files go in its "lane_merged" sub-folder
+  
+  sample_index (string):
+    Sample index from the submission form
+  
+  sample_files (list):
+    Full paths of the sample's .fq.gz files
+  
+  lane_tags (list):
+    Tags that identify samples' lane e.g. "s_1 s_2".
+  
+  paired_single (string):
+    Either "paired" or "single"
+  
+  paired_tags (list):
+    Same as PRAGUI's pair tags input. Only used for paired reads.
+  
+  rRNA_library (string / os.path / None):
+    Path to the rRNA library (.fa file), None to skip rRNA removal
+  
+  rRNA_output_subdirectory (string / os.path / None):
+    Output folder for the rRNA removal step
+  
+  engine (string):
+    Lane merger engine, either "shell" (zcat | pigz) or "python"
+  
+  Returns
+  -------
+  merged_files (list):
+    Full paths of the merged files created
+  
+  '''
+
+  util.info('All files for {0} downloaded and verified, starting processing'.format(sample_index))
+  files_to_merge = rna_seq_lane_merger.lane_merger_preparation({sample_index: sample_files}, paired_single, paired_tags)
+  merged_files = rna_seq_lane_merger.lane_merger(working_directory, files_to_merge, lane_tags, engine)
+
+  if rRNA_library is not None:
+    merged_directory = os.path.dirname(merged_files[0])
+    merged_file_names = [os.path.basename(merged_file) for merged_file in merged_files]
+    sample_reads = rRNA_remover.paired_reads_finder(merged_file_names, paired_single, paired_tags)
+
+    sample_reads = rRNA_remover.absolute_sample_reads(sample_reads, merged_directory, paired_single)
+    rRNA_remover.rrna_removal(rRNA_library, sample_reads, rRNA_output_subdirectory, paired_single)
+
+  util.info('Processing complete for {0}'.format(sample_index))
+  return(merged_files)
+
+
+async def ftp_pipeline(working_directory, ftp_server, slx_id, samples_information, lane_tags, paired_single, paired_tags, rRNA_library = None, workers = 4, engine = 'shell',
+                       samples = None, cache_directory = None):
+  '''Event-driven download and processing pipeline. Files are downloaded one sample at a
+  time and MD5 checked as they arrive. As soon as every file of a sample has passed its
+  MD5 check the sample is merged (and optionally rRNA depleted) on a bounded worker pool,
+  while the remaining files carry on downloading.
+  
+  Parameters
+  ----------
+  working_directory (string / os.path):
+    Folder the files are downloaded to
+  
+  ftp_server (ftplib object):
+    connection to FTP server
+  
+  slx_id (string)
+    The user's SLX ID for the wanted files
+  
+  samples_information (pandas dataframe):
+    Pandas dataframe containing the file index (prefix)
+  
+  lane_tags (list):
+    Tags that identify samples' lane e.g. "s_1 s_2".
+  
+  paired_single (string):
+    Either "paired" or "single"
+  
+  paired_tags (list):
+    Same as PRAGUI's pair tags input. Only used for paired reads.
+  
+  rRNA_library (string / os.path / None):
+    Path to the rRNA library (.fa file), None to skip rRNA removal
+  
+  workers (int):
+    Maximum number of samples processed at the same time
+  
+  engine (string):
+    Lane merger engine, either "shell" (zcat | pigz) or "python"
+  
+  samples (list / None):
+    Sample names or indexes to download; empty for every sample on the submission form, None for every file of the SLX
+  
+  cache_directory (string / os.path / None):
+    Folder holding earlier deliveries, matching files are hard-linked instead of downloaded
+  
+  Returns
+  -------
+  downloaded_files (list):
+    List of downloaded files (absolute path)
+  
+  failed_files (list):
+    Files that did not pass the MD5 checksum test
+  
+  merged_files (list):
+    Full paths of the merged files created
+  
+  '''
+
+  import asyncio, concurrent.futures
+
+  loop = asyncio.get_running_loop()
+  ftp_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1) # A single FTP connection can only transfer one file at a time
+  processing_executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+  verified_files = asyncio.Queue()
+  download_times = {}
+
+  server_files, selected_files = await loop.run_in_executor(ftp_executor, ftp_file_selection, working_directory, ftp_server, slx_id,
+                                                            samples_information, samples, cache_directory)
+  download_space_check(working_directory, server_files, selected_files, processing = True)
+  md5_files = [file for file in selected_files if file.endswith('.md5sums.txt')]
+  other_files = [file for file in selected_files if not file.endswith('.md5sums.txt')]
+
+  util.info('Downloading {0} MD5 checksum files for {1}'.format(len(md5_files), slx_id))
+  md5_file_paths = []
+  for file in md5_files:
+    file_path, verified = await loop.run_in_executor(ftp_executor, ftp_download_verified, working_directory, ftp_server, file, None, 3, None, True)
+    md5_file_paths.append(file_path)
+  md5_check_hash_dictionary = md5_expected_hashes(md5_file_paths)
+
+  sample_files = {}
+  for index in samples_information['Index']:
+    sample_files[index] = [file for file in other_files if file.endswith('.fq.gz') and '.{0}.'.format(index) in file]
+    if len(sample_files[index]) == 0:
+      if samples is None: # Otherwise already reported, or left out on purpose, by "sample_file_selection"
+        util.warn('No files found on the FTP server for index {0}'.format(index))
+      del sample_files[index]
+
+  download_order = [file for index in sample_files for file in sample_files[index]] # Sample by sample so samples complete early
+  download_order += [file for file in other_files if file not in download_order]
+
+  if rRNA_library is not None:
+    subfolder_check, subfolder = rna_seq_lane_merger.lane_merged_subfolder(working_directory)
+    rRNA_output_subdirectory = rRNA_remover.output_preperation(subfolder)
+  else:
+    rRNA_output_subdirectory = None
+
+  async def downloader():
+    try:
+      for file in download_order:
+        file_path, verified = await loop.run_in_executor(ftp_executor, ftp_download_verified, working_directory, ftp_server, file,
+                                                         md5_check_hash_dictionary.get(file), 3, server_files[file]['size'], False, download_times)
+        await verified_files.put((file, file_path, verified))
+    finally:
+      await verified_files.put(None) # Always ends the dispatcher; a download error is re-raised by "await download_task"
+
+  async def dispatcher():
+    outstanding = {index: set(sample_files[index]) for index in sample_files}
+    verified_paths = {index: [] for index in sample_files}
+    downloaded_files = list(md5_file_paths)
+    failed_files = []
+    processing = []
+
+    while True:
+      event = await verified_files.get()
+      if event is None:
+        break
+
+      file, file_path, verified = event
+      if not verified:
+        failed_files.append(file)
+        continue
+      downloaded_files.append(file_path)
+
+      for index in outstanding:
+        if file in outstanding[index]:
+          outstanding[index].discard(file)
+          verified_paths[index].append(file_path)
+          if len(outstanding[index]) == 0:
+            processing.append(loop.run_in_executor(processing_executor, sample_processor, working_directory, index, sorted(verified_paths[index]),
+                                                   lane_tags, paired_single, paired_tags, rRNA_library, rRNA_output_subdirectory, engine))
+
+    util.info('All downloads finished, waiting for {0} samples still processing'.format(len(processing)))
+    processed = await asyncio.gather(*processing)
+    merged_files = [merged_file for sample_merged_files in processed for merged_file in sample_merged_files]
+    return(downloaded_files, failed_files, merged_files)
+
+  try:
+    download_task = asyncio.ensure_future(downloader())
+    downloaded_files, failed_files, merged_files = await dispatcher()
+    await download_task
+    record_downloads(samples_information, download_times)
+  finally:
+    ftp_executor.shutdown()
+    processing_executor.shutdown()
+
+  return(downloaded_files, failed_files, merged_files)
+
+
+@instrumentation.timed
 def samples_csv_writer(working_directory, slx_id, samples_information):
   '''Automatically creates a samples.csv file based on what was downloaded and included in CRUKCI_SLX_Submission.xlsx file
   
@@ -227,14 +876,20 @@ def samples_csv_writer(working_directory, slx_id, samples_information):
   samples_information['read2'] = ''
   samples_information['condition'] = ''
 
+  missing_samples = []
   for index, row in samples_information.iterrows():
     glob_pattern = os.path.join(working_directory, '{0}.{1}*.r_*.fq.gz'.format(slx_id, row['Index']))
     globbing = sorted(glob.glob(glob_pattern))
-    samples_information['read1'][index] = globbing[0]
+    if len(globbing) == 0: # e.g. a sample left out of a selective download
+      util.warn('No .fq.gz files found for {0}, leaving it out of samples.csv'.format(row['Name']))
+      missing_samples.append(index)
+      continue
+    samples_information.loc[index, 'read1'] = globbing[0]
 
     if len(globbing) == 2:
-      samples_information['read2'][index] = globbing[1]
+      samples_information.loc[index, 'read2'] = globbing[1]
 
+  samples_information = samples_information.drop(missing_samples)
   del samples_information['Index']
   samples_information = samples_information.rename(columns = {'Name': 'samples'})
 
@@ -251,28 +906,116 @@ if __name__ == '__main__':
                       metavar = 'FILENAME',
                       help = 'Path to the submission form (e.g. CRUKCI_SLX_Submission.xlsx) - Please provide full path and ensure this file is in same folder as where you wish to download the RNA-Seq files to.')
 
+  parser.add_argument('--pipeline', action = 'store_true',
+                      help = 'Merge lanes (and optionally remove rRNA) for each sample as soon as its files have downloaded and passed the MD5 check, while other files are still downloading.')
+
+  parser.add_argument('-l', '--lane_tags',
+                      type = str,
+                      nargs = '+',
+                      metavar = 'lane_tag',
+                      help = 'Pipeline mode only. Tags that identify samples\' RNA-Seq lanes e.g. "s_1 s_2".')
+
+  group = parser.add_mutually_exclusive_group() # Sets --single_end and --paired_end as mutually exclusive arguments
+  group.add_argument('-s', '--single_end', action = 'store_true',
+                     help = 'Pipeline mode only. Flag if RNA-Seq data are single end reads. Mutually exclusive with the -p/--paired_end argument.')
+  group.add_argument('-p', '--paired_end', nargs = 2, metavar = '<PAIR_TAG>',
+                     help = 'Pipeline mode only. Flag if RNA-Seq data are paired end reads. Mutually exclusive with the -s/--single_end argument. Provide pair tags, this will be the same as PRAGUI\'s "pair_tags" argument.')
+
+  parser.add_argument('-r', '--rRNA_library',
+                      type = str,
+                      metavar = '<FILE>',
+                      help = 'Pipeline mode only. Path to the rRNA genome library (.fa file). If provided, rRNA reads are removed from each merged sample.')
+
+  parser.add_argument('-w', '--workers',
+                      type = int,
+                      default = 4,
+                      metavar = '<WORKERS>',
+                      help = 'Pipeline mode only. Maximum number of samples processed at the same time (default 4).')
+
+  parser.add_argument('-e', '--engine',
+                      type = str,
+                      default = 'shell',
+                      choices = ['shell', 'python'],
+                      help = 'Pipeline mode only. Lane merger engine: "shell" pipes zcat into pigz, "python" merges in-process with zlib (default shell).')
+
+  parser.add_argument('--samples',
+                      type = str,
+                      nargs = '*',
+                      metavar = '<SAMPLE>',
+                      help = 'Only download these samples (names or indexes from the submission form) and the .md5sums.txt files. Without any samples listed, every sample on the submission form is downloaded but other files on the server are not.')
+
+  parser.add_argument('--cache_directory',
+                      type = str,
+                      metavar = '<DIRECTORY>',
+                      help = 'Folder of earlier deliveries (searched with its sub-folders). Files found there with the same name and size are hard-linked instead of downloaded, then MD5 checked as usual. Must be on the same file system.')
+
+  io_governor.add_arguments(parser)
+  run_history.add_arguments(parser)
+
+  parser.add_argument('--profile', type = str, metavar = '<FILE>',
+                      help = 'Record wall time, CPU time, bytes read/written and child process peak memory for each step. Written as a Chrome trace if FILE ends in .json, otherwise as JSON lines.')
+
+  args = parser.parse_args()
+  if args.profile is not None:
+    instrumentation.enable_profile(args.profile)
+  if args.pipeline and (args.lane_tags is None or (not args.single_end and args.paired_end is None)):
+    parser.error('--pipeline requires --lane_tags and one of --single_end / --paired_end')
+  io_governor.configure_from_arguments(args)
+  run_history.start_run('cruk_downloader', args)
+
   ftp_username = input('Enter FTP server\'s username: ')
   ftp_password = input('Enter FTP server\'s password: ')
 
-  args = parser.parse_args()
+  if args.single_end == True:
+    paired_single = 'single'
+    paired_tags = None
+  else:
+    paired_single = 'paired'
+    paired_tags = args.paired_end
 
   working_directory = os.path.abspath(os.path.split(args.submission_form)[0])
   directory_check = check_directory(working_directory, 'working_directory')
 
+  cache_directory = None
+  if args.cache_directory is not None:
+    cache_directory = check_directory(args.cache_directory, 'cache_directory')
+
   samples_information, slx_id = glob_lister(os.path.abspath(args.submission_form))
   ftp_server = ftp_server_connection(ftp_username, ftp_password)
-  downloaded_files = ftp_download_files(ftp_server, slx_id)
-  ftp_server.quit()
 
-  retries = 0
-  md5_check = False
-  while md5_check == False:
-    if retries >= 3:
-      util.critical('{0} retries at downloading files have failed. Please try again later'.format(retries))
+  if args.pipeline:
+    import asyncio
+
+    rRNA_library = None
+    if args.rRNA_library is not None:
+      rRNA_library = rRNA_remover.check_rRNA_library(os.path.abspath(args.rRNA_library))
+
+    downloaded_files, failed_files, merged_files = asyncio.run(ftp_pipeline(working_directory, ftp_server, slx_id, samples_information, args.lane_tags,
+                                                                            paired_single, paired_tags, rRNA_library, args.workers, args.engine,
+                                                                            args.samples, cache_directory))
+    ftp_server.quit()
+
+    if len(failed_files) > 0:
+      util.critical('{0} files did not pass MD5 checksum test after 3 download attempts. Please try again later'.format(len(failed_files)))
+    util.info('{0} merged files created'.format(len(merged_files)))
+
+  else:
+    server_files, selected_files = ftp_file_selection(working_directory, ftp_server, slx_id, samples_information, args.samples, cache_directory)
+
+    retries = 0
+    md5_check = False
+    download_times = {}
+    while md5_check == False:
+      if retries >= 3:
+        util.critical('{0} retries at downloading files have failed. Please try again later'.format(retries))
 
-    md5_check = file_md5_check(downloaded_files)
-    retries += 1
+      downloaded_files = ftp_download_files(working_directory, ftp_server, slx_id, selected_files, server_files, download_times) # Fetches files removed by a failed check again
+      md5_check = file_md5_check(downloaded_files)
+      retries += 1
+    ftp_server.quit()
+    record_downloads(samples_information, download_times)
 
   samples_csv_writer(working_directory, slx_id, samples_information)
 
+  run_history.finish_run()
   util.info('Run complete')
@@ -0,0 +1,374 @@
+import os, glob, json, argparse
+import rnaseq_util as util
+import instrumentation, run_history
+import gzip_merge_engine
+
+BASES = ['A', 'C', 'G', 'T', 'N']
+MAX_QUALITY = 93
+lookup_tables = {}
+
+
+def base_code_table():
+  '''Lookup table from byte value to base code (A, C, G, T are 0-3), built on first use.
+  numpy is imported inside the functions that need it so importing this module stays cheap.
+
+  Returns
+  -------
+  base_codes (numpy array):
+    Base code for each of the 256 byte values; anything that is not A, C, G or T is counted as N (4)
+
+  '''
+
+  import numpy
+
+  if 'base_codes' not in lookup_tables:
+    base_codes = numpy.full(256, 4, dtype = numpy.int64)
+    for base_code, base in enumerate('ACGT'):
+      base_codes[ord(base)] = base_code
+      base_codes[ord(base.lower())] = base_code
+    lookup_tables['base_codes'] = base_codes
+
+  return(lookup_tables['base_codes'])
+
+
+def new_qc_state():
+  '''Creates the dictionary that accumulates QC statistics over a FASTQ stream
+
+  Returns
+  -------
+  state (dictionary):
+    Running totals and per-position arrays, all starting empty
+
+  '''
+
+  import numpy
+
+  state = {'reads': 0, 'bases': 0, 'gc_bases': 0, 'quality_sum': 0,
+           'length_counts': numpy.zeros(0, dtype = numpy.int64),
+           'base_counts': numpy.zeros((0, 5), dtype = numpy.int64),
+           'position_quality_sum': numpy.zeros(0, dtype = numpy.float64),
+           'read_gc_histogram': numpy.zeros(101, dtype = numpy.int64),
+           'read_quality_histogram': numpy.zeros(MAX_QUALITY + 1, dtype = numpy.int64),
+           'remainder': b''}
+  return(state)
+
+
+def grow(array, length):
+  '''Pads an accumulator array with zeros along its first axis up to the given length'''
+
+  import numpy
+
+  if array.shape[0] >= length:
+    return(array)
+  padding = numpy.zeros((length - array.shape[0],) + array.shape[1:], dtype = array.dtype)
+  return(numpy.concatenate([array, padding]))
+
+
+def qc_batch(state, sequences, qualities):
+  '''Adds a batch of reads to the QC statistics. All reads in the batch are handled
+  together with NumPy: the sequences are joined into one array and each base is
+  given its position within its read, so no per-read Python loop is needed.
+
+  Parameters
+  ----------
+  state (dictionary):
+    QC state from "new_qc_state"
+
+  sequences (list):
+    Sequence lines (bytes) of the reads
+
+  qualities (list):
+    Quality lines (bytes) of the reads, same order as sequences
+
+  '''
+
+  import numpy
+
+  if len(sequences) == 0:
+    return
+
+  lengths = numpy.fromiter(map(len, sequences), dtype = numpy.int64, count = len(sequences))
+  total_bases = int(lengths.sum())
+  max_length = int(lengths.max())
+
+  state['reads'] += len(sequences)
+  state['bases'] += total_bases
+  state['length_counts'] = grow(state['length_counts'], max_length + 1)
+  state['length_counts'][:max_length + 1] += numpy.bincount(lengths, minlength = max_length + 1)
+
+  if total_bases == 0:
+    return
+
+  base_codes = base_code_table()[numpy.frombuffer(b''.join(sequences), dtype = numpy.uint8)]
+  quality_scores = numpy.frombuffer(b''.join(qualities), dtype = numpy.uint8).astype(numpy.int64) - 33
+  offsets = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+  positions = numpy.arange(total_bases) - numpy.repeat(offsets, lengths)
+
+  state['base_counts'] = grow(state['base_counts'], max_length)
+  state['base_counts'][:max_length] += numpy.bincount(positions * 5 + base_codes, minlength = max_length * 5).reshape(max_length, 5)
+  state['position_quality_sum'] = grow(state['position_quality_sum'], max_length)
+  state['position_quality_sum'][:max_length] += numpy.bincount(positions, weights = quality_scores, minlength = max_length)
+  state['quality_sum'] += int(quality_scores.sum())
+
+  gc = ((base_codes == 1) | (base_codes == 2)).astype(numpy.int64)
+  state['gc_bases'] += int(gc.sum())
+
+  non_empty = lengths > 0
+  read_offsets = offsets[non_empty]
+  read_lengths = lengths[non_empty]
+  read_gc_percent = numpy.rint(100.0 * numpy.add.reduceat(gc, read_offsets) / read_lengths).astype(numpy.int64)
+  state['read_gc_histogram'] += numpy.bincount(read_gc_percent, minlength = 101)
+  read_mean_quality = numpy.clip(numpy.add.reduceat(quality_scores, read_offsets) // read_lengths, 0, MAX_QUALITY)
+  state['read_quality_histogram'] += numpy.bincount(read_mean_quality, minlength = MAX_QUALITY + 1)
+
+
+def qc_update(state, data):
+  '''Adds a block of decompressed FASTQ data to the QC statistics. Blocks do not need
+  to end on a read boundary; an incomplete final read is held until the next block.
+
+  Parameters
+  ----------
+  state (dictionary):
+    QC state from "new_qc_state"
+
+  data (bytes):
+    Decompressed FASTQ data
+
+  '''
+
+  lines = (state['remainder'] + data).split(b'\n')
+  complete_lines = ((len(lines) - 1) // 4) * 4
+  state['remainder'] = b'\n'.join(lines[complete_lines:])
+  qc_batch(state, lines[1:complete_lines:4], lines[3:complete_lines:4])
+
+
+def qc_tap(blocks, state):
+  '''Passes decompressed blocks straight through while collecting QC statistics
+  from them, e.g. on the python lane merger engine's stream.
+
+  Parameters
+  ----------
+  blocks (iterable):
+    Blocks of decompressed FASTQ data
+
+  state (dictionary):
+    QC state from "new_qc_state"
+
+  Yields
+  ------
+  block (bytes):
+    The unchanged input blocks
+
+  '''
+
+  for block in blocks:
+    qc_update(state, block)
+    yield block
+
+
+def qc_report(state, fastq_file):
+  '''Summarises the QC statistics
+
+  Parameters
+  ----------
+  state (dictionary):
+    QC state from "new_qc_state"
+
+  fastq_file (string / os.path):
+    File the statistics were collected from
+
+  Returns
+  -------
+  report (dictionary):
+    JSON serialisable QC report
+
+  '''
+
+  import numpy
+
+  if state['remainder'].strip(): # Last read of a file without a trailing newline
+    qc_update(state, b'\n')
+
+  base_counts = state['base_counts']
+  position_totals = numpy.maximum(base_counts.sum(axis = 1), 1)
+  composition = base_counts / position_totals[:, None]
+  bases = max(state['bases'], 1)
+
+  report = {'file': fastq_file,
+            'reads': state['reads'],
+            'bases': state['bases'],
+            'mean_quality': round(state['quality_sum'] / bases, 3),
+            'gc_content': round(state['gc_bases'] / bases, 5),
+            'length_distribution': {str(length): int(count) for length, count in enumerate(state['length_counts']) if count > 0},
+            'per_position_base_composition': {base: [round(value, 5) for value in composition[:, base_code].tolist()]
+                                              for base_code, base in enumerate(BASES)},
+            'per_position_mean_quality': [round(value, 3) for value in (state['position_quality_sum'] / position_totals).tolist()],
+            'read_gc_distribution': state['read_gc_histogram'].tolist(),
+            'read_mean_quality_distribution': state['read_quality_histogram'].tolist()}
+  return(report)
+
+
+def qc_report_path(fastq_file, output_directory):
+  '''Gives the JSON report location for a .fq.gz file'''
+
+  report_name = os.path.basename(fastq_file).replace('.fq.gz', '') + '.qc.json'
+  return(os.path.join(output_directory, report_name))
+
+
+def qc_write_report(state, fastq_file, output_directory):
+  '''Writes the QC report of a file as JSON into the output directory
+
+  Returns
+  -------
+  report_file (string / os.path):
+    Location of the JSON report
+
+  '''
+
+  report_file = qc_report_path(fastq_file, output_directory)
+  with open(report_file, 'w') as report_output:
+    json.dump(qc_report(state, fastq_file), report_output, indent = 1)
+  util.info('QC report written to {0}'.format(report_file))
+  return(report_file)
+
+
+def qc_file(fastq_file, output_directory):
+  '''Collects QC statistics for one .fq.gz file in a single decompression pass
+
+  Parameters
+  ----------
+  fastq_file (string / os.path):
+    Full path of the .fq.gz file
+
+  output_directory (string / os.path):
+    Folder for the JSON report
+
+  Returns
+  -------
+  report_file (string / os.path):
+    Location of the JSON report
+
+  '''
+
+  util.info('Collecting QC statistics for {0}'.format(fastq_file))
+  state = new_qc_state()
+  for block in gzip_merge_engine.gzip_block_reader([fastq_file]):
+    qc_update(state, block)
+  return(qc_write_report(state, fastq_file, output_directory))
+
+
+def qc_output_preparation(directory):
+  '''Creates the "qc_reports" sub-folder within a directory, if needed
+
+  Returns
+  -------
+  output_directory (string / os.path):
+    Path to the "qc_reports" sub-folder
+
+  '''
+
+  output_directory = os.path.join(directory, 'qc_reports')
+  os.makedirs(output_directory, exist_ok = True)
+  return(output_directory)
+
+
+@instrumentation.timed
+def qc_directory(directory, output_directory = None, processes = None):
+  '''Collects QC statistics for every .fq.gz file in a directory (e.g. "lane_merged" or
+  "rRNA_processed"), processing files in parallel across a process pool.
+
+  Parameters
+  ----------
+  directory (string / os.path):
+    Folder containing the .fq.gz files
+
+  output_directory (string / os.path / None):
+    Folder for the JSON reports, defaults to a "qc_reports" sub-folder
+
+  processes (int / None):
+    Number of worker processes, defaults to the number of CPUs
+
+  Returns
+  -------
+  report_files (list):
+    Locations of the JSON reports
+
+  '''
+
+  fastq_files = sorted(glob.glob(os.path.join(directory, '*.fq.gz')))
+  if len(fastq_files) == 0:
+    util.critical('There are no gzipped fastq (FILENAME.fq.gz) files within specified directory: {0}'.format(directory))
+
+  if output_directory is None:
+    output_directory = qc_output_preparation(directory)
+
+  return(qc_files(fastq_files, output_directory, processes))
+
+
+@instrumentation.timed
+def qc_files(fastq_files, output_directory, processes = None):
+  '''Collects QC statistics for the given .fq.gz files, e.g. only those a run has just written,
+  processing files in parallel across a process pool.
+
+  Parameters
+  ----------
+  fastq_files (list):
+    Full paths of the .fq.gz files
+
+  output_directory (string / os.path):
+    Folder for the JSON reports
+
+  processes (int / None):
+    Number of worker processes, defaults to the number of CPUs
+
+  Returns
+  -------
+  report_files (list):
+    Locations of the JSON reports
+
+  '''
+
+  import concurrent.futures
+
+  util.info('Collecting QC statistics for {0} files'.format(len(fastq_files)))
+  if len(fastq_files) == 0:
+    return([])
+
+  with concurrent.futures.ProcessPoolExecutor(max_workers = processes) as executor:
+    report_files = list(executor.map(qc_file, fastq_files, [output_directory] * len(fastq_files)))
+
+  return(report_files)
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description = 'Collect read count, length, base composition, quality and GC statistics for .fq.gz files')
+  parser.add_argument('-d', '--directory', help = 'Specify the location of the .fq.gz files e.g. the "lane_merged" or "rRNA_processed" folder',
+                      type = str, metavar = '<DIRECTORY>', required = True)
+  parser.add_argument('-o', '--output_directory', help = 'Folder for the JSON reports. Default is a "qc_reports" sub-folder of --directory',
+                      type = str, metavar = '<DIRECTORY>')
+  parser.add_argument('-n', '--processes', help = 'Number of files processed at the same time. Defaults to the number of CPUs',
+                      type = int, metavar = '<PROCESSES>')
+
+  run_history.add_arguments(parser)
+
+  parser.add_argument('--profile', type = str, metavar = '<FILE>',
+                      help = 'Record wall time, CPU time, bytes read/written and child process peak memory for each step. Written as a Chrome trace if FILE ends in .json, otherwise as JSON lines.')
+
+  args = parser.parse_args()
+  if args.profile is not None:
+    instrumentation.enable_profile(args.profile)
+  run_history.start_run('fastq_qc', args)
+
+  directory = os.path.abspath(args.directory)
+  if not os.path.isdir(directory):
+    util.critical('Invalid --directory location. Please ensure directory exists before proceeding:\n\t{0}'.format(args.directory))
+
+  output_directory = args.output_directory
+  if output_directory is not None:
+    output_directory = os.path.abspath(output_directory)
+    os.makedirs(output_directory, exist_ok = True)
+
+  qc_directory(directory, output_directory, args.processes)
+  run_history.finish_run()
+  util.info('Process complete')
@@ -0,0 +1,212 @@
+import os, json, time, collections, itertools
+import rnaseq_util as util
+import instrumentation, io_governor
+import gzip_merge_engine, fastq_subsampler
+
+BATCH_READS = 16384
+
+
+def fastq_batches(input_files, batch_reads, stats = None):
+  '''Streams the reads of one or more .fq.gz files in batches of a fixed number of reads,
+  always split on read boundaries
+
+  Parameters
+  ----------
+  input_files (list):
+    Full paths of the .fq.gz files, read in the order given
+
+  batch_reads (int):
+    Number of reads in each batch; only the last batch can hold fewer
+
+  stats (dictionary / None):
+    Dictionary from "gzip_merge_engine.new_engine_stats" to add the read and decompress timings to
+
+  Yields
+  ------
+  data (bytes):
+    Complete FASTQ records, ending with a newline
+
+  reads (int):
+    Number of reads in the batch
+
+  '''
+
+  batch_lines = batch_reads * 4
+  pending_lines = []
+  remainder = b''
+
+  for block in gzip_merge_engine.gzip_block_reader(input_files, stats = stats):
+    lines = (remainder + block).split(b'\n')
+    remainder = lines.pop()
+    pending_lines += lines
+    while len(pending_lines) >= batch_lines:
+      yield(b'\n'.join(pending_lines[:batch_lines]) + b'\n', batch_reads)
+      del pending_lines[:batch_lines]
+
+  if remainder: # Last read of a file without a trailing newline
+    pending_lines.append(remainder)
+  while pending_lines and pending_lines[-1] == b'':
+    pending_lines.pop()
+  if len(pending_lines) % 4 != 0:
+    util.critical('Incomplete FASTQ record at the end of {0}'.format(', '.join(input_files)))
+  if pending_lines:
+    yield(b'\n'.join(pending_lines) + b'\n', len(pending_lines) // 4)
+
+
+def shard_file_name(output_file, shard_number):
+  '''Gives the name of one shard of a merged file, e.g. "SLX-1.D701_D501.HXXX.merged.r_1.fq.gz"
+  becomes "SLX-1.D701_D501.HXXX.merged_shard_001.r_1.fq.gz". Each shard keeps the CRUK naming
+  format, so "rRNA_remover.paired_reads_finder" pairs up the mates of every shard.
+
+  Parameters
+  ----------
+  output_file (string / os.path):
+    Full path of the merged (unsharded) file
+
+  shard_number (int):
+    Shard number, starting at 1
+
+  Returns
+  -------
+  shard_file (string / os.path):
+    Full path of the shard
+
+  '''
+
+  directory, file_name = os.path.split(output_file)
+  if '.merged.' in file_name:
+    file_name = file_name.replace('.merged.', '.merged_shard_{0:03d}.'.format(shard_number), 1)
+  else:
+    file_name = file_name.replace('.fq.gz', '.shard_{0:03d}.fq.gz'.format(shard_number))
+  return(os.path.join(directory, file_name))
+
+
+def shard_manifest_name(output_file):
+  '''Gives the manifest location for a sample's shards, e.g. "SLX-1.D701_D501.HXXX.merged_shards.json"'''
+
+  directory, file_name = os.path.split(output_file)
+  if '.merged.' in file_name:
+    file_name = file_name.split('.merged.')[0] + '.merged_shards.json'
+  else:
+    file_name = file_name.replace('.fq.gz', '.shards.json')
+  return(os.path.join(directory, file_name))
+
+
+@instrumentation.timed
+def sharded_merge(mate_input_files, mate_output_files, shards = 2, max_reads_per_shard = None, threads = 4, level = 6):
+  '''Merges a sample's lanes into read-synchronised shards in one streaming pass. The mates
+  (r_1 and r_2) are read in step, in batches of the same number of reads, and each batch goes
+  to the same shard for every mate. Batches are dealt round-robin over the shards so they
+  fill evenly. With a maximum number of reads per shard, a full shard is closed and a new one
+  takes its place, so there can be more shards than requested. Batches for every shard are
+  compressed on one shared thread pool and written in order. A JSON manifest lists the shards.
+
+  Parameters
+  ----------
+  mate_input_files (list):
+    One list of lane files per mate (one list for single end reads)
+
+  mate_output_files (list):
+    Full path of the merged (unsharded) file of each mate, used to name the shards
+
+  shards (int):
+    Number of shards filled at the same time
+
+  max_reads_per_shard (int / None):
+    Maximum number of reads (or pairs) in a shard
+
+  threads (int):
+    Number of compression threads
+
+  level (int):
+    gzip compression level (1-9)
+
+  Returns
+  -------
+  manifest (dictionary):
+    Shard files, read counts and settings, as written to the manifest file
+
+  stats (dictionary):
+    Byte counters and per-stage timings
+
+  '''
+
+  import concurrent.futures
+
+  stats = gzip_merge_engine.new_engine_stats()
+  wall_start = time.perf_counter()
+
+  batch_reads = BATCH_READS
+  if max_reads_per_shard is not None: # Batches that divide the maximum (nearly) evenly, so shards end up close to full
+    batch_reads = max(1, max_reads_per_shard // -(-max_reads_per_shard // BATCH_READS))
+
+  manifest = {'inputs': [sorted(input_files) for input_files in mate_input_files], 'shards_filled_together': shards,
+              'max_reads_per_shard': max_reads_per_shard, 'batch_reads': batch_reads, 'reads': 0, 'shards': []}
+  batch_streams = [fastq_batches(input_files, batch_reads, stats) for input_files in manifest['inputs']]
+
+  slots = [None] * shards
+  in_flight = collections.deque()
+  max_in_flight = threads * 2 # Bounds memory use while keeping every thread busy
+
+  def write_member():
+    shard, mate, future = in_flight.popleft()
+    member, seconds = future.result()
+    stats['compress_seconds'] += seconds
+    io_governor.throttle(len(member))
+    write_start = time.perf_counter()
+    shard['handles'][mate].write(member)
+    stats['write_seconds'] += time.perf_counter() - write_start
+    stats['bytes_written'] += len(member)
+
+  def close_shard(shard):
+    while in_flight: # Its last batches must be written before its files are closed
+      write_member()
+    for handle in shard['handles']:
+      handle.close()
+
+  def open_shard():
+    shard_number = len(manifest['shards']) + 1
+    files = [shard_file_name(output_file, shard_number) for output_file in mate_output_files]
+    manifest['shards'].append({'shard': shard_number, 'reads': 0, 'files': files})
+    return({'entry': manifest['shards'][-1], 'handles': [open(shard_file, 'wb') for shard_file in files]})
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers = threads) as executor:
+    try:
+      for batch_number, batches in enumerate(itertools.zip_longest(*batch_streams)):
+        if None in batches or len(set(reads for data, reads in batches)) > 1:
+          util.critical('Paired files do not contain the same number of reads: {0}'.format(', '.join(manifest['inputs'][0])))
+        names = [fastq_subsampler.read_name(data[:data.index(b'\n')]) for data, reads in batches]
+        if len(set(names)) > 1:
+          util.critical('Paired files are out of sync at read {0}: {1}'.format(manifest['reads'] + 1, ', '.join(manifest['inputs'][0])))
+
+        reads = batches[0][1]
+        slot = batch_number % shards
+        shard = slots[slot]
+        if shard is None or (max_reads_per_shard is not None and shard['entry']['reads'] + reads > max_reads_per_shard):
+          if shard is not None:
+            close_shard(shard)
+          shard = slots[slot] = open_shard()
+
+        shard['entry']['reads'] += reads
+        manifest['reads'] += reads
+        for mate, (data, reads) in enumerate(batches):
+          in_flight.append((shard, mate, executor.submit(gzip_merge_engine.gzip_compress_block, data, level)))
+        while len(in_flight) >= max_in_flight:
+          write_member()
+
+      while in_flight:
+        write_member()
+    finally:
+      for shard in slots:
+        if shard is not None:
+          for handle in shard['handles']:
+            handle.close()
+
+  stats['wall_seconds'] = time.perf_counter() - wall_start
+
+  manifest_file = shard_manifest_name(mate_output_files[0])
+  with open(manifest_file, 'w') as manifest_output:
+    json.dump(manifest, manifest_output, indent = 1)
+  util.info('{0} reads written to {1} shards, listed in {2}'.format(manifest['reads'], len(manifest['shards']), manifest_file))
+
+  return(manifest, stats)
@@ -0,0 +1,366 @@
+import os, time, argparse, hashlib, random, queue, itertools
+import rnaseq_util as util
+import instrumentation, run_history
+import gzip_merge_engine, rRNA_remover
+
+WRITE_BLOCK_SIZE = 4194304
+
+
+def read_name(header):
+  '''Gives the read name shared by both mates of a pair, i.e. the header up to the
+  first whitespace with any "/1" or "/2" suffix removed
+
+  Parameters
+  ----------
+  header (bytes):
+    FASTQ header line
+
+  Returns
+  -------
+  name (bytes):
+    Read name
+
+  '''
+
+  name = header[1:].split(None, 1)[0] if len(header) > 1 else b''
+  if name.endswith(b'/1') or name.endswith(b'/2'):
+    name = name[:-2]
+  return(name)
+
+
+def fastq_records(fastq_file):
+  '''Streams the reads of a .fq.gz file
+
+  Parameters
+  ----------
+  fastq_file (string / os.path):
+    Full path of the .fq.gz file
+
+  Yields
+  ------
+  header (bytes):
+    Header line of the read
+
+  record (bytes):
+    The complete four line record, including the final newline
+
+  '''
+
+  remainder = b''
+  for block in gzip_merge_engine.gzip_block_reader([fastq_file]):
+    lines = (remainder + block).split(b'\n')
+    complete_lines = ((len(lines) - 1) // 4) * 4
+    remainder = b'\n'.join(lines[complete_lines:])
+    for line_number in range(0, complete_lines, 4):
+      yield(lines[line_number], b'\n'.join(lines[line_number:line_number + 4]) + b'\n')
+
+  lines = remainder.split(b'\n') # Last read of a file without a trailing newline
+  if len(lines) >= 4:
+    yield(lines[0], b'\n'.join(lines[0:4]) + b'\n')
+
+
+def hash_fraction(name, salt):
+  '''Maps a read name to a number in [0, 1). The same name and seed always give the same
+  number, so both mates of a pair (and repeated runs) make the same sampling decision.
+
+  Parameters
+  ----------
+  name (bytes):
+    Read name from "read_name"
+
+  salt (bytes):
+    Seed derived salt (up to 16 bytes)
+
+  Returns
+  -------
+  fraction (float):
+    Pseudo-random number in [0, 1)
+
+  '''
+
+  digest = hashlib.blake2b(name, digest_size = 8, salt = salt).digest()
+  return(int.from_bytes(digest, 'big') / 18446744073709551616.0)
+
+
+def queue_blocks(block_queue):
+  '''Yields blocks from a queue until None is received'''
+
+  while True:
+    block = block_queue.get()
+    if block is None:
+      return
+    yield block
+
+
+def put_block(block_queue, block, writer):
+  '''Queues a block for a writer thread, failing fast instead of waiting forever if the writer
+  has stopped (e.g. full disk or unwritable output folder)
+
+  Parameters
+  ----------
+  block_queue (queue.Queue):
+    Bounded queue read by the writer
+
+  block (bytes / None):
+    Block to write, None to end the output file
+
+  writer (concurrent.futures.Future):
+    The writer reading the queue; its exception is re-raised if it has failed
+
+  '''
+
+  while True:
+    try:
+      block_queue.put(block, timeout = 1)
+      return
+    except queue.Full:
+      if writer.done():
+        writer.result()
+        raise RuntimeError('Writer stopped before the end of its output') # Only reached if it returned early without an error
+
+
+def subsample_sample(read_files, output_files, fraction = None, reads = None, seed = 11, threads = 2):
+  '''Subsamples one sample, keeping mates in sync.
+  With a fraction each read is kept if the hash of its name falls below the fraction, in a single streaming pass.
+  With a number of reads a seeded reservoir sample of that many read numbers is taken, and the chosen reads
+  are written on a second pass over the input, so only one number per kept read (or pair) is held in memory.
+
+  Parameters
+  ----------
+  read_files (list):
+    Full paths of the sample's .fq.gz files; one file for single end or two for paired end reads
+
+  output_files (list):
+    Full paths of the subsampled files, same order as read_files
+
+  fraction (float / None):
+    Fraction of reads to keep
+
+  reads (int / None):
+    Number of reads (or pairs) to keep
+
+  seed (int):
+    Random seed; the same seed gives the same subsample
+
+  threads (int):
+    Number of compression threads per output file
+
+  Returns
+  -------
+  kept (int):
+    Number of reads (or pairs) written
+
+  total (int):
+    Number of reads (or pairs) in the input
+
+  seconds (float):
+    Wall time taken, as the sample runs in its own process
+
+  '''
+
+  import concurrent.futures
+
+  start = time.perf_counter()
+  salt = hashlib.md5(str(seed).encode()).digest()
+  random_generator = random.Random(seed)
+  reservoir = []
+  kept = 0
+  total = 0
+
+  block_queues = [queue.Queue(maxsize = 4) for output_file in output_files]
+  buffers = [[] for output_file in output_files]
+  buffer_size = 0
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers = len(output_files)) as writer_executor:
+    writers = [writer_executor.submit(gzip_merge_engine.parallel_gzip_write, queue_blocks(block_queue), output_file, threads)
+               for block_queue, output_file in zip(block_queues, output_files)]
+
+    def flush_buffers():
+      for block_queue, writer, buffer in zip(block_queues, writers, buffers):
+        if buffer:
+          put_block(block_queue, b''.join(buffer), writer)
+          del buffer[:]
+
+    def buffer_records(records):
+      nonlocal buffer_size
+      for buffer, (header, record) in zip(buffers, records):
+        buffer.append(record)
+      buffer_size += len(records[0][1])
+      if buffer_size >= WRITE_BLOCK_SIZE:
+        flush_buffers()
+        buffer_size = 0
+
+    try:
+      for records in itertools.zip_longest(*[fastq_records(read_file) for read_file in read_files]):
+        if None in records:
+          util.critical('Paired files do not contain the same number of reads: {0}'.format(', '.join(read_files)))
+
+        name = read_name(records[0][0])
+        for header, record in records[1:]:
+          if read_name(header) != name:
+            util.critical('Paired files are out of sync at read {0}: {1}'.format(total + 1, ', '.join(read_files)))
+
+        if reads is not None:
+          if total < reads:
+            reservoir.append(total)
+          else:
+            replace_index = random_generator.randrange(total + 1)
+            if replace_index < reads:
+              reservoir[replace_index] = total
+          total += 1
+          continue
+
+        total += 1
+        if hash_fraction(name, salt) < fraction:
+          kept += 1
+          buffer_records(records)
+
+      if reads is not None: # Second pass writes the chosen reads in input order
+        reservoir.sort()
+        kept = len(reservoir)
+        chosen_reads = iter(reservoir)
+        chosen_read = next(chosen_reads, None)
+        for read_number, records in enumerate(zip(*[fastq_records(read_file) for read_file in read_files])):
+          if chosen_read is None:
+            break
+          if read_number == chosen_read:
+            buffer_records(records)
+            chosen_read = next(chosen_reads, None)
+
+      flush_buffers()
+    finally:
+      for block_queue, writer in zip(block_queues, writers):
+        try:
+          put_block(block_queue, None, writer)
+        except Exception: # A failed writer's error is raised by writer.result() below
+          pass
+
+    for writer in writers:
+      writer.result()
+
+  return(kept, total, time.perf_counter() - start)
+
+
+def subsample_output_preparation(working_directory):
+  '''Creates the "subsampled" sub-folder within the working directory, if needed
+
+  Returns
+  -------
+  output_subdirectory (string / os.path):
+    Path to the "subsampled" sub-folder
+
+  '''
+
+  output_subdirectory = os.path.join(working_directory, 'subsampled')
+  if not os.path.exists(output_subdirectory):
+    util.info('Creating sub-folder "subsampled" within {0}'.format(working_directory))
+    os.makedirs(output_subdirectory, exist_ok = True)
+  return(output_subdirectory)
+
+
+@instrumentation.timed
+def subsample_reads(working_directory, sample_reads, paired_single, output_subdirectory, fraction = None, reads = None,
+                    seed = 11, processes = None, threads = 2):
+  '''Subsamples every sample found by "rRNA_remover.paired_reads_finder", samples in parallel.
+  Output files keep their input names so the "subsampled" folder can be passed straight to rRNA_remover.py.
+
+  Parameters
+  ----------
+  working_directory (string / os.path):
+    Location of the .fq.gz files
+
+  sample_reads (dictionary):
+    Output of "rRNA_remover.paired_reads_finder"
+
+  paired_single (string):
+    Either "paired" or "single"
+
+  output_subdirectory (string / os.path):
+    Folder for the subsampled files
+
+  fraction (float / None):
+    Fraction of reads to keep
+
+  reads (int / None):
+    Number of reads (or pairs) to keep per sample
+
+  seed (int):
+    Random seed; the same seed gives the same subsample
+
+  processes (int / None):
+    Number of samples processed at the same time, defaults to the number of CPUs
+
+  threads (int):
+    Number of compression threads per output file
+
+  '''
+
+  import concurrent.futures
+
+  with concurrent.futures.ProcessPoolExecutor(max_workers = processes) as executor:
+    subsampling = {}
+    for entries in sample_reads:
+      if paired_single == 'paired':
+        file_names = [sample_reads[entries]['1'], sample_reads[entries]['2']]
+      else:
+        file_names = [sample_reads[entries]]
+
+      read_files = [os.path.join(working_directory, file_name) for file_name in file_names]
+      output_files = [os.path.join(output_subdirectory, file_name) for file_name in file_names]
+      subsampling[entries] = executor.submit(subsample_sample, read_files, output_files, fraction, reads, seed, threads)
+
+    for entries in subsampling:
+      kept, total, seconds = subsampling[entries].result()
+      util.info('{0}: kept {1} of {2} reads'.format(entries, kept, total))
+      read_files = [sample_reads[entries]['1'], sample_reads[entries]['2']] if paired_single == 'paired' else [sample_reads[entries]]
+      run_history.record_sample(entries, 'subsample', seconds, sum(os.path.getsize(os.path.join(working_directory, read_file)) for read_file in read_files),
+                                sum(os.path.getsize(os.path.join(output_subdirectory, read_file)) for read_file in read_files), total, threads = threads)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = 'Deterministically subsample RNA-Seq reads for pilot runs, keeping read pairs in sync')
+  parser.add_argument('-d', '--directory', help = 'Specify the location of the RNA-Seq data', type = str, metavar = '<DIRECTORY>', required = True)
+
+  group = parser.add_mutually_exclusive_group(required = True) # Sets --single_end and --paired_end as mutually exclusive arguments
+  group.add_argument('-s', '--single_end', help = 'Flag if RNA-Seq data are single end reads. Mutually exclusive with the -p/--paired_end argument.', action = 'store_true')
+  group.add_argument('-p', '--paired_end', nargs = 2, metavar = '<PAIR_TAG>',
+                     help = 'Flag if RNA-Seq data are paired end reads. Mutually exclusive with the -s/--single_end argument. Provide pair tags, this will be the same as PRAGUI\'s "pair_tags" argument.')
+
+  sampling = parser.add_mutually_exclusive_group(required = True)
+  sampling.add_argument('-f', '--fraction', help = 'Fraction of reads (or pairs) to keep, chosen by a hash of the read name', type = float, metavar = '<FRACTION>')
+  sampling.add_argument('-r', '--reads', help = 'Number of reads (or pairs) to keep per sample, chosen by seeded reservoir sampling. Only the chosen read numbers are held in memory; the input is read twice', type = int, metavar = '<READS>')
+
+  parser.add_argument('--seed', help = 'Random seed. The same seed always gives the same subsample (default 11)', type = int, default = 11, metavar = '<SEED>')
+  parser.add_argument('-n', '--processes', help = 'Number of samples processed at the same time. Defaults to the number of CPUs', type = int, metavar = '<PROCESSES>')
+  parser.add_argument('-t', '--threads', help = 'Number of compression threads per output file (default 2)', type = int, default = 2, metavar = '<THREADS>')
+
+  run_history.add_arguments(parser)
+
+  parser.add_argument('--profile', type = str, metavar = '<FILE>',
+                      help = 'Record wall time, CPU time, bytes read/written and child process peak memory for each step. Written as a Chrome trace if FILE ends in .json, otherwise as JSON lines.')
+
+  args = parser.parse_args()
+  if args.profile is not None:
+    instrumentation.enable_profile(args.profile)
+  run_history.start_run('fastq_subsampler', args)
+  if args.single_end == True:
+    paired_single = 'single'
+    paired_tags = None
+  else:
+    paired_single = 'paired'
+    paired_tags = args.paired_end
+
+  if args.fraction is not None and not 0 < args.fraction <= 1:
+    parser.error('--fraction must be greater than 0 and at most 1')
+  if args.reads is not None and args.reads < 1:
+    parser.error('--reads must be at least 1')
+
+  working_directory = rRNA_remover.check_directory(args.directory, 'working_directory')
+  fastq_gz_files = rRNA_remover.gzip_file_list(working_directory)
+  sample_reads = rRNA_remover.paired_reads_finder(fastq_gz_files, paired_single, paired_tags)
+  output_subdirectory = subsample_output_preparation(working_directory)
+  subsample_reads(working_directory, sample_reads, paired_single, output_subdirectory, args.fraction, args.reads,
+                  args.seed, args.processes, args.threads)
+  util.info('Subsampled files written to {0}. These can be passed to rRNA_remover.py with -d'.format(output_subdirectory))
+  run_history.finish_run()
+  util.info('Process complete')
@@ -0,0 +1,248 @@
+import zlib, time, collections
+import rnaseq_util as util
+import instrumentation, io_governor
+
+
+def new_engine_stats():
+  '''Creates the dictionary used to collect byte counts and timings for each stage of the engine
+
+  Returns
+  -------
+  stats (dictionary):
+    Byte counters and per-stage timings (seconds), all starting at zero
+
+  '''
+
+  stats = {'bytes_read': 0, 'bytes_decompressed': 0, 'bytes_written': 0,
+           'read_seconds': 0.0, 'decompress_seconds': 0.0, 'compress_seconds': 0.0,
+           'write_seconds': 0.0, 'wall_seconds': 0.0}
+  return(stats)
+
+
+def gzip_block_reader(input_files, block_size = 4194304, stats = None):
+  '''Decompresses one or more gzip files in large blocks, yielding the decompressed data in order.
+  Files made of several concatenated gzip members (e.g. pigz or earlier merges) are handled.
+
+  Parameters
+  ----------
+  input_files (list):
+    Full paths of the .gz files, read in the order given
+
+  block_size (int):
+    Number of compressed bytes read from disk at a time
+
+  stats (dictionary / None):
+    Dictionary from "new_engine_stats" to add the read and decompress timings to
+
+  Yields
+  ------
+  data (bytes):
+    Blocks of decompressed data
+
+  '''
+
+  if stats is None:
+    stats = new_engine_stats()
+
+  for input_file in input_files:
+    decompressor = zlib.decompressobj(31)
+    member_started = False
+
+    with open(input_file, 'rb') as compressed_file:
+      while True:
+        read_start = time.perf_counter()
+        compressed = compressed_file.read(block_size)
+        stats['read_seconds'] += time.perf_counter() - read_start
+        if not compressed:
+          break
+        stats['bytes_read'] += len(compressed)
+
+        while compressed:
+          decompress_start = time.perf_counter()
+          data = decompressor.decompress(compressed)
+          stats['decompress_seconds'] += time.perf_counter() - decompress_start
+          member_started = True
+
+          if data:
+            stats['bytes_decompressed'] += len(data)
+            yield data
+
+          if decompressor.eof: # Start of the next gzip member, if any
+            compressed = decompressor.unused_data.lstrip(b'\x00')
+            decompressor = zlib.decompressobj(31)
+            member_started = False
+          else:
+            compressed = b''
+
+    if member_started and not decompressor.eof:
+      util.critical('Truncated gzip file, cannot merge: {0}'.format(input_file))
+
+
+def gzip_compress_block(block, level):
+  '''Compresses a block of data into a complete gzip member. zlib releases the GIL
+  while compressing so several blocks can be compressed at once on a thread pool.
+
+  Parameters
+  ----------
+  block (bytes):
+    Data to be compressed
+
+  level (int):
+    gzip compression level (1-9)
+
+  Returns
+  -------
+  member (bytes):
+    Complete gzip member
+
+  seconds (float):
+    Time taken to compress the block
+
+  '''
+
+  compress_start = time.perf_counter()
+  compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+  member = compressor.compress(block) + compressor.flush()
+  return(member, time.perf_counter() - compress_start)
+
+
+def parallel_gzip_write(blocks, output_file, threads = 4, level = 6, chunk_size = 16777216, stats = None):
+  '''Compresses a stream of data in parallel chunks and writes them, in order, as
+  concatenated gzip members. The output is a valid .gz file readable by zcat, gzip and pigz.
+
+  Parameters
+  ----------
+  blocks (iterable):
+    Blocks of uncompressed data e.g. from "gzip_block_reader"
+
+  output_file (string / os.path):
+    Full path of the file to be created
+
+  threads (int):
+    Number of compression threads
+
+  level (int):
+    gzip compression level (1-9)
+
+  chunk_size (int):
+    Number of uncompressed bytes in each gzip member
+
+  stats (dictionary / None):
+    Dictionary from "new_engine_stats" to add the compress and write timings to
+
+  Returns
+  -------
+  stats (dictionary):
+    Byte counters and per-stage timings
+
+  '''
+
+  import concurrent.futures # Imports logging, so kept out of module start-up
+
+  if stats is None:
+    stats = new_engine_stats()
+
+  in_flight = collections.deque()
+  max_in_flight = threads * 2 # Bounds memory use while keeping every thread busy
+
+  def write_member(compressed_output, future):
+    member, seconds = future.result()
+    stats['compress_seconds'] += seconds
+    io_governor.throttle(len(member))
+    write_start = time.perf_counter()
+    compressed_output.write(member)
+    stats['write_seconds'] += time.perf_counter() - write_start
+    stats['bytes_written'] += len(member)
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers = threads) as executor, open(output_file, 'wb') as compressed_output:
+    pending = []
+    pending_size = 0
+
+    for block in blocks:
+      pending.append(block)
+      pending_size += len(block)
+      if pending_size < chunk_size:
+        continue
+
+      in_flight.append(executor.submit(gzip_compress_block, b''.join(pending), level))
+      pending = []
+      pending_size = 0
+      while len(in_flight) >= max_in_flight:
+        write_member(compressed_output, in_flight.popleft())
+
+    if pending_size > 0:
+      in_flight.append(executor.submit(gzip_compress_block, b''.join(pending), level))
+    while in_flight:
+      write_member(compressed_output, in_flight.popleft())
+
+  return(stats)
+
+
+@instrumentation.timed
+def python_merge(input_files, output_file, threads = 4, level = 6, tap = None):
+  '''Merges gzip files without any external programs: the inputs are decompressed
+  with zlib in large blocks and the output is compressed in parallel chunks.
+
+  Parameters
+  ----------
+  input_files (list):
+    Full paths of the files to be merged, in order
+
+  output_file (string / os.path):
+    Full path of the merged file to be created
+
+  threads (int):
+    Number of compression threads
+
+  level (int):
+    gzip compression level (1-9)
+
+  tap (function / None):
+    Given the decompressed block iterator, returns the iterator to be compressed.
+    Allows the stream to be inspected (e.g. "fastq_qc.qc_tap") without a second pass
+
+  Returns
+  -------
+  stats (dictionary):
+    Byte counters and per-stage timings
+
+  '''
+
+  stats = new_engine_stats()
+  wall_start = time.perf_counter()
+  blocks = gzip_block_reader(input_files, stats = stats)
+  if tap is not None:
+    blocks = tap(blocks)
+  parallel_gzip_write(blocks, output_file, threads, level, stats = stats)
+  stats['wall_seconds'] = time.perf_counter() - wall_start
+  return(stats)
+
+
+def throughput_report(stats):
+  '''Formats engine statistics as MB/s for each stage
+
+  Parameters
+  ----------
+  stats (dictionary):
+    Byte counters and per-stage timings
+
+  Returns
+  -------
+  report (string):
+    Human readable throughput summary
+
+  '''
+
+  megabytes = 1048576.0
+
+  def rate(byte_count, seconds):
+    if seconds <= 0:
+      return('n/a')
+    return('{0:.1f} MB/s'.format(byte_count / megabytes / seconds))
+
+  report = ['read {0}'.format(rate(stats['bytes_read'], stats['read_seconds'])),
+            'decompress {0}'.format(rate(stats['bytes_decompressed'], stats['decompress_seconds'])),
+            'compress {0} per thread'.format(rate(stats['bytes_decompressed'], stats['compress_seconds'])),
+            'write {0}'.format(rate(stats['bytes_written'], stats['write_seconds'])),
+            'overall {0} uncompressed in {1:.1f} s'.format(rate(stats['bytes_decompressed'], stats['wall_seconds']), stats['wall_seconds'])]
+  return(', '.join(report))
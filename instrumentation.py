@@ -0,0 +1,154 @@
+import os, time, json, atexit, resource, functools, threading, contextlib
+
+profile = {'spans': None, 'path': None, 'stages': None, 'lock': threading.Lock()}
+
+
+def enable_profile(profile_path):
+  '''Starts recording timed spans; they are written to the profile file when the script exits.
+  A file ending in ".json" is written as a Chrome trace (chrome://tracing or ui.perfetto.dev),
+  anything else as JSON lines with one span per line.
+
+  Parameters
+  ----------
+  profile_path (string / os.path):
+    Location of the profile file
+
+  '''
+
+  if profile['spans'] is None:
+    atexit.register(write_profile)
+  profile['spans'] = []
+  profile['path'] = os.path.abspath(profile_path)
+
+
+def enable_stage_totals():
+  '''Starts adding up the wall time and number of calls of each span name (used by "run_history"),
+  without the cost of a full profile'''
+
+  profile['stages'] = {}
+
+
+def io_counters():
+  '''Reads the bytes read and written (including pipes and sockets) by this process and its finished children from /proc
+
+  Returns
+  -------
+  counters (dictionary):
+    "rchar" and "wchar" byte counts, empty if /proc is not available
+
+  '''
+
+  counters = {}
+  try:
+    with open('/proc/self/io', 'r') as io_file:
+      for line in io_file:
+        key, value = line.split(':')
+        if key in ('rchar', 'wchar'):
+          counters[key] = int(value)
+  except (OSError, ValueError):
+    pass
+
+  return(counters)
+
+
+def resource_snapshot():
+  '''Takes the counters that a span reports as differences between its start and end
+
+  Returns
+  -------
+  snapshot (dictionary):
+    Wall, CPU and I/O counters for this process and its finished child processes
+
+  '''
+
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  snapshot = {'wall': time.perf_counter(), 'cpu': time.process_time(),
+              'child_cpu': children.ru_utime + children.ru_stime,
+              'child_blocks_read': children.ru_inblock, 'child_blocks_written': children.ru_oublock,
+              'child_max_rss_kb': children.ru_maxrss}
+  snapshot.update(io_counters())
+  return(snapshot)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+  '''Times a block of code when profiling or stage totals are enabled, otherwise does nothing.
+  Records wall time, CPU time of this process and of child processes (e.g. zcat, pigz, bowtie2),
+  bytes read and written (Linux counts the I/O of child processes once they have finished,
+  pipes included), block I/O that reached the disk from child processes and the peak RSS of
+  the largest child process finished so far. CPU and I/O are process wide, so spans running
+  at the same time on different threads share them.
+
+  Parameters
+  ----------
+  name (string):
+    Span name, e.g. the function name
+
+  attributes (keyword arguments):
+    Extra details to record with the span (e.g. the sample)
+
+  '''
+
+  if profile['spans'] is None and profile['stages'] is None:
+    yield
+    return
+
+  start_time = time.time()
+  start = resource_snapshot() if profile['spans'] is not None else {'wall': time.perf_counter()}
+  try:
+    yield
+  finally:
+    wall_seconds = time.perf_counter() - start['wall']
+    if profile['stages'] is not None:
+      with profile['lock']:
+        stage = profile['stages'].setdefault(name, {'calls': 0, 'wall_seconds': 0.0})
+        stage['calls'] += 1
+        stage['wall_seconds'] += wall_seconds
+    if profile['spans'] is not None and 'cpu' in start: # Profiling may have been enabled while the span ran
+      end = resource_snapshot()
+      record = {'name': name, 'start': start_time, 'thread': threading.get_ident(),
+                'wall_seconds': round(end['wall'] - start['wall'], 6),
+                'cpu_seconds': round(end['cpu'] - start['cpu'], 6),
+                'child_cpu_seconds': round(end['child_cpu'] - start['child_cpu'], 6),
+                'bytes_read': end.get('rchar', 0) - start.get('rchar', 0),
+                'bytes_written': end.get('wchar', 0) - start.get('wchar', 0),
+                'child_bytes_read': (end['child_blocks_read'] - start['child_blocks_read']) * 512,
+                'child_bytes_written': (end['child_blocks_written'] - start['child_blocks_written']) * 512,
+                'child_peak_rss_kb': end['child_max_rss_kb']}
+      if attributes:
+        record['attributes'] = {key: str(value) for key, value in attributes.items()}
+      with profile['lock']:
+        if profile['spans'] is not None:
+          profile['spans'].append(record)
+
+
+def timed(function):
+  '''Decorator recording a span, named after the function, around every call'''
+
+  @functools.wraps(function)
+  def timed_function(*args, **kwargs):
+    with span(function.__name__):
+      return(function(*args, **kwargs))
+
+  return(timed_function)
+
+
+def write_profile():
+  '''Writes the recorded spans to the profile file, as a Chrome trace or as JSON lines'''
+
+  with profile['lock']:
+    spans = list(profile['spans'] or [])
+  if profile['path'] is None:
+    return
+
+  with open(profile['path'], 'w') as profile_file:
+    if profile['path'].endswith('.json'):
+      events = []
+      for record in spans:
+        arguments = {key: value for key, value in record.items() if key not in ('name', 'start', 'thread', 'wall_seconds')}
+        events.append({'name': record['name'], 'ph': 'X', 'pid': os.getpid(), 'tid': record['thread'],
+                       'ts': int(record['start'] * 1000000), 'dur': int(record['wall_seconds'] * 1000000), 'args': arguments})
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, profile_file)
+    else:
+      for record in spans:
+        profile_file.write(json.dumps(record) + '\n')
@@ -0,0 +1,233 @@
+import os, time, shutil, threading, contextlib
+import rnaseq_util as util
+
+governor = {'slots': None, 'rate': None, 'tokens': 0.0, 'refilled': None, 'idle_priority': False,
+            'ionice': None, 'reserved': {}, 'lock': threading.Lock()}
+
+# Expected bytes written per byte of input. A merged file is recompressed at about the same level
+# as the lanes; an rRNA removal sample holds its .fq.gz outputs and an uncompressed SAM file
+# (every read, aligned or not) on disk until the sample finishes.
+OUTPUT_RATIOS = {'lane_merge': 1.05, 'rrna_removal': 7.0, 'download': 1.0}
+FREE_SPACE_MARGIN = 1073741824 # Left free for other users of the scratch space
+
+
+def configure(max_heavy_writes = None, max_write_rate = None, idle_priority = False):
+  '''Sets the limits shared by every tool in this process. Call before any work starts.
+
+  Parameters
+  ----------
+  max_heavy_writes (int / None):
+    Number of heavy-write tasks (merging a file, depleting a sample, downloading a file) that
+    may run at the same time, None for no limit
+
+  max_write_rate (float / None):
+    Bytes per second written in-process (python merge engine, shards, downloads), None for no limit
+
+  idle_priority (Boolean):
+    Run child processes (zcat, pigz, bowtie2) with idle I/O priority ("ionice -c 3")
+
+  '''
+
+  governor['slots'] = threading.BoundedSemaphore(max_heavy_writes) if max_heavy_writes else None
+  governor['rate'] = float(max_write_rate) if max_write_rate else None
+  governor['tokens'] = governor['rate'] or 0.0
+  governor['refilled'] = time.monotonic()
+  governor['idle_priority'] = idle_priority
+
+  if idle_priority == True:
+    governor['ionice'] = shutil.which('ionice')
+    if governor['ionice'] is None:
+      util.warn('ionice not found, child processes will run with normal I/O priority')
+
+
+def add_arguments(parser):
+  '''Adds the I/O governor flags to a tool's argument parser'''
+
+  parser.add_argument('--max_heavy_writes', type = int, metavar = '<TASKS>',
+                      help = 'Number of heavy-write tasks (merging a file, depleting a sample, downloading a file) allowed at the same time. Default no limit.')
+  parser.add_argument('--max_write_rate', type = float, metavar = '<MB/S>',
+                      help = 'Limit for the MB per second written in-process (python merge engine, shards, downloads). Default no limit.')
+  parser.add_argument('--idle_io', action = 'store_true',
+                      help = 'Run zcat, pigz and bowtie2 with idle I/O priority (ionice -c 3), so other users of the disk go first.')
+
+
+def configure_from_arguments(args):
+  '''Configures the governor from the flags of "add_arguments"'''
+
+  if args.max_heavy_writes is not None and args.max_heavy_writes < 1:
+    util.critical('--max_heavy_writes must be at least 1')
+  max_write_rate = args.max_write_rate * 1048576 if args.max_write_rate else None
+  configure(args.max_heavy_writes, max_write_rate, args.idle_io)
+
+
+def output_estimate(input_files, kind):
+  '''Estimates the bytes a task will write from the size of its inputs
+
+  Parameters
+  ----------
+  input_files (list):
+    Full paths of the task's input files; missing files count as empty
+
+  kind (string):
+    Key of OUTPUT_RATIOS, e.g. "lane_merge"
+
+  Returns
+  -------
+  estimated_bytes (int):
+    Expected size of the task's output
+
+  '''
+
+  input_bytes = sum(os.path.getsize(input_file) for input_file in input_files if os.path.isfile(input_file))
+  return(int(input_bytes * OUTPUT_RATIOS[kind]))
+
+
+def space_check(output_directory, estimated_bytes, description, reserve = False):
+  '''Stops the script before a task starts if its output would not fit on the disk. Space
+  already promised to running tasks (see "heavy_write") counts as used, as does FREE_SPACE_MARGIN.
+
+  Parameters
+  ----------
+  output_directory (string / os.path):
+    Folder the output is written to
+
+  estimated_bytes (int):
+    Expected size of the output, e.g. from "output_estimate"
+
+  description (string):
+    What is about to be written, for the error message
+
+  reserve (Boolean):
+    Hold the space for the task until "release" is called
+
+  Returns
+  -------
+  device (int):
+    Device of the output folder, used as the reservation key
+
+  '''
+
+  device = os.stat(output_directory).st_dev
+  with governor['lock']:
+    free_bytes = shutil.disk_usage(output_directory).free - governor['reserved'].get(device, 0)
+    if estimated_bytes + FREE_SPACE_MARGIN > free_bytes:
+      util.critical('Not enough free space in {0} for {1}: about {2:.1f} GB needed, {3:.1f} GB free'.format(
+                    output_directory, description, (estimated_bytes + FREE_SPACE_MARGIN) / 1073741824.0, max(free_bytes, 0) / 1073741824.0))
+    if reserve == True:
+      governor['reserved'][device] = governor['reserved'].get(device, 0) + estimated_bytes
+
+  return(device)
+
+
+def release(device, estimated_bytes):
+  '''Returns space reserved by "space_check"; by then the output is on disk and counted as used'''
+
+  with governor['lock']:
+    governor['reserved'][device] -= estimated_bytes
+
+
+@contextlib.contextmanager
+def batch_reservation(output_directory, estimated_bytes, description):
+  '''Checks up front that a whole batch of heavy writes fits, and holds the space until each task's
+  "heavy_write" takes over its share, so the batch fails before it starts rather than partway through
+  and no task is counted twice
+
+  Yields
+  ------
+  batch (dictionary):
+    "device" and the "bytes" still held, to pass to "heavy_write"
+
+  '''
+
+  batch = {'device': space_check(output_directory, estimated_bytes, description, reserve = True), 'bytes': estimated_bytes}
+  try:
+    yield batch
+  finally:
+    release(batch['device'], batch['bytes'])
+
+
+@contextlib.contextmanager
+def heavy_write(output_directory, estimated_bytes, description, batch = None):
+  '''Runs a heavy-write task once a slot is free (see "configure") and its output is known to fit.
+  Free space is checked after waiting for the slot, and held for the task until it finishes, so
+  tasks running side by side cannot fill the disk between them and leave truncated outputs.
+
+  Parameters
+  ----------
+  output_directory (string / os.path):
+    Folder the output is written to
+
+  estimated_bytes (int):
+    Expected size of the output, e.g. from "output_estimate"
+
+  description (string):
+    What is about to be written, for log and error messages
+
+  batch (dictionary / None):
+    From "batch_reservation"; the task's share of the batch's space is handed over to the task
+
+  '''
+
+  slots = governor['slots']
+  if slots is not None and not slots.acquire(blocking = False):
+    util.info('Waiting for a free heavy-write slot for {0}'.format(description))
+    slots.acquire()
+  try:
+    if batch is not None:
+      share = min(estimated_bytes, batch['bytes'])
+      release(batch['device'], share)
+      batch['bytes'] -= share
+    device = space_check(output_directory, estimated_bytes, description, reserve = True)
+    try:
+      yield
+    finally:
+      release(device, estimated_bytes)
+  finally:
+    if slots is not None:
+      slots.release()
+
+
+def throttle(size):
+  '''Waits until "size" more bytes may be written under the bytes per second limit. The token bucket is
+  shared by every thread in the process and holds up to one second of writes, so short bursts go through
+  at full speed.
+
+  Parameters
+  ----------
+  size (int):
+    Number of bytes about to be written
+
+  '''
+
+  rate = governor['rate']
+  if rate is None:
+    return
+
+  with governor['lock']:
+    now = time.monotonic()
+    governor['tokens'] = min(rate, governor['tokens'] + (now - governor['refilled']) * rate) - size
+    governor['refilled'] = now
+    wait = -governor['tokens'] / rate
+
+  if wait > 0:
+    time.sleep(wait)
+
+
+def command(command):
+  '''Gives the command line for a child process, run with idle I/O priority when configured
+
+  Parameters
+  ----------
+  command (list):
+    Command and its arguments
+
+  Returns
+  -------
+  command (list):
+    The command, behind "ionice -c 3" if idle priority is on
+
+  '''
+
+  if governor['idle_priority'] == True and governor['ionice'] is not None:
+    return([governor['ionice'], '-c', '3'] + command)
+  return(command)
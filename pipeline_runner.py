@@ -0,0 +1,528 @@
+import os, re, json, argparse
+import rnaseq_util as util
+import instrumentation, io_governor, run_history
+import cruk_downloader, rna_seq_lane_merger, rRNA_remover
+import tpm_standard_deviation_mean_calculator as tpm_calculator
+
+RESOURCES = ['cpu', 'io', 'memory']
+
+
+def new_task(name, action, requires, dependencies = None, inputs = None, outputs = None):
+  '''Creates a task for the pipeline's dependency graph
+
+  Parameters
+  ----------
+  name (string):
+    Unique task name e.g. "merge D701_D501"
+
+  action (function):
+    Called without arguments to run the task
+
+  requires (dictionary):
+    Share of the budget needed while running; keys are "cpu", "io" and "memory" (GB)
+
+  dependencies (list / None):
+    Names of tasks that must finish first
+
+  inputs (function / None):
+    Returns the task's input files, used to decide if the outputs are up to date
+
+  outputs (function / None):
+    Returns the files the task creates
+
+  Returns
+  -------
+  task (dictionary):
+    Task, with its state set to "waiting"
+
+  '''
+
+  task = {'name': name, 'action': action, 'requires': requires, 'dependencies': dependencies or [],
+          'inputs': inputs or (lambda: []), 'outputs': outputs or (lambda: []), 'state': 'waiting'}
+  return(task)
+
+
+def task_marker(task_name, output_files):
+  '''Gives the location of a task's completion marker: a hidden file next to its first output,
+  e.g. "lane_merged/.merge_D701_D501.done"'''
+
+  return(os.path.join(os.path.dirname(output_files[0]), '.{0}.done'.format(re.sub('[^A-Za-z0-9_.-]+', '_', task_name))))
+
+
+def write_task_marker(task_name, output_files):
+  '''Records that a task finished, with the size and modification time of each output it left.
+  Written only after the task's action returns, and atomically, so a task killed partway never has a
+  marker matching its (possibly truncated) outputs.'''
+
+  if len(output_files) == 0:
+    return
+
+  outputs = {}
+  for output_file in output_files:
+    if os.path.exists(output_file):
+      outputs[output_file] = [os.path.getsize(output_file), os.path.getmtime(output_file)]
+
+  marker_file = task_marker(task_name, output_files)
+  with open(marker_file + '.tmp', 'w') as marker:
+    json.dump(outputs, marker, indent = 1)
+  os.replace(marker_file + '.tmp', marker_file)
+
+
+def outputs_up_to_date(input_files, output_files, marker_file):
+  '''Checks if every output file exists, is newer than every input file, and is exactly as its task
+  left it when it last finished (same size and modification time as in the completion marker).
+  Outputs of a run that was killed partway have no matching marker, so they are never trusted.
+
+  Parameters
+  ----------
+  input_files (list):
+    Full paths of the task's inputs
+
+  output_files (list):
+    Full paths of the task's outputs
+
+  marker_file (string / os.path):
+    The task's completion marker, from "task_marker"
+
+  Returns
+  -------
+  Boolean (True/False)
+    Can the task be skipped?
+
+  '''
+
+  if len(output_files) == 0 or not all(os.path.exists(output_file) for output_file in output_files):
+    return(False)
+
+  try:
+    with open(marker_file, 'r') as marker:
+      completed = json.load(marker)
+  except (OSError, ValueError):
+    return(False)
+  for output_file in output_files:
+    if completed.get(output_file) != [os.path.getsize(output_file), os.path.getmtime(output_file)]:
+      return(False)
+
+  existing_inputs = [input_file for input_file in input_files if os.path.exists(input_file)]
+  if len(existing_inputs) == 0:
+    return(True)
+
+  newest_input = max(os.path.getmtime(input_file) for input_file in existing_inputs)
+  oldest_output = min(os.path.getmtime(output_file) for output_file in output_files)
+  return(oldest_output >= newest_input)
+
+
+def merge_plan(settings, index):
+  '''Finds the lane files of one sample and the merged files they will produce
+
+  Parameters
+  ----------
+  settings (dictionary):
+    Run settings built in "__main__"
+
+  index (string):
+    Sample index from the submission form
+
+  Returns
+  -------
+  files_to_merge (dictionary):
+    Output of "rna_seq_lane_merger.lane_merger_preparation"
+
+  merged_files (list):
+    Full paths of the merged files, empty if any read is missing its lane files
+
+  '''
+
+  indexed_files = rna_seq_lane_merger.globber(settings['working_directory'], [index])
+  files_to_merge = rna_seq_lane_merger.lane_merger_preparation(indexed_files, settings['paired_single'], settings['paired_tags'])
+
+  if any(len(input_files) == 0 for input_files in files_to_merge.values()):
+    return(files_to_merge, [])
+
+  merged_files = [rna_seq_lane_merger.merged_filename(files_to_merge[index_files], settings['lane_tags'], settings['merged_directory'])
+                  for index_files in files_to_merge]
+  return(files_to_merge, merged_files)
+
+
+def merge_task(settings, index, dependencies):
+  '''Creates the lane merger task for one sample'''
+
+  plan = {} # Found once the task is ready to start, so the files are only globbed once
+
+  def planned():
+    if len(plan) == 0:
+      plan['files_to_merge'], plan['merged_files'] = merge_plan(settings, index)
+    return(plan['files_to_merge'], plan['merged_files'])
+
+  def inputs():
+    files_to_merge, merged_files = planned()
+    return([input_file for input_files in files_to_merge.values() for input_file in input_files])
+
+  def outputs():
+    files_to_merge, merged_files = planned()
+    return(merged_files)
+
+  def action():
+    files_to_merge, merged_files = planned()
+    if len(merged_files) == 0:
+      util.critical('No lane files found for index {0}'.format(index))
+    rna_seq_lane_merger.lane_merger(settings['working_directory'], files_to_merge, settings['lane_tags'],
+                                    settings['engine'], settings['threads'])
+
+  cpus = settings['threads'] or 2 # zcat | pigz uses about two cores at the pigz default
+  return(new_task('merge {0}'.format(index), action, {'cpu': cpus, 'io': 1, 'memory': 0.5}, dependencies, inputs, outputs))
+
+
+def rrna_plan(settings, index):
+  '''Finds the merged files of one sample and the rRNA removal outputs they will produce
+
+  Parameters
+  ----------
+  settings (dictionary):
+    Run settings built in "__main__"
+
+  index (string):
+    Sample index from the submission form
+
+  Returns
+  -------
+  sample_reads (dictionary):
+    Output of "rRNA_remover.paired_reads_finder", with full paths
+
+  output_files (list):
+    Full paths of the log and rRNA depleted files
+
+  '''
+
+  files_to_merge, merged_files = merge_plan(settings, index)
+  merged_file_names = [os.path.basename(merged_file) for merged_file in merged_files]
+  sample_reads = rRNA_remover.paired_reads_finder(merged_file_names, settings['paired_single'], settings['paired_tags'])
+  sample_reads = rRNA_remover.absolute_sample_reads(sample_reads, settings['merged_directory'], settings['paired_single'])
+
+  output_files = []
+  for entries in sample_reads:
+    output_files.append(os.path.join(settings['rRNA_directory'], 'log_files', 'logs_{0}.txt'.format(entries)))
+    output_files += rRNA_remover.rrna_output_files(settings['rRNA_directory'], entries, settings['paired_single'])
+
+  return(sample_reads, output_files)
+
+
+def rrna_task(settings, index):
+  '''Creates the rRNA removal task for one sample, run after the sample's lane merger'''
+
+  plan = {}
+
+  def planned():
+    if len(plan) == 0:
+      plan['sample_reads'], plan['output_files'] = rrna_plan(settings, index)
+    return(plan['sample_reads'], plan['output_files'])
+
+  def inputs():
+    sample_reads = planned()[0]
+    if settings['paired_single'] == 'paired':
+      return([sample_reads[entries][pair_number] for entries in sample_reads for pair_number in sample_reads[entries]])
+    return(list(sample_reads.values()))
+
+  def outputs():
+    return(planned()[1])
+
+  def action():
+    sample_reads, output_files = planned()
+    rRNA_remover.rrna_removal(settings['rRNA_library'], sample_reads, settings['rRNA_directory'],
+                              settings['paired_single'], settings['rRNA_threads'])
+
+  requires = {'cpu': settings['rRNA_threads'], 'io': 1, 'memory': 0.25} # bowtie2 --mm shares the index pages between jobs
+  return(new_task('rRNA {0}'.format(index), action, requires, ['merge {0}'.format(index)], inputs, outputs))
+
+
+def download_task(settings, ftp_username, ftp_password):
+  '''Creates the task that downloads and MD5 checks the SLX, then writes samples.csv.
+  With --samples the task always runs, as samples.csv does not show which samples were downloaded;
+  files already downloaded are not fetched again.'''
+
+  samples_csv = os.path.join(settings['working_directory'], 'samples.csv')
+
+  def action():
+    samples_information, slx_id = cruk_downloader.glob_lister(settings['submission_form'])
+    ftp_server = cruk_downloader.ftp_server_connection(ftp_username, ftp_password)
+    server_files, selected_files = cruk_downloader.ftp_file_selection(settings['working_directory'], ftp_server, slx_id, samples_information,
+                                                                      settings['samples'], settings['cache_directory'])
+
+    retries = 0
+    md5_check = False
+    download_times = {}
+    while md5_check == False:
+      if retries >= 3:
+        util.critical('{0} retries at downloading files have failed. Please try again later'.format(retries))
+      downloaded_files = cruk_downloader.ftp_download_files(settings['working_directory'], ftp_server, slx_id, selected_files, server_files,
+                                                            download_times)
+      md5_check = cruk_downloader.file_md5_check(downloaded_files)
+      retries += 1
+    ftp_server.quit()
+    cruk_downloader.record_downloads(samples_information, download_times)
+
+    cruk_downloader.samples_csv_writer(settings['working_directory'], slx_id, samples_information)
+
+  outputs = (lambda: []) if settings['samples'] is not None else (lambda: [samples_csv]) # No outputs, never up to date
+  return(new_task('download', action, {'cpu': 1, 'io': 1, 'memory': 0.5}, [],
+                  lambda: [settings['submission_form']], outputs))
+
+
+def tpm_task(settings):
+  '''Creates the TPM mean and standard deviation task'''
+
+  tpm_directory, tpm_file_name = tpm_calculator.working_directory_finder(settings['tpm_file'])
+  samples_csv = os.path.join(tpm_directory, tpm_file_name.replace('_tpm.txt', ''))
+
+  def action(): # Incremental, so only conditions whose samples or values changed are rewritten
+    read_tpm = tpm_calculator.read_in_tpm(settings['tpm_file'])
+    gene_ids = tpm_calculator.gene_name_converter()
+    sample_conditions = tpm_calculator.samples_file_conditions_finder(tpm_directory, tpm_file_name)
+    tpm_calculator.output_file_creator(tpm_directory, read_tpm, sample_conditions, gene_ids, incremental = True)
+
+  return(new_task('TPM statistics', action, {'cpu': 1, 'io': 1, 'memory': 2}, [],
+                  lambda: [settings['tpm_file'], samples_csv], lambda: [os.path.join(tpm_directory, tpm_calculator.TPM_CACHE_FILE)]))
+
+
+def fits_budget(requires, available):
+  '''Checks if a task's requirements fit within the resources still available'''
+
+  return(all(requires.get(resource, 0) <= available[resource] for resource in RESOURCES))
+
+
+@instrumentation.timed
+def run_tasks(tasks, budget, dry_run = False):
+  '''Runs the task graph. Tasks start as soon as their dependencies have finished and their
+  requirements fit within what is left of the global budget, so independent samples run
+  concurrently. Tasks that finished before, whose outputs are unchanged since and newer than their
+  inputs, are skipped (see "outputs_up_to_date").
+
+  Parameters
+  ----------
+  tasks (dictionary):
+    Keys are task names and values are tasks from "new_task", in priority order
+
+  budget (dictionary):
+    Total "cpu", "io" and "memory" (GB) the pipeline may use at once
+
+  dry_run (Boolean):
+    Only report which tasks would run
+
+  Returns
+  -------
+  tasks (dictionary):
+    The same tasks with their final state; "done", "up_to_date" or "failed"
+
+  '''
+
+  import concurrent.futures
+
+  available = dict(budget)
+  running = {}
+
+  def run_action(task):
+    with instrumentation.span('task', task = task['name']):
+      task['action']()
+    write_task_marker(task['name'], task['outputs']())
+
+  def schedule():
+    changed = False
+    for task in tasks.values():
+      if task['state'] != 'waiting':
+        continue
+
+      dependency_states = [tasks[dependency]['state'] for dependency in task['dependencies']]
+      if 'failed' in dependency_states:
+        util.warn('Not running {0}, a task it depends on failed'.format(task['name']))
+        task['state'] = 'failed'
+        changed = True
+        continue
+      if not all(state in ('done', 'up_to_date') for state in dependency_states):
+        continue
+
+      requires = {resource: min(task['requires'].get(resource, 0), budget[resource]) for resource in RESOURCES} # A task larger than the budget runs alone
+      if not fits_budget(requires, available):
+        continue
+
+      try:
+        output_files = task['outputs']()
+        up_to_date = len(output_files) > 0 and outputs_up_to_date(task['inputs'](), output_files, task_marker(task['name'], output_files))
+      except Exception as error:
+        util.warn('Unable to check outputs of {0}: {1}'.format(task['name'], error))
+        up_to_date = False
+
+      changed = True
+      if up_to_date:
+        util.info('Outputs of {0} are up to date, skipping'.format(task['name']))
+        task['state'] = 'up_to_date'
+      elif dry_run:
+        util.info('Would run {0}'.format(task['name']))
+        task['state'] = 'done'
+      else:
+        util.info('Starting {0}'.format(task['name']))
+        for resource in RESOURCES:
+          available[resource] -= requires[resource]
+        task['reserved'] = requires
+        task['state'] = 'running'
+        running[executor.submit(run_action, task)] = task
+    return(changed)
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers = max(len(tasks), 1)) as executor:
+    while True:
+      if schedule():
+        continue
+      if len(running) == 0:
+        break
+
+      finished, still_running = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+      for future in finished:
+        task = running.pop(future)
+        for resource in RESOURCES:
+          available[resource] += task['reserved'][resource]
+        try:
+          future.result()
+        except BaseException as error: # util.critical exits, which must only fail this task
+          util.warn('{0} failed: {1}'.format(task['name'], error))
+          task['state'] = 'failed'
+        else:
+          util.info('Finished {0}'.format(task['name']))
+          task['state'] = 'done'
+
+  return(tasks)
+
+
+def default_budget():
+  '''Gives the whole node as the default budget: every CPU, two concurrent heavy I/O tasks and all memory
+
+  Returns
+  -------
+  budget (dictionary):
+    Total "cpu", "io" and "memory" (GB)
+
+  '''
+
+  memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1073741824.0
+  return({'cpu': os.cpu_count(), 'io': 2, 'memory': memory})
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description = 'Run download, lane merger, rRNA removal and TPM statistics as one pipeline')
+  parser.add_argument('-f', '--submission_form',
+                      type = str,
+                      required = True,
+                      metavar = 'FILENAME',
+                      help = 'Path to the submission form (e.g. CRUKCI_SLX_Submission.xlsx) - Please ensure this file is in same folder as the RNA-Seq files.')
+
+  parser.add_argument('-l', '--lane_tags',
+                      type = str,
+                      required = True,
+                      nargs = '+',
+                      metavar = 'lane_tag',
+                      help = 'Tags that identify samples\' RNA-Seq lanes e.g. "s_1 s_2".')
+
+  group = parser.add_mutually_exclusive_group(required = True) # Sets --single_end and --paired_end as mutually exclusive arguments
+  group.add_argument('-s', '--single_end', action = 'store_true',
+                     help = 'Flag if RNA-Seq data are single end reads. Mutually exclusive with the -p/--paired_end argument.')
+  group.add_argument('-p', '--paired_end', nargs = 2, metavar = '<PAIR_TAG>',
+                     help = 'Flag if RNA-Seq data are paired end reads. Mutually exclusive with the -s/--single_end argument. Provide pair tags, this will be the same as PRAGUI\'s "pair_tags" argument.')
+
+  parser.add_argument('--download', action = 'store_true',
+                      help = 'Download the SLX from the CRUK FTP server before merging.')
+  parser.add_argument('--samples', type = str, nargs = '*', metavar = '<SAMPLE>',
+                      help = 'Only merge (and with --rRNA_library, rRNA remove) these samples (names or indexes); with --download, only download them and the .md5sums.txt files. Without any samples listed, only the submission form\'s samples are downloaded.')
+  parser.add_argument('--cache_directory', type = str, metavar = '<DIRECTORY>',
+                      help = 'With --download, hard-link files already held in this folder of earlier deliveries instead of downloading them.')
+  parser.add_argument('-r', '--rRNA_library', type = str, metavar = '<FILE>',
+                      help = 'Path to the rRNA genome library (.fa file). If provided, rRNA reads are removed from each merged sample.')
+  parser.add_argument('-t', '--tpm_file', type = str, metavar = 'FILENAME',
+                      help = 'Full path for the tpm.txt file. If provided, TPM means and standard deviations are calculated.')
+  parser.add_argument('-e', '--engine', type = str, default = 'shell', choices = ['shell', 'python'],
+                      help = 'Lane merger engine: "shell" pipes zcat into pigz, "python" merges in-process with zlib (default shell).')
+  parser.add_argument('--merge_threads', type = int, metavar = '<THREADS>',
+                      help = 'Compression threads per lane merger task. Defaults to the engine\'s default.')
+  parser.add_argument('--rRNA_threads', type = int, default = 1, metavar = '<THREADS>',
+                      help = 'bowtie2 alignment threads per rRNA removal task (default 1).')
+
+  budget = default_budget()
+  parser.add_argument('--cpus', type = int, default = budget['cpu'], metavar = '<CPUS>',
+                      help = 'CPU budget shared by all running tasks (default: all CPUs).')
+  parser.add_argument('--io', type = int, default = budget['io'], metavar = '<TASKS>',
+                      help = 'Maximum number of disk heavy tasks running at once (default 2).')
+  parser.add_argument('--memory', type = float, default = budget['memory'], metavar = '<GB>',
+                      help = 'Memory budget in GB shared by all running tasks (default: all memory).')
+  parser.add_argument('--dry_run', action = 'store_true',
+                      help = 'Only report which tasks would run.')
+  io_governor.add_arguments(parser)
+  run_history.add_arguments(parser)
+
+  parser.add_argument('--profile', type = str, metavar = '<FILE>',
+                      help = 'Record wall time, CPU time, bytes read/written and child process peak memory for each step. Written as a Chrome trace if FILE ends in .json, otherwise as JSON lines.')
+
+  args = parser.parse_args()
+  if args.profile is not None:
+    instrumentation.enable_profile(args.profile)
+  io_governor.configure_from_arguments(args)
+  if not args.dry_run:
+    run_history.start_run('pipeline_runner', args)
+  if args.single_end == True:
+    paired_single = 'single'
+    paired_tags = None
+  else:
+    paired_single = 'paired'
+    paired_tags = args.paired_end
+
+  ftp_username = None
+  ftp_password = None
+  if args.download and not args.dry_run:
+    ftp_username = input('Enter FTP server\'s username: ')
+    ftp_password = input('Enter FTP server\'s password: ')
+
+  submission_form = os.path.abspath(args.submission_form)
+  working_directory = cruk_downloader.check_directory(os.path.split(submission_form)[0], 'submission_form')
+
+  subfolder_check, merged_directory = rna_seq_lane_merger.lane_merged_subfolder(working_directory)
+  settings = {'submission_form': submission_form, 'working_directory': working_directory, 'merged_directory': merged_directory,
+              'lane_tags': args.lane_tags, 'paired_single': paired_single, 'paired_tags': paired_tags,
+              'engine': args.engine, 'threads': args.merge_threads, 'rRNA_threads': args.rRNA_threads,
+              'rRNA_library': None, 'rRNA_directory': None, 'tpm_file': None, 'samples': args.samples, 'cache_directory': None}
+  if args.cache_directory is not None:
+    settings['cache_directory'] = cruk_downloader.check_directory(args.cache_directory, 'cache_directory')
+
+  tasks = {}
+  if args.download:
+    task = download_task(settings, ftp_username, ftp_password)
+    tasks[task['name']] = task
+
+  if args.rRNA_library is not None:
+    settings['rRNA_library'] = rRNA_remover.check_rRNA_library(os.path.abspath(args.rRNA_library))
+    settings['rRNA_directory'] = rRNA_remover.output_preperation(merged_directory)
+
+  if args.samples:
+    samples_information, slx_id = cruk_downloader.glob_lister(submission_form)
+    indexes = cruk_downloader.selected_indexes(samples_information, args.samples)
+  else:
+    indexes = rna_seq_lane_merger.glob_lister(submission_form)
+
+  for index in indexes: # Each sample's rRNA removal follows its merge, so samples finish early
+    task = merge_task(settings, index, ['download'] if args.download else [])
+    tasks[task['name']] = task
+    if args.rRNA_library is not None:
+      task = rrna_task(settings, index)
+      tasks[task['name']] = task
+
+  if args.tpm_file is not None:
+    settings['tpm_file'] = tpm_calculator.check_file(os.path.abspath(args.tpm_file))
+    task = tpm_task(settings)
+    tasks[task['name']] = task
+
+  budget = {'cpu': args.cpus, 'io': args.io, 'memory': args.memory}
+  util.info('Running {0} tasks within a budget of {1} CPUs, {2} I/O tasks and {3:.1f} GB memory'.format(
+            len(tasks), budget['cpu'], budget['io'], budget['memory']))
+  run_tasks(tasks, budget, args.dry_run)
+
+  failed = [task['name'] for task in tasks.values() if task['state'] == 'failed']
+  run_history.finish_run('failed' if len(failed) > 0 else 'complete')
+  if len(failed) > 0:
+    util.critical('{0} tasks failed:\n{1}'.format(len(failed), '\n'.join(failed)))
+  util.info('Pipeline complete')
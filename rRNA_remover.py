@@ -1,10 +1,6 @@
-import os, argparse, sys
-
-module_path = os.path.realpath(__file__)
-utilities_directory = os.path.dirname(module_path)
-sys.path.append(utilities_directory)
-
-from cell_bio_util import cell_bio_util as util
+import os, re, glob, time, argparse, hashlib, fcntl
+import rnaseq_util as util
+import instrumentation, io_governor, run_history
 
 
 def check_directory(directory, check_type):
@@ -33,50 +29,163 @@ def check_directory(directory, check_type):
     util.critical('Invalid --{0} location. Please ensure directory exists before proceeding:\n\t{1}'.format(check_type, directory))
 
 
-def check_rRNA_library(rRNA_genome_path):
-  '''Checks to see if a passed rRNA library exits
+BOWTIE2_INDEX_SUFFIXES = ['.1', '.2', '.3', '.4', '.rev.1', '.rev.2']
+
+
+def bowtie2_index_files(index_prefix):
+  '''Finds the complete set of bowtie2 index files for an index prefix
+  
+  Parameters
+  ----------
+  index_prefix (string / os.path):
+    bowtie2 index prefix (the -x argument)
+  
+  Returns
+  -------
+  index_files (list):
+    Full paths of all six index files (small .bt2 or large .bt2l index), or an empty list if the set is incomplete
+  
+  '''
+
+  for extension in ['.bt2', '.bt2l']:
+    index_files = ['{0}{1}{2}'.format(index_prefix, suffix, extension) for suffix in BOWTIE2_INDEX_SUFFIXES]
+    if all(os.path.isfile(index_file) for index_file in index_files):
+      return(index_files)
+
+  return([])
+
+
+def rRNA_library_md5(rRNA_genome_path):
+  '''Computes the MD5 checksum of the rRNA library (.fa file)'''
+
+  file_hashing = hashlib.md5()
+  with open(rRNA_genome_path, 'rb') as library_file:
+    for chunks in iter(lambda: library_file.read(1048576), b""):
+      file_hashing.update(chunks)
+
+  return(file_hashing.hexdigest())
+
+
+def bowtie2_index_current(rRNA_genome_path, index_prefix, library_md5):
+  '''Checks that a complete bowtie2 index exists and was built from the current rRNA library.
+  The checksum of the .fa file used to build the index is kept next to it in "<index_prefix>.bt2.md5",
+  written after the index files. The checksum is only trusted if no index file is newer than it, as an
+  index rebuilt by hand or partly rewritten since would not match it. An index without a checksum file
+  (e.g. built by hand) is accepted if it is newer than the .fa file, and its checksum file is written.
   
   Parameters
   ----------
   rRNA_genome_path (string / os.path):
-    Filepath to be checked
+    Path to the rRNA library (.fa file)
+  
+  index_prefix (string / os.path):
+    bowtie2 index prefix
+  
+  library_md5 (string):
+    MD5 checksum of the .fa file
   
   Returns
   -------
-  Directory (string / os.path):
-    Path returned if valid or error if invalid - terminating this script
+  Boolean (True/False)
+    Can the index be used as it is?
   
   '''
 
-  directory_library = os.path.split(rRNA_genome_path)
+  index_files = bowtie2_index_files(index_prefix)
+  if len(index_files) == 0:
+    return(False)
 
-  directory_checked = check_directory(directory_library[0], 'rRNA_library')
-  if not os.path.isfile(rRNA_genome_path):
-    util.critical('Unable to locate rRNA library (.fa file) with specified rRNA_library path')
+  checksum_file = '{0}.bt2.md5'.format(index_prefix)
+  if os.path.isfile(checksum_file):
+    if max(os.path.getmtime(index_file) for index_file in index_files) > os.path.getmtime(checksum_file):
+      return(False)
+    with open(checksum_file, 'r') as checksum_read:
+      return(checksum_read.read().strip() == library_md5)
 
-  list_files = os.listdir(directory_checked)
-  list_checked_list = []
+  if min(os.path.getmtime(index_file) for index_file in index_files) < os.path.getmtime(rRNA_genome_path):
+    return(False)
 
-  for_bowtie2_path = os.path.splitext(rRNA_genome_path)
-  bowtie_file_reference = os.path.split(for_bowtie2_path[0])
+  try:
+    with open(checksum_file, 'w') as checksum_write:
+      checksum_write.write(library_md5)
+  except OSError:
+    pass # Read-only library directory, the index is still usable
 
-  for files in list_files:
+  return(True)
 
-    if files.startswith(bowtie_file_reference[1]) and files.endswith('.bt2'):
-      list_checked_list.append(True)
-    else:
-      list_checked_list.append(False)
 
-  list_checked = set(list_checked_list)
-  if True in list_checked:
-    util.info('rRNA library path appears valid')
-    return(rRNA_genome_path)
-  else:
-    util.critical('Unable to locate rRNA library (bt2 files) within specified rRNA_library path: {0}'.format(directory_library[0]))
+@instrumentation.timed
+def check_rRNA_library(rRNA_genome_path, threads = 1):
+  '''Checks to see if a passed rRNA library exits and has a complete, up to date bowtie2 index.
+  The index is built with bowtie2-build if it is missing or was built from a different .fa file.
+  A lock file stops concurrent jobs from building the same index at the same time. The index is built
+  under a temporary prefix and then renamed into place, so jobs that already have the old index
+  memory-mapped (bowtie2 --mm) keep reading it unchanged; the checksum file is written last.
+  
+  Parameters
+  ----------
+  rRNA_genome_path (string / os.path):
+    Filepath to be checked
+  
+  threads (int):
+    Number of bowtie2-build threads, if the index needs building
+  
+  Returns
+  -------
+  index_prefix (string / os.path):
+    bowtie2 index prefix (-x argument) if valid or error if invalid - terminating this script
+  
+  '''
 
-  return()
+  directory_library = os.path.split(rRNA_genome_path)
 
+  directory_checked = check_directory(directory_library[0], 'rRNA_library')
+  if not os.path.isfile(rRNA_genome_path):
+    util.critical('Unable to locate rRNA library (.fa file) with specified rRNA_library path')
 
+  library_md5 = rRNA_library_md5(rRNA_genome_path)
+  index_prefix = os.path.splitext(rRNA_genome_path)[0]
+
+  for candidate_prefix in [index_prefix, rRNA_genome_path]: # Indexes are sometimes named after the full .fa file name
+    if bowtie2_index_current(rRNA_genome_path, candidate_prefix, library_md5):
+      util.info('rRNA library bowtie2 index is complete and up to date: {0}'.format(candidate_prefix))
+      return(candidate_prefix)
+
+  try:
+    lock_file = open('{0}.bt2.lock'.format(index_prefix), 'w')
+  except OSError:
+    util.critical('bowtie2 index for {0} is missing or out of date and cannot be built in {1}'.format(rRNA_genome_path, directory_checked))
+
+  with lock_file:
+    fcntl.flock(lock_file, fcntl.LOCK_EX) # Waits while another job builds the index
+    if not bowtie2_index_current(rRNA_genome_path, index_prefix, library_md5):
+      util.info('Building bowtie2 index for {0}'.format(rRNA_genome_path))
+      building_prefix = '{0}.building_{1}'.format(index_prefix, os.getpid())
+      build_status = util.call(io_governor.command(['bowtie2-build', '--threads', str(threads), rRNA_genome_path, building_prefix]))
+      built_files = bowtie2_index_files(building_prefix)
+      if build_status != 0 or len(built_files) == 0:
+        for built_file in glob.glob('{0}.*'.format(building_prefix)):
+          os.remove(built_file)
+        util.critical('bowtie2-build failed for rRNA library: {0}'.format(rRNA_genome_path))
+
+      for built_file in built_files: # Renaming leaves the old files intact for jobs that have them open
+        os.replace(built_file, index_prefix + built_file[len(building_prefix):])
+      extension = os.path.splitext(built_files[0])[1]
+      for stale_file in bowtie2_index_files(index_prefix): # An older index with the other extension would be found first
+        if not stale_file.endswith(extension):
+          os.remove(stale_file)
+
+      checksum_file = '{0}.bt2.md5'.format(index_prefix)
+      with open(checksum_file + '.tmp', 'w') as checksum_write:
+        checksum_write.write(library_md5)
+      os.replace(checksum_file + '.tmp', checksum_file)
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+  util.info('rRNA library bowtie2 index is complete and up to date: {0}'.format(index_prefix))
+  return(index_prefix)
+
+
+@instrumentation.timed
 def gzip_file_list(working_directory):
   '''Gets list of all .fq.gz files in the working directory (except .lostreads.fq.gz files)
   
@@ -152,6 +261,38 @@ def paired_reads_finder(fastq_gz_files, paired_single, paired_tags):
   return(sample_reads)
 
 
+def absolute_sample_reads(sample_reads, directory, paired_single):
+  '''Turns the file names found by "paired_reads_finder" into full paths, so bowtie2
+  does not need to be run from within the data directory.
+  
+  Parameters
+  ----------
+  sample_reads (dictionary):
+    Output of "paired_reads_finder"
+  
+  directory (string / os.path):
+    Location of the files
+  
+  paired_single (string):
+    Either "paired" or "single"
+  
+  Returns
+  -------
+  sample_reads (dictionary):
+    Same as the input, with full paths as values
+  
+  '''
+
+  for entries in sample_reads:
+    if paired_single == 'paired':
+      for pair_number in sample_reads[entries]:
+        sample_reads[entries][pair_number] = os.path.join(directory, sample_reads[entries][pair_number])
+    else:
+      sample_reads[entries] = os.path.join(directory, sample_reads[entries])
+
+  return(sample_reads)
+
+
 def output_preperation(working_directory):
   '''Creates folders for the output and log files
   
@@ -181,7 +322,105 @@ def output_preperation(working_directory):
   return(output_subdirectory)
 
 
-def rrna_removal(rRNA_library, sample_reads, output_subdirectory, paired_single):
+def bowtie2_read_count(log_file):
+  '''Reads the number of reads (or pairs) bowtie2 processed from the summary it writes at the end of a sample's log
+
+  Returns
+  -------
+  reads (int / None):
+    None if the log has no bowtie2 summary
+
+  '''
+
+  with open(log_file, 'r') as log:
+    summary = re.search(r'^(\d+) reads; of these:', log.read(), re.MULTILINE)
+  return(int(summary.group(1)) if summary else None)
+
+
+def rrna_output_files(output_subdirectory, entries, paired_single):
+  '''Gives the rRNA depleted files bowtie2 writes for a sample; single end reads are written as mate 1
+
+  Returns
+  -------
+  output_files (list):
+    Full paths of the .fq.gz files, two for paired end or one for single end reads
+
+  '''
+
+  mates = ['1', '2'] if paired_single == 'paired' else ['1']
+  return([os.path.join(output_subdirectory, '{0}_rRNA_processed_r_{1}.fq.gz'.format(entries, mate)) for mate in mates])
+
+
+@instrumentation.timed
+def rrna_removal_sample(rRNA_library, entries, reads, output_subdirectory, paired_single, threads = 1):
+  '''Runs the bowtie2 command on one sample's reads to remove rRNA data.
+  bowtie2 is run with --mm so the index is memory-mapped: concurrent jobs on a node share
+  one copy of the index pages instead of each loading their own. The sample only starts
+  once "io_governor" has a heavy-write slot and room on disk for its outputs and SAM file.
+  
+  Parameters
+  ----------
+  rRNA_library (string / os.path):
+    bowtie2 index prefix from "check_rRNA_library"
+  
+  entries (string):
+    Filename prefix of the sample
+  
+  reads (dictionary / string):
+    The paired read files ("1" and "2" keys) or the single end read file
+  
+  output_subdirectory (string / os.path):
+    Path to the output files sub-folder 
+  
+  threads (int):
+    Number of bowtie2 alignment threads
+  
+  Returns
+  -------
+  output_files (list):
+    Full paths of the rRNA depleted .fq.gz files written
+    
+  '''
+
+  if paired_single == 'paired':
+    subcommand = ['-1', reads['1'], '-2', reads['2'], '-X', '1000', '--dovetail', '--un-conc-gz',
+                  os.path.join(output_subdirectory, '{0}_rRNA_processed_r_%.fq.gz'.format(entries))]
+  elif paired_single == 'single':
+    subcommand = ['-U', reads, '--un-gz', rrna_output_files(output_subdirectory, entries, paired_single)[0]] # --un-conc-gz only applies to pairs
+
+  command = ['bowtie2', '--mm', '--phred33', '-D', '20', '-R', '3', '-N', '1', '-L', '20',
+             '-i', 'S,1,0.50', '-x', rRNA_library, '-S', os.path.join(output_subdirectory,
+             'ribo_aligns_{0}.sam'.format(entries)), '--np', '0'] + subcommand
+
+  if threads > 1:
+    command += ['-p', str(threads)]
+
+  command = io_governor.command(command)
+  util_message = ' '.join(command)
+  util.info(util_message)
+
+  read_files = [reads['1'], reads['2']] if paired_single == 'paired' else [reads]
+  estimated_bytes = io_governor.output_estimate(read_files, 'rrna_removal')
+  log_file = os.path.join(os.sep, output_subdirectory, 'log_files', 'logs_{0}.txt'.format(entries))
+  with io_governor.heavy_write(output_subdirectory, estimated_bytes, 'rRNA removal of {0}'.format(entries)), \
+       open(log_file, 'w') as stdout_file:
+    stdout_file.write('\n\nSample read file prefix: {0}'.format(entries))
+    stdout_file.flush() # bowtie2 appends to the same file
+    start = time.perf_counter()
+    util.call(command, stdout = stdout_file, stderr = stdout_file)
+    seconds = time.perf_counter() - start
+
+  os.remove(os.path.join(output_subdirectory, 'ribo_aligns_{0}.sam'.format(entries))) # Need to delete these .sam files otherwise accumulation of many large files
+
+  output_files = rrna_output_files(output_subdirectory, entries, paired_single)
+  run_history.record_sample(entries, 'rrna_removal', seconds, sum(os.path.getsize(read_file) for read_file in read_files),
+                            sum(os.path.getsize(output_file) for output_file in output_files if os.path.isfile(output_file)),
+                            bowtie2_read_count(log_file), 'bowtie2', threads)
+  return([output_file for output_file in output_files if os.path.isfile(output_file)])
+
+
+@instrumentation.timed
+def rrna_removal(rRNA_library, sample_reads, output_subdirectory, paired_single, threads = 1, jobs = 1):
   '''Runs the bowtie2 commands on the reads to remove rRNA data.
   Currently only tested on paired data, needs to be for single end data.
   
@@ -192,36 +431,41 @@ def rrna_removal(rRNA_library, sample_reads, output_subdirectory, paired_single)
 
   output_subdirectory (string / os.path):
     Path to the output files sub-folder 
+  
+  threads (int):
+    Number of bowtie2 alignment threads per sample
+  
+  jobs (int):
+    Number of samples processed at the same time
+  
+  Returns
+  -------
+  output_files (list):
+    Full paths of the rRNA depleted .fq.gz files written by this run
     
   '''
 
-  read_index_number = 0
-  for entries in sample_reads:
-    read_index_number += 1
-    util.info('Processing pair number {0} of {1}: {2}'.format(read_index_number, len(sample_reads), entries))
-
-    if os.path.exists(os.path.join(output_subdirectory, 'logs_{0}.txt'.format(entries))):
-      util.warning('{0} already processed, skipping'.format(entries))
-      continue
+  import concurrent.futures
 
-    if paired_single == 'paired':
-      subcommand = ['-1', sample_reads[entries]['1'], '-2', sample_reads[entries]['2'], '-X', '1000', '--dovetail']
-    elif paired_single == 'single':
-      subcommand = ['-U', sample_reads[entries]]
+  with concurrent.futures.ThreadPoolExecutor(max_workers = jobs) as executor:
+    processing = []
+    read_index_number = 0
+    for entries in sample_reads:
+      read_index_number += 1
+      util.info('Processing pair number {0} of {1}: {2}'.format(read_index_number, len(sample_reads), entries))
 
-    command = ['bowtie2', '--phred33', '-D', '20', '-R', '3', '-N', '1', '-L', '20',
-               '-i', 'S,1,0.50', '-x', rRNA_library, '-S', os.path.join(output_subdirectory,
-               'ribo_aligns_{0}.sam'.format(entries)), '--un-conc-gz', os.path.join(output_subdirectory,
-               '{0}_rRNA_processed_r_%.fq.gz'.format(entries)), '--np', '0'] + subcommand
+      if os.path.exists(os.path.join(output_subdirectory, 'logs_{0}.txt'.format(entries))):
+        util.warning('{0} already processed, skipping'.format(entries))
+        continue
 
-    util_message = ' '.join(command)
-    util.info(util_message)
+      processing.append(executor.submit(rrna_removal_sample, rRNA_library, entries, sample_reads[entries],
+                                        output_subdirectory, paired_single, threads))
 
-    with open(os.path.join(os.sep, output_subdirectory, 'log_files', 'logs_{0}.txt'.format(entries)), 'w') as stdout_file:
-      stdout_file.write('\n\nSample read file prefix: {0}'.format(entries))
-      util.call(command, stdout = stdout_file, stderr = stdout_file)
+    output_files = []
+    for sample in processing:
+      output_files += sample.result()
 
-    os.remove(os.path.join(output_subdirectory, 'ribo_aligns_{0}.sam'.format(entries))) # Need to delete these .sam files otherwise accumulation of many large files
+  return(output_files)
 
 
 if __name__ == '__main__':
@@ -235,7 +479,22 @@ if __name__ == '__main__':
   group.add_argument('-p', '--paired_end', nargs = 2, metavar = '<PAIR_TAG>',
                      help = 'Flag if RNA-Seq data are paired end reads. Mutually exclusive with the -s/--single_end argument. Provide pair tags, this will be the same as PRAGUI\'s "pair_tags" argument.')
 
+  parser.add_argument('-t', '--threads', help = 'Number of bowtie2 alignment threads per sample (default 1)', type = int, default = 1, metavar = '<THREADS>')
+  parser.add_argument('-j', '--jobs', help = 'Number of samples processed at the same time. The bowtie2 index is shared between them (default 1)', type = int, default = 1, metavar = '<JOBS>')
+  parser.add_argument('--qc', action = 'store_true',
+                      help = 'Write read count, length, base composition, quality and GC statistics for each rRNA depleted file to "rRNA_processed/qc_reports".')
+
+  io_governor.add_arguments(parser)
+  run_history.add_arguments(parser)
+
+  parser.add_argument('--profile', type = str, metavar = '<FILE>',
+                      help = 'Record wall time, CPU time, bytes read/written and child process peak memory for each step. Written as a Chrome trace if FILE ends in .json, otherwise as JSON lines.')
+
   args = parser.parse_args()
+  if args.profile is not None:
+    instrumentation.enable_profile(args.profile)
+  io_governor.configure_from_arguments(args)
+  run_history.start_run('rRNA_remover', args)
   if args.single_end == True:
     paired_single = 'single'
     paired_tags = None
@@ -246,9 +505,14 @@ if __name__ == '__main__':
   working_directory = check_directory(args.directory, 'working_directory')
   os.chdir(working_directory)
 
-  rRNA_library = check_rRNA_library(args.rRNA_library)
+  rRNA_library = check_rRNA_library(os.path.abspath(args.rRNA_library), args.threads)
   fastq_gz_files = gzip_file_list(working_directory)
   sample_reads = paired_reads_finder(fastq_gz_files, paired_single, paired_tags)
   output_subdirectory = output_preperation(working_directory)
-  rrna_removal(rRNA_library, sample_reads, output_subdirectory, paired_single)
+  output_files = rrna_removal(rRNA_library, sample_reads, output_subdirectory, paired_single, args.threads, args.jobs)
+
+  if args.qc == True: # Only this run's outputs, not those of earlier runs or other batches in the folder
+    import fastq_qc # Needs numpy, so only imported when QC is wanted
+    fastq_qc.qc_files(output_files, fastq_qc.qc_output_preparation(output_subdirectory))
+  run_history.finish_run()
   util.info('Process complete')
@@ -1,7 +1,10 @@
-import os, glob, argparse, re, subprocess, pandas
-from cell_bio_util import cell_bio_util as util
+import os, glob, argparse, re, time
+import rnaseq_util as util
+import instrumentation, io_governor, run_history
+import gzip_merge_engine
 
 
+@instrumentation.timed
 def glob_lister(submission_form):
   '''Reads in the CRUKCI_SLX_Submission.xlsx file and returns a list of the
   glob variables to be used by the "globber" function (The "Index" column) in
@@ -26,6 +29,8 @@ def glob_lister(submission_form):
     error_message = 'Submission form not found, please ensure this file is in\n-->\t{0}'.format(working_directory)
     util.critical(error_message)
 
+  import pandas # Imported here so --help and the merge itself do not pay for it
+
   util.info('Reading in index file')
   excel_file = pandas.read_excel(submission_form) # Find the start row to skip passed the header information
   util.info('Index file read')
@@ -40,6 +45,7 @@ def glob_lister(submission_form):
   return(index_list)
 
 
+@instrumentation.timed
 def globber(directory, glob_list_pattern):
   '''Takes in the directory to search within and a list of glob variables (e.g.
   from the "glob_lister" function). Returns a dictionary where the keys are the
@@ -76,7 +82,7 @@ def globber(directory, glob_list_pattern):
   return(index_files_dict)
 
 
-def lane_merger_preparation(indexed_files, paired_single):
+def lane_merger_preparation(indexed_files, paired_single, paired_tags = None):
   '''If the input files for PRAGUI are paired reads then this function will
   allow these pairs to be treated separately. e.g. files "FileA-r_1" and
   "FileA-r_2.fq.gz" will be merged separately. 
@@ -85,8 +91,10 @@ def lane_merger_preparation(indexed_files, paired_single):
   ----------
   indexed_files (dictionary)
     Output of "globber" function. 
-  pair_tags (list)
-    Same as PRAGUI's pair tags input.
+  paired_single (string):
+    Either "paired" or "single".
+  paired_tags (list)
+    Same as PRAGUI's pair tags input. Only used for paired reads.
   
   Returns
   -------
@@ -186,9 +194,111 @@ def merged_filename(file_list, lane_tags, output_subfolder):
   return(output_file_str)
 
 
-def lane_merger(working_directory, files_to_merge, lane_tags):
-  '''Performs the merging of the input files. zcat to read in, pigz to create
-  the merged file - multi-threaded alternative to gzip for faster compression. 
+@instrumentation.timed
+def shell_merge(input_files, output_file_name, threads = None):
+  '''Merges the input files with zcat piped into pigz (multi-threaded alternative
+  to gzip for faster compression).
+  
+  Parameters
+  ----------
+  input_files (List):
+    Full paths of files to be merged.
+  output_file_name (string / os.path):
+    Full path of the merged file.
+  threads (int / None):
+    Number of pigz compression threads, None for the pigz default.
+  
+  Returns
+  -------
+  stats (dictionary):
+    Byte counters and overall timing, in the same form as the python engine's.
+  
+  '''
+
+  import subprocess
+
+  stats = gzip_merge_engine.new_engine_stats()
+  wall_start = time.perf_counter()
+
+  pigz_command = ['pigz', '-c']
+  if threads is not None:
+    pigz_command += ['-p', str(threads)]
+
+  with open(output_file_name, 'wb') as outfile:
+    zcat_files = util.run(io_governor.command(['zcat'] + input_files), stdout = subprocess.PIPE)
+    pigz_output = util.run(io_governor.command(pigz_command), stdin = zcat_files.stdout, stdout = outfile)
+    zcat_files.stdout.close() # Only pigz reads the pipe, so zcat stops instead of hanging if pigz fails
+    zcat_files.wait()
+    pigz_output.wait() # Output must be complete before any downstream step reads it
+
+  stats['wall_seconds'] = time.perf_counter() - wall_start
+  stats['bytes_read'] = sum(os.path.getsize(input_file) for input_file in input_files)
+  stats['bytes_written'] = os.path.getsize(output_file_name)
+  return(stats)
+
+
+def sharded_lane_merger(files_to_merge, lane_tags, subfolder, shards, max_reads_per_shard = None, threads = None, batch = None):
+  '''Merges each sample into read-synchronised shards. The read pair entries of
+  "lane_merger_preparation" (e.g. "D701_D501 r_1" and "D701_D501 r_2") are grouped
+  back into samples so that both mates are split at the same reads.
+  
+  Parameters
+  ----------
+  files_to_merge (Dictionary):
+    Output of "lane_merger_preparation".
+  lane_tags (List):
+    Tags that identify samples' lane e.g. "s_1 s_2".
+  subfolder (string / os.path):
+    Location of the "lane_merged" subfolder.
+  shards (int):
+    Number of shards filled at the same time.
+  max_reads_per_shard (int / None):
+    Maximum number of reads (pairs for paired data) in a shard.
+  threads (int / None):
+    Number of compression threads, None for the number of CPUs.
+  batch (dictionary / None):
+    Space reserved up front by "io_governor.batch_reservation".
+  
+  Returns
+  -------
+  merged_files (list):
+    Full paths of the shards created.
+  
+  '''
+
+  import fastq_sharder
+
+  samples = {}
+  for index_files in files_to_merge:
+    samples.setdefault(index_files.split(' ')[0], []).append(files_to_merge[index_files])
+
+  util.info('Beginning sharded lane merger for {0} samples'.format(len(samples)))
+  merged_files = []
+
+  for sample in samples:
+    mate_input_files = samples[sample]
+    mate_output_files = [os.path.join(subfolder, merged_filename(input_files, lane_tags, subfolder)) for input_files in mate_input_files]
+    estimated_bytes = io_governor.output_estimate(sum(mate_input_files, []), 'lane_merge')
+    with io_governor.heavy_write(subfolder, estimated_bytes, 'shards of {0}'.format(sample), batch), \
+         instrumentation.span('merge_file', output = os.path.basename(mate_output_files[0]), engine = 'sharded'):
+      manifest, stats = fastq_sharder.sharded_merge(mate_input_files, mate_output_files, shards, max_reads_per_shard, threads or os.cpu_count())
+    util.info('Sharded merge throughput: {0}'.format(gzip_merge_engine.throughput_report(stats)))
+    run_history.record_sample(sample, 'lane_merge', stats['wall_seconds'], stats['bytes_read'], stats['bytes_written'],
+                              manifest['reads'], 'sharded', threads or os.cpu_count())
+    for shard in manifest['shards']:
+      merged_files += shard['files']
+  util.info('All lane files merged')
+
+  return(merged_files)
+
+
+@instrumentation.timed
+def lane_merger(working_directory, files_to_merge, lane_tags, engine = 'shell', threads = None, qc = False,
+                shards = None, max_reads_per_shard = None):
+  '''Performs the merging of the input files. With the "shell" engine zcat reads
+  the files in and pigz creates the merged file. The "python" engine does the same
+  in-process with zlib and a thread pool, without any external programs. Sharded
+  output is always written in-process by "fastq_sharder".
   
   Parameters
   ----------
@@ -201,11 +311,23 @@ def lane_merger(working_directory, files_to_merge, lane_tags):
       Files to be merged.
   lane_tags (List):
     Tags that identify samples' lane e.g. "s_1 s_2".
-  
+  engine (string):
+    Either "shell" (zcat | pigz) or "python".
+  threads (int / None):
+    Number of compression threads, None for the engine's default.
+  qc (Boolean):
+    Write a QC report for each merged file into "lane_merged/qc_reports". The
+    python engine collects the statistics from its stream as it merges.
+  shards (int / None):
+    Write each sample as this many read-synchronised shards instead of one file per
+    read pair tag, with a JSON manifest per sample.
+  max_reads_per_shard (int / None):
+    Start a new shard once a shard holds this many reads (pairs for paired data).
   
   Returns
   -------
-  No return
+  merged_files (list):
+    Full paths of the merged files created.
   
   '''
 
@@ -214,19 +336,56 @@ def lane_merger(working_directory, files_to_merge, lane_tags):
   if subfolder_check == False:
     util.critical('Terminating script early')
 
-  util.info('Beginning lane merger for files')
-
-  for index_files in files_to_merge:
-    util.info('Merging {0}'.format(index_files))
-    input_files = files_to_merge[index_files]
-    output_file_name_pre = merged_filename(input_files, lane_tags, subfolder)
-    output_file_name = os.path.join(subfolder, output_file_name_pre)
-    with open(output_file_name, 'wb') as outfile:
-      zcat_files = util.run(['zcat'] + input_files, stdout = subprocess.PIPE)
-      pigz_output = util.run(['pigz', '-c'], stdin = zcat_files.stdout, stdout = outfile)
-      zcat_files.wait()
-    util.info('Output file {0} created'.format(output_file_name))
-  util.info('All lane files merged')
+  if qc == True:
+    import fastq_qc # Needs numpy, so only imported when QC is wanted
+    qc_directory = fastq_qc.qc_output_preparation(subfolder)
+
+  all_input_files = sum(files_to_merge.values(), [])
+  with io_governor.batch_reservation(subfolder, io_governor.output_estimate(all_input_files, 'lane_merge'), 'the merged files') as batch: # Fail now rather than partway through
+    if shards is not None or max_reads_per_shard is not None:
+      if engine != 'python':
+        util.info('Sharded output is written in-process, the {0} engine is not used'.format(engine))
+      merged_files = sharded_lane_merger(files_to_merge, lane_tags, subfolder, shards or 1, max_reads_per_shard, threads, batch)
+      if qc == True:
+        for merged_file in merged_files:
+          fastq_qc.qc_file(merged_file, qc_directory)
+      return(merged_files)
+
+    util.info('Beginning lane merger for files')
+    merged_files = []
+
+    for index_files in files_to_merge:
+      util.info('Merging {0}'.format(index_files))
+      input_files = files_to_merge[index_files]
+      output_file_name_pre = merged_filename(input_files, lane_tags, subfolder)
+      output_file_name = os.path.join(subfolder, output_file_name_pre)
+      reads = None
+      estimated_bytes = io_governor.output_estimate(input_files, 'lane_merge')
+      with io_governor.heavy_write(subfolder, estimated_bytes, os.path.basename(output_file_name), batch), \
+           instrumentation.span('merge_file', output = os.path.basename(output_file_name), engine = engine):
+        if engine == 'python':
+          qc_tap = None
+          if qc == True:
+            qc_state = fastq_qc.new_qc_state()
+            qc_tap = lambda blocks: fastq_qc.qc_tap(blocks, qc_state)
+          stats = gzip_merge_engine.python_merge(input_files, output_file_name, threads or os.cpu_count(), tap = qc_tap)
+          util.info('Python engine throughput: {0}'.format(gzip_merge_engine.throughput_report(stats)))
+          if qc == True:
+            fastq_qc.qc_write_report(qc_state, output_file_name, qc_directory)
+            reads = qc_state['reads']
+        else:
+          stats = shell_merge(input_files, output_file_name, threads)
+          util.info('zcat | pigz throughput: {0:.1f} MB/s compressed input in {1:.1f} s'.format(
+                    stats['bytes_read'] / 1048576.0 / max(stats['wall_seconds'], 1e-9), stats['wall_seconds']))
+          if qc == True:
+            fastq_qc.qc_file(output_file_name, qc_directory)
+      run_history.record_sample(os.path.basename(output_file_name), 'lane_merge', stats['wall_seconds'], stats['bytes_read'],
+                                stats['bytes_written'], reads, engine, threads or (os.cpu_count() if engine == 'python' else None))
+      util.info('Output file {0} created'.format(output_file_name))
+      merged_files.append(output_file_name)
+    util.info('All lane files merged')
+
+    return(merged_files)
 
 
 if __name__ == '__main__':
@@ -251,7 +410,45 @@ if __name__ == '__main__':
   group.add_argument('-p', '--paired_end', nargs = 2, metavar = '<PAIR_TAG>',
                      help = 'Flag if RNA-Seq data are paired end reads. Mutually exclusive with the -s/--single_end argument. Provide pair tags, this will be the same as PRAGUI\'s "pair_tags" argument.')
 
+  parser.add_argument('-e', '--engine',
+                      type = str,
+                      default = 'shell',
+                      choices = ['shell', 'python'],
+                      help = 'Merge engine: "shell" pipes zcat into pigz, "python" merges in-process with zlib and needs no external programs (default shell).')
+
+  parser.add_argument('-t', '--threads',
+                      type = int,
+                      metavar = '<THREADS>',
+                      help = 'Number of compression threads. Defaults to the number of CPUs.')
+
+  parser.add_argument('--qc',
+                      action = 'store_true',
+                      help = 'Write read count, length, base composition, quality and GC statistics for each merged file to "lane_merged/qc_reports".')
+
+  parser.add_argument('--shards',
+                      type = int,
+                      metavar = '<SHARDS>',
+                      help = 'Write each sample as SHARDS read-synchronised shards (e.g. "...merged_shard_001.r_1.fq.gz") with a JSON manifest, instead of one merged file per read pair tag.')
+
+  parser.add_argument('--max_reads_per_shard',
+                      type = int,
+                      metavar = '<READS>',
+                      help = 'Start a new shard once a shard holds READS reads (read pairs for paired end data). Can be used with or without --shards.')
+
+  io_governor.add_arguments(parser)
+  run_history.add_arguments(parser)
+
+  parser.add_argument('--profile', type = str, metavar = '<FILE>',
+                      help = 'Record wall time, CPU time, bytes read/written and child process peak memory for each step. Written as a Chrome trace if FILE ends in .json, otherwise as JSON lines.')
+
   args = parser.parse_args()
+  for value in (args.shards, args.max_reads_per_shard):
+    if value is not None and value < 1:
+      parser.error('--shards and --max_reads_per_shard must be at least 1')
+  io_governor.configure_from_arguments(args)
+  run_history.start_run('rna_seq_lane_merger', args)
+  if args.profile is not None:
+    instrumentation.enable_profile(args.profile)
   if args.single_end == True:
     paired_single = 'single'
     paired_tags = None
@@ -263,6 +460,8 @@ if __name__ == '__main__':
 
   glob_list = glob_lister(args.submission_form)
   indexed_files = globber(working_directory, glob_list)
-  files_to_merge = lane_merger_preparation(indexed_files, paired_single)
-  merged_files = lane_merger(working_directory, files_to_merge, args.lane_tags)
+  files_to_merge = lane_merger_preparation(indexed_files, paired_single, paired_tags)
+  merged_files = lane_merger(working_directory, files_to_merge, args.lane_tags, args.engine, args.threads, args.qc,
+                             args.shards, args.max_reads_per_shard)
+  run_history.finish_run()
   util.info('Process complete')
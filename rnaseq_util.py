@@ -0,0 +1,113 @@
+import os, sys
+
+module_path = os.path.realpath(__file__)
+rnaseq_utilities_directory = os.path.dirname(module_path)
+utilities_directory = os.path.split(rnaseq_utilities_directory)[0]
+
+loaded = {}
+
+
+def cell_bio_util():
+  '''Imports cell_bio_util on first use, so tools only pay for it once they log or run a command.
+  cell_bio_util is looked for next to this project's directory (see README) and on the normal path.
+
+  Returns
+  -------
+  cell_bio_util (module / None):
+    The cell_bio_util module, or None if it is not installed
+
+  '''
+
+  if 'cell_bio_util' not in loaded:
+    for directory in [utilities_directory, rnaseq_utilities_directory]:
+      if directory not in sys.path:
+        sys.path.append(directory)
+    try:
+      from cell_bio_util import cell_bio_util as util
+    except ImportError:
+      util = None
+    loaded['cell_bio_util'] = util
+
+  return(loaded['cell_bio_util'])
+
+
+def fallback_logger():
+  '''Lightweight logger used when cell_bio_util is not installed'''
+
+  if 'logger' not in loaded:
+    import logging
+    logging.basicConfig(format = '%(asctime)s %(levelname)s: %(message)s', level = logging.INFO)
+    loaded['logger'] = logging.getLogger('RNA-Seq_utilities')
+
+  return(loaded['logger'])
+
+
+def info(message):
+  '''Logs an information message'''
+
+  util = cell_bio_util()
+  if util is not None:
+    return(util.info(message))
+  fallback_logger().info(message)
+
+
+def warn(message):
+  '''Logs a warning'''
+
+  util = cell_bio_util()
+  if util is not None:
+    return(util.warn(message))
+  fallback_logger().warning(message)
+
+
+def warning(message):
+  '''Logs a warning'''
+
+  util = cell_bio_util()
+  if util is not None:
+    return(getattr(util, 'warning', util.warn)(message))
+  fallback_logger().warning(message)
+
+
+def critical(message):
+  '''Logs an error and terminates the script'''
+
+  util = cell_bio_util()
+  if util is not None:
+    return(util.critical(message))
+  fallback_logger().critical(message)
+  sys.exit(1)
+
+
+def run(command, **kwargs):
+  '''Starts an external command without waiting for it
+
+  Returns
+  -------
+  process (subprocess.Popen):
+    The running command
+
+  '''
+
+  util = cell_bio_util()
+  if util is not None:
+    return(util.run(command, **kwargs))
+  import subprocess
+  return(subprocess.Popen(command, **kwargs))
+
+
+def call(command, **kwargs):
+  '''Runs an external command and waits for it to finish
+
+  Returns
+  -------
+  returncode (int):
+    Exit status of the command
+
+  '''
+
+  util = cell_bio_util()
+  if util is not None:
+    return(util.call(command, **kwargs))
+  import subprocess
+  return(subprocess.call(command, **kwargs))
@@ -0,0 +1,273 @@
+import os, sys, json, math, time, socket, argparse, threading, atexit
+import rnaseq_util as util
+import instrumentation
+
+history = {'run': None, 'samples': [], 'path': None, 'lock': threading.Lock()}
+
+HISTORY_FILE = os.environ.get('RNASEQ_RUN_HISTORY', os.path.join(os.path.expanduser('~'), '.rnaseq_utilities', 'run_history.sqlite'))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+  run_id INTEGER PRIMARY KEY,
+  tool TEXT, host TEXT, started REAL, wall_seconds REAL, status TEXT, settings TEXT);
+CREATE TABLE IF NOT EXISTS samples (
+  run_id INTEGER REFERENCES runs(run_id),
+  sample TEXT, stage TEXT, seconds REAL, input_bytes INTEGER, output_bytes INTEGER, reads INTEGER,
+  engine TEXT, threads INTEGER);
+CREATE TABLE IF NOT EXISTS stages (
+  run_id INTEGER REFERENCES runs(run_id),
+  stage TEXT, calls INTEGER, wall_seconds REAL);
+CREATE INDEX IF NOT EXISTS samples_stage ON samples(stage);
+'''
+
+
+def add_arguments(parser):
+  '''Adds the run history flags to a tool's argument parser'''
+
+  parser.add_argument('--history', type = str, default = HISTORY_FILE, metavar = '<FILE>',
+                      help = 'SQLite file the run is recorded in (default {0}, or $RNASEQ_RUN_HISTORY). See run_history.py to query it.'.format(HISTORY_FILE))
+  parser.add_argument('--no_history', action = 'store_true',
+                      help = 'Do not record this run in the run history.')
+
+
+def start_run(tool, args):
+  '''Starts recording a run. Each major step's wall time is added up as it runs, and the run is written
+  to the history file when the tool calls "finish_run", or as "incomplete" if the script exits first.
+
+  Parameters
+  ----------
+  tool (string):
+    Name of the script, e.g. "rna_seq_lane_merger"
+
+  args (argparse.Namespace):
+    Parsed arguments, with the flags of "add_arguments"; all of them are stored as the run's settings
+
+  '''
+
+  if args.no_history == True:
+    return
+
+  settings = {key: value for key, value in vars(args).items() if key not in ('history', 'no_history')}
+  history['run'] = {'tool': tool, 'host': socket.gethostname(), 'started': time.time(), 'wall_start': time.perf_counter(),
+                    'settings': json.dumps(settings, default = str, sort_keys = True)}
+  history['path'] = os.path.abspath(args.history)
+  instrumentation.enable_stage_totals()
+  atexit.register(finish_run, 'incomplete')
+
+
+def record_sample(sample, stage, seconds = None, input_bytes = None, output_bytes = None, reads = None, engine = None, threads = None):
+  '''Records one sample (or file) passing through a stage. Does nothing unless a run is being recorded.
+
+  Parameters
+  ----------
+  sample (string):
+    Sample or file name
+
+  stage (string):
+    e.g. "lane_merge", "rrna_removal", "download"
+
+  seconds (float / None):
+    Wall time the stage took for this sample
+
+  input_bytes, output_bytes, reads (int / None):
+    Sizes, where known
+
+  engine (string / None), threads (int / None):
+    Settings the stage ran with
+
+  '''
+
+  if history['run'] is None:
+    return
+
+  with history['lock']:
+    history['samples'].append((sample, stage, seconds, input_bytes, output_bytes, reads, engine, threads))
+
+
+def connect(history_path):
+  '''Opens the history file, creating it and its tables if needed'''
+
+  import sqlite3
+
+  directory = os.path.dirname(history_path)
+  if directory:
+    os.makedirs(directory, exist_ok = True)
+  connection = sqlite3.connect(history_path, timeout = 60) # Waits for other tools finishing at the same time
+  connection.executescript(SCHEMA)
+  return(connection)
+
+
+def finish_run(status = 'complete'):
+  '''Writes the run, its samples and its stage totals to the history file in one transaction.
+  Only the first call for a run writes anything.
+
+  Parameters
+  ----------
+  status (string):
+    "complete", "failed", or "incomplete" when called as the script exits
+
+  '''
+
+  with history['lock']:
+    run = history['run']
+    samples = list(history['samples'])
+    history['run'] = None
+    history['samples'] = []
+  if run is None:
+    return
+
+  stages = instrumentation.profile['stages'] or {}
+  try:
+    connection = connect(history['path'])
+    with connection:
+      cursor = connection.execute('INSERT INTO runs (tool, host, started, wall_seconds, status, settings) VALUES (?, ?, ?, ?, ?, ?)',
+                                  (run['tool'], run['host'], run['started'], time.perf_counter() - run['wall_start'], status, run['settings']))
+      run_id = cursor.lastrowid
+      connection.executemany('INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [(run_id,) + sample for sample in samples])
+      connection.executemany('INSERT INTO stages VALUES (?, ?, ?, ?)',
+                             [(run_id, stage, stages[stage]['calls'], stages[stage]['wall_seconds']) for stage in sorted(stages)])
+    connection.close()
+  except Exception as error: # The history must never fail a run that did its work
+    util.warn('Could not record the run in {0}: {1}'.format(history['path'], error))
+    return
+
+  util.info('Run recorded in {0}'.format(history['path']))
+
+
+def percentile(values, fraction):
+  '''Nearest-rank percentile of a list of numbers, None if the list is empty'''
+
+  if len(values) == 0:
+    return(None)
+  values = sorted(values)
+  return(values[max(math.ceil(fraction * len(values)), 1) - 1])
+
+
+def query_history(history_path, tool = None, stage = None, host = None, days = None, slowest = 10, span = None):
+  '''Reports throughput percentiles per stage, engine and thread count, the slowest samples and the
+  stages taking the most time per run, across every recorded run matching the filters
+
+  Parameters
+  ----------
+  history_path (string / os.path):
+    SQLite history file
+
+  tool, stage, host (string / None):
+    Only include runs of this tool, samples of this stage (e.g. "lane_merge"), runs on this host
+
+  days (float / None):
+    Only include runs started in the last number of days
+
+  slowest (int):
+    Number of slowest samples and stages listed
+
+  span (string / None):
+    Only include this step in the stages taking the most time, e.g. "lane_merger"; steps are
+    the timed functions and spans, so are named differently from the sample stages
+
+  Returns
+  -------
+  report (dictionary):
+    "throughput", "slowest_samples" and "slowest_stages" rows, as printed
+
+  '''
+
+  if not os.path.isfile(history_path):
+    util.critical('No run history at {0}'.format(history_path))
+  connection = connect(history_path)
+
+  conditions = []
+  parameters = []
+  for column, value in (('runs.tool', tool), ('runs.host', host)):
+    if value is not None:
+      conditions.append('{0} = ?'.format(column))
+      parameters.append(value)
+  if days is not None:
+    conditions.append('runs.started >= ?')
+    parameters.append(time.time() - days * 86400)
+  run_filter = ' AND '.join(conditions) if conditions else '1'
+
+  sample_filter = run_filter + (' AND samples.stage = ?' if stage is not None else '')
+  sample_parameters = parameters + ([stage] if stage is not None else [])
+  sample_rows = connection.execute('SELECT samples.stage, samples.engine, samples.threads, samples.seconds, samples.input_bytes, samples.reads, '
+                                   'samples.sample, runs.tool, runs.host, runs.started FROM samples JOIN runs USING (run_id) '
+                                   'WHERE samples.seconds > 0 AND ' + sample_filter, sample_parameters).fetchall()
+
+  groups = {}
+  for row in sample_rows:
+    groups.setdefault(row[:3], []).append(row)
+
+  report = {'throughput': [], 'slowest_samples': [], 'slowest_stages': []}
+  for (stage_name, engine, threads), rows in sorted(groups.items(), key = lambda group: [str(key) for key in group[0]]):
+    mb_per_second = [row[4] / 1048576.0 / row[3] for row in rows if row[4] is not None]
+    reads_per_second = [row[5] / row[3] for row in rows if row[5] is not None]
+    report['throughput'].append({'stage': stage_name, 'engine': engine, 'threads': threads, 'samples': len(rows),
+                                 'mb_per_second': [percentile(mb_per_second, fraction) for fraction in (0.1, 0.5, 0.9)],
+                                 'reads_per_second': [percentile(reads_per_second, fraction) for fraction in (0.1, 0.5, 0.9)]})
+
+  for row in sorted(sample_rows, key = lambda row: row[3], reverse = True)[:slowest]:
+    report['slowest_samples'].append({'sample': row[6], 'stage': row[0], 'seconds': row[3], 'input_bytes': row[4],
+                                      'tool': row[7], 'host': row[8], 'started': time.strftime('%Y-%m-%d %H:%M', time.localtime(row[9]))})
+
+  stage_rows = connection.execute('SELECT stages.stage, stages.wall_seconds FROM stages JOIN runs USING (run_id) WHERE ' + run_filter +
+                                  (' AND stages.stage = ?' if span is not None else ''), parameters + ([span] if span is not None else [])).fetchall()
+  connection.close()
+  stage_seconds = {}
+  for stage_name, wall_seconds in stage_rows:
+    stage_seconds.setdefault(stage_name, []).append(wall_seconds)
+  for stage_name in sorted(stage_seconds, key = lambda stage_name: percentile(stage_seconds[stage_name], 0.5), reverse = True)[:slowest]:
+    report['slowest_stages'].append({'stage': stage_name, 'runs': len(stage_seconds[stage_name]),
+                                     'seconds': [percentile(stage_seconds[stage_name], fraction) for fraction in (0.5, 0.9, 1.0)]})
+
+  return(report)
+
+
+def print_report(report):
+  '''Prints the output of "query_history" as plain text tables'''
+
+  def number(value, digits = 1):
+    return('-' if value is None else '{0:.{1}f}'.format(value, digits))
+
+  print('Throughput per sample (p10 / p50 / p90)')
+  print('{0:<28}{1:<10}{2:>8}{3:>9}  {4:<26}{5}'.format('stage', 'engine', 'threads', 'samples', 'MB/s', 'reads/s'))
+  for row in report['throughput']:
+    print('{0:<28}{1:<10}{2:>8}{3:>9}  {4:<26}{5}'.format(row['stage'], str(row['engine'] or '-'), str(row['threads'] or '-'), row['samples'],
+                                                          ' / '.join(number(value) for value in row['mb_per_second']),
+                                                          ' / '.join(number(value, 0) for value in row['reads_per_second'])))
+
+  print('\nSlowest samples')
+  for row in report['slowest_samples']:
+    print('{0:>10} s  {1:<16}{2:<60}{3} {4} ({5})'.format(number(row['seconds']), row['stage'], row['sample'], row['started'], row['host'], row['tool']))
+
+  print('\nSlowest stages, seconds per run (p50 / p90 / max)')
+  for row in report['slowest_stages']:
+    print('{0:<40}{1:>6} runs  {2}'.format(row['stage'], row['runs'], ' / '.join(number(value) for value in row['seconds'])))
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description = 'Report throughput percentiles and the slowest samples and stages from the run history')
+  parser.add_argument('--history', type = str, default = HISTORY_FILE, metavar = '<FILE>',
+                      help = 'SQLite run history file (default {0}, or $RNASEQ_RUN_HISTORY).'.format(HISTORY_FILE))
+  parser.add_argument('--tool', type = str, metavar = '<TOOL>',
+                      help = 'Only include runs of this script, e.g. rna_seq_lane_merger.')
+  parser.add_argument('--stage', type = str, metavar = '<STAGE>',
+                      help = 'Only include samples of this stage: lane_merge, rrna_removal, download or subsample.')
+  parser.add_argument('--span', type = str, metavar = '<SPAN>',
+                      help = 'Only include this step in the slowest stages, e.g. lane_merger or ftp_download_files.')
+  parser.add_argument('--host', type = str, metavar = '<HOST>',
+                      help = 'Only include runs on this host.')
+  parser.add_argument('--days', type = float, metavar = '<DAYS>',
+                      help = 'Only include runs started in the last DAYS days.')
+  parser.add_argument('--slowest', type = int, default = 10, metavar = '<N>',
+                      help = 'Number of slowest samples and stages listed (default 10).')
+  parser.add_argument('--json', action = 'store_true',
+                      help = 'Print the report as JSON instead of tables.')
+
+  args = parser.parse_args()
+  report = query_history(os.path.abspath(args.history), args.tool, args.stage, args.host, args.days, args.slowest, args.span)
+  if args.json == True:
+    json.dump(report, sys.stdout, indent = 1)
+    print()
+  else:
+    print_report(report)
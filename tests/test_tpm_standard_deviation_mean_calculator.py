@@ -0,0 +1,47 @@
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import numpy, pandas
+import tpm_standard_deviation_mean_calculator as tpm_calculator
+
+
+def mixed_expression_data(genes = 2000, seed = 11):
+  '''TPM values where a highly expressed condition sits next to a barely expressed one, with
+  replicate spreads far smaller than the means, and a few missing values'''
+
+  random_generator = numpy.random.default_rng(seed)
+  levels = {'high': 20000.0, 'low': 1.0, 'mid': 350.0}
+  spreads = [0.01, 0.001, 2.5]
+  data = {'geneName': ['WBGene{0:08d}'.format(gene) for gene in range(genes)],
+          'gene': ['gene-{0}'.format(gene) for gene in range(genes)]}
+  for condition, level in levels.items():
+    for replicate in range(1, 4):
+      spread = numpy.array([spreads[gene % len(spreads)] for gene in range(genes)])
+      data['{0}_{1}'.format(condition, replicate)] = level * (1 + random_generator.random(genes)) + spread * random_generator.standard_normal(genes)
+  merged_data = pandas.DataFrame(data)
+  merged_data.loc[::97, 'mid_2'] = numpy.nan
+  merged_data.loc[::89, ['low_1', 'low_2']] = numpy.nan
+
+  sample_conditions = {condition: ['{0}_{1}'.format(condition, replicate) for replicate in range(1, 4)] for condition in levels}
+  return(merged_data, sample_conditions)
+
+
+def test_statistics_match_pandas():
+  merged_data, sample_conditions = mixed_expression_data()
+  conditions = list(sample_conditions)
+  tpm_mean, tpm_variance = tpm_calculator.sums_statistics(tpm_calculator.condition_sums(merged_data, sample_conditions, conditions))
+
+  for condition_number, condition in enumerate(conditions):
+    replicates = merged_data[sample_conditions[condition]]
+    numpy.testing.assert_allclose(tpm_mean[:, condition_number], replicates.mean(axis = 1), rtol = 1e-12)
+    numpy.testing.assert_allclose(tpm_variance[:, condition_number] ** 0.5, replicates.std(axis = 1), rtol = 1e-9, equal_nan = True)
+
+
+def test_statistics_do_not_depend_on_other_conditions():
+  merged_data, sample_conditions = mixed_expression_data()
+  together = tpm_calculator.sums_statistics(tpm_calculator.condition_sums(merged_data, sample_conditions, ['high', 'low']))
+  alone = tpm_calculator.sums_statistics(tpm_calculator.condition_sums(merged_data, sample_conditions, ['low']))
+
+  numpy.testing.assert_array_equal(together[0][:, 1], alone[0][:, 0])
+  numpy.testing.assert_array_equal(together[1][:, 1], alone[1][:, 0])
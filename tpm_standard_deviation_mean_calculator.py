@@ -1,5 +1,10 @@
-import argparse, os, sys, pandas, re, unicodedata
-from cell_bio_util import cell_bio_util as util
+import argparse, os, sys, re, unicodedata, hashlib, json, itertools
+import rnaseq_util as util
+import instrumentation, run_history
+
+TPM_CACHE_FILE = 'TPM_std_dev_cache.json'
+TPM_SUMMARY_FILE = 'TPM_std_dev_summary.txt'
+TPM_DIFFERENTIAL_FILE = 'TPM_differential_summary.txt'
 
 
 def check_file(file_path):
@@ -48,6 +53,7 @@ def working_directory_finder(samples_tpm_path):
   return(working_directory, tpm_file_name)
 
 
+@instrumentation.timed
 def read_in_tpm(tpm_file_location):
   '''Reads in the information within TPM file using the pandas module
   
@@ -63,19 +69,23 @@ def read_in_tpm(tpm_file_location):
   
   '''
 
+  import pandas # Imported here so --help does not pay for it
+
   tpm_file = pandas.read_csv(tpm_file_location, delimiter = '\t')
   util.info('TPM file read in')
   return(tpm_file)
 
 
-def gene_name_converter():
+@instrumentation.timed
+def gene_name_converter(gene_id_file = None):
   '''Provides a reference to allow gene IDs to be converted human readable gene name abbreviations 
   (e.g. "WBGene00000001" to "aap-1" etc)
   This version of the script only deals with C. elegans
   
   Parameters
   ----------
-  NONE
+  gene_id_file (string / os.path / None):
+    WormBase geneIDs file, defaults to the canonical C. elegans file under /data1/geneIDs
     
   Returns
   -------
@@ -84,7 +94,10 @@ def gene_name_converter():
   
   '''
 
-  gene_id_file = os.path.join(os.sep, 'data1', 'geneIDs', 'c_elegans.canonical_bioproject.current.geneIDs.txt')
+  import pandas
+
+  if gene_id_file is None:
+    gene_id_file = os.path.join(os.sep, 'data1', 'geneIDs', 'c_elegans.canonical_bioproject.current.geneIDs.txt')
   util.info('Reading in geneIDs from {0}'.format(gene_id_file))
   gene_id_csv = pandas.read_csv(gene_id_file, delimiter = ',', names = [0, 'geneName', 'gene', 'transcript_id', 4])
   gene_id = gene_id_csv.filter(['geneName', 'gene', 'transcript_id'])
@@ -119,14 +132,18 @@ def slugify(value):
   return(value)
 
 
-def samples_file_conditions_finder(tpm_file):
+@instrumentation.timed
+def samples_file_conditions_finder(working_directory, tpm_file):
   '''Finds the user set conditions for the RNA-Seq data
   Reads in original CSV file to obtain information
   
   Parameters
   ----------
+  working_directory (string / os.path):
+    Folder holding the TPM file and the samples CSV file
+  
   tpm_file (string / os.path):
-    TPM file location
+    TPM file name
   
   Returns
   -------
@@ -135,6 +152,8 @@ def samples_file_conditions_finder(tpm_file):
   
   '''
 
+  import pandas
+
   sample_conditions = {}
 
   util.info('Reading in samples CSV file to obtain sample names and conditions')
@@ -154,12 +173,334 @@ def samples_file_conditions_finder(tpm_file):
   return(sample_conditions)
 
 
-def output_file_creator(tpm_read, sample_conditions, gene_ids):
+def frame_fingerprint(frame):
+  '''Hashes the values of a pandas object (and its index), independent of how it was read in
+
+  Returns
+  -------
+  fingerprint (string):
+    Hexadecimal MD5 digest
+
+  '''
+
+  import pandas
+
+  return(hashlib.md5(pandas.util.hash_pandas_object(frame, index = True).values.tobytes()).hexdigest())
+
+
+@instrumentation.timed
+def condition_fingerprints(tpm_read, sample_conditions, gene_ids):
+  '''Fingerprints everything each condition's output depends on: its sample list, the TPM
+  columns of those samples, the gene order of the TPM file and the gene reference. Each TPM
+  column is hashed once, however many conditions use it.
+
+  Parameters
+  ----------
+  tpm_read (pandas object):
+    Pandas object containing TPM data
+
+  sample_conditions (dictionary):
+    Dictionary object; Keys are (slugified) conditions and values are lists containing the sample names
+
+  gene_ids (pandas csv object):
+    Pandas object containing wormbase geneIDs and corresponding gene name abbreviations
+
+  Returns
+  -------
+  fingerprints (dictionary):
+    Keys are the conditions and values are their fingerprints
+
+  '''
+
+  gene_reference = frame_fingerprint(gene_ids)
+  gene_order = frame_fingerprint(tpm_read['geneName'].reset_index(drop = True))
+
+  column_fingerprints = {}
+  fingerprints = {}
+  for condition in sample_conditions:
+    samples = sample_conditions[condition]
+    for sample in samples:
+      if sample not in column_fingerprints:
+        column_fingerprints[sample] = frame_fingerprint(tpm_read[sample].reset_index(drop = True)) if sample in tpm_read else None
+    condition_inputs = {'samples': samples, 'columns': [column_fingerprints[sample] for sample in samples],
+                        'genes': gene_order, 'gene_reference': gene_reference}
+    fingerprints[condition] = hashlib.md5(json.dumps(condition_inputs, sort_keys = True).encode()).hexdigest()
+
+  return(fingerprints)
+
+
+def read_tpm_cache(cache_file):
+  '''Reads the condition fingerprints recorded by the last run, empty if there are none'''
+
+  try:
+    with open(cache_file, 'r') as cache_input:
+      return(json.load(cache_input).get('conditions', {}))
+  except (OSError, ValueError):
+    return({})
+
+
+def write_tpm_cache(cache_file, fingerprints):
+  '''Records the condition fingerprints of this run'''
+
+  temporary_file = cache_file + '.tmp'
+  with open(temporary_file, 'w') as cache_output:
+    json.dump({'conditions': fingerprints}, cache_output, indent = 1, sort_keys = True)
+  os.replace(temporary_file, cache_file)
+
+
+def stale_conditions(sample_conditions, fingerprints, cached_fingerprints, summary_file):
+  '''Finds the conditions whose output needs to be recomputed: those whose fingerprint changed,
+  whose .xlsx file is missing, or all of them if there is no summary table to update
+
+  Returns
+  -------
+  stale (list):
+    Conditions to recompute
+
+  '''
+
+  if not os.path.isfile(summary_file):
+    return(list(sample_conditions))
+
+  stale = []
+  for condition in sample_conditions:
+    output_file = os.path.join(os.path.dirname(summary_file), 'TPM_std_dev_{0}.xlsx'.format(condition))
+    if cached_fingerprints.get(condition) != fingerprints[condition] or not os.path.isfile(output_file):
+      stale.append(condition)
+
+  return(stale)
+
+
+@instrumentation.timed
+def summary_file_update(summary_file, merged_data, sample_conditions, condition_statistics):
+  '''Writes the summary table: gene ID, gene name and the TPM mean and standard deviation of every
+  condition. Columns of conditions that were not recomputed are kept from the existing table and
+  columns of conditions no longer in the samples file are dropped.
+
+  Parameters
+  ----------
+  summary_file (string / os.path):
+    Location of the tab separated summary table
+
+  merged_data (pandas object):
+    TPM data merged with the gene name/ID references
+
+  sample_conditions (dictionary):
+    Dictionary object; Keys are (slugified) conditions and values are lists containing the sample names
+
+  condition_statistics (dictionary):
+    Keys are the recomputed conditions and values are their (tpm_mean, tpm_standard_deviation) columns
+
+  '''
+
+  import pandas
+
+  if len(condition_statistics) < len(sample_conditions) and os.path.isfile(summary_file):
+    summary = pandas.read_csv(summary_file, delimiter = '\t')
+  else:
+    summary = merged_data.filter(items = ['geneName', 'gene']).reset_index(drop = True)
+
+  summary_columns = ['geneName', 'gene']
+  for condition in sample_conditions:
+    summary_columns += ['{0}_tpm_mean'.format(condition), '{0}_tpm_standard_deviation'.format(condition)]
+    if condition in condition_statistics:
+      tpm_mean, tpm_standard_deviation = condition_statistics[condition]
+      summary['{0}_tpm_mean'.format(condition)] = tpm_mean.to_numpy() # Same genes in the same order, or every condition would be stale
+      summary['{0}_tpm_standard_deviation'.format(condition)] = tpm_standard_deviation.to_numpy()
+
+  temporary_file = summary_file + '.tmp'
+  summary.reindex(columns = summary_columns).to_csv(temporary_file, sep = '\t', index = False)
+  os.replace(temporary_file, summary_file)
+  util.info('Summary table updated: {0}'.format(summary_file))
+
+
+@instrumentation.timed
+def condition_sums(merged_data, sample_conditions, conditions):
+  '''Counts the replicates with a value, and takes the mean and the sum of squared deviations from
+  that mean for every gene, for all the given conditions. Deviations are taken from each condition's
+  own mean (two passes, as pandas does), so standard deviations keep their precision when conditions
+  with very different expression levels sit side by side. Samples missing from the TPM file are
+  ignored, as the pandas mean and std do.
+
+  Parameters
+  ----------
+  merged_data (pandas object):
+    TPM data merged with the gene name/ID references
+
+  sample_conditions (dictionary):
+    Dictionary object; Keys are (slugified) conditions and values are lists containing the sample names
+
+  conditions (list):
+    Conditions to sum
+
+  Returns
+  -------
+  sums (dictionary):
+    "conditions" (list) and per-gene, per-condition "count", "mean" and "squared_deviations"
+    (NumPy arrays with one column per condition)
+
+  '''
+
+  import numpy
+
+  samples = []
+  for condition in conditions:
+    samples += [sample for sample in sample_conditions[condition] if sample not in samples]
+
+  values = merged_data.reindex(columns = samples).to_numpy(dtype = numpy.float64)
+  present = ~numpy.isnan(values)
+
+  shape = (len(values), len(conditions))
+  sums = {'conditions': list(conditions), 'count': numpy.zeros(shape), 'mean': numpy.full(shape, numpy.nan),
+          'squared_deviations': numpy.zeros(shape)}
+  for condition_number, condition in enumerate(conditions):
+    columns = [samples.index(sample) for sample in sample_conditions[condition]]
+    condition_present = present[:, columns]
+    count = condition_present.sum(axis = 1)
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+      mean = numpy.where(condition_present, values[:, columns], 0.0).sum(axis = 1) / count
+    deviations = numpy.where(condition_present, values[:, columns] - mean[:, None], 0.0)
+    sums['count'][:, condition_number] = count
+    sums['mean'][:, condition_number] = numpy.where(count > 0, mean, numpy.nan)
+    sums['squared_deviations'][:, condition_number] = (deviations * deviations).sum(axis = 1)
+
+  return(sums)
+
+
+def sums_statistics(sums):
+  '''Turns the output of "condition_sums" into per-gene means and sample variances. As with pandas,
+  the mean is NaN without any value and the variance is NaN with fewer than two values.
+
+  Returns
+  -------
+  tpm_mean (NumPy array):
+    One column per condition
+
+  tpm_variance (NumPy array):
+    One column per condition
+
+  '''
+
+  import numpy
+
+  count = sums['count']
+  with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+    tpm_variance = numpy.where(count > 1, sums['squared_deviations'] / (count - 1), numpy.nan)
+
+  return(sums['mean'], tpm_variance)
+
+
+def comparison_pairs(compare, sample_conditions):
+  '''Reads the --compare argument into condition pairs
+
+  Parameters
+  ----------
+  compare (list):
+    "CONDITION_A:CONDITION_B" pairs (condition names as in the samples file, or slugified), or "all"
+
+  sample_conditions (dictionary):
+    Dictionary object; Keys are (slugified) conditions and values are lists containing the sample names
+
+  Returns
+  -------
+  comparisons (list):
+    (condition_a, condition_b) tuples of slugified conditions
+
+  '''
+
+  if compare == ['all']:
+    return(list(itertools.combinations(sample_conditions, 2)))
+
+  comparisons = []
+  for pair in compare:
+    if pair.count(':') != 1:
+      util.critical('Invalid --compare pair "{0}", expected CONDITION_A:CONDITION_B or "all"'.format(pair))
+    condition_a, condition_b = [slugify(condition) for condition in pair.split(':')]
+    for condition in (condition_a, condition_b):
+      if condition not in sample_conditions:
+        util.critical('Condition "{0}" in --compare is not in the samples file. Conditions are:\n{1}'.format(condition, '\n'.join(sample_conditions)))
+    comparisons.append((condition_a, condition_b))
+
+  return(comparisons)
+
+
+@instrumentation.timed
+def differential_summary(working_directory, merged_data, sums, comparisons, pseudocount = 1.0):
+  '''Computes log2 fold changes and Welch t statistics for every gene and condition pair in one
+  vectorised pass over the per-condition sums, and writes them as one long table with a row
+  per gene and pair.
+
+  Parameters
+  ----------
+  working_directory (string / os.path):
+    Folder the table is written to
+
+  merged_data (pandas object):
+    TPM data merged with the gene name/ID references
+
+  sums (dictionary):
+    Output of "condition_sums" covering every condition in the pairs
+
+  comparisons (list):
+    (condition_a, condition_b) tuples
+
+  pseudocount (float):
+    Added to both means before taking the log2 fold change
+
+  Returns
+  -------
+  differential_file (string / os.path):
+    Location of the tab separated table
+
+  '''
+
+  import numpy, pandas
+
+  tpm_mean, tpm_variance = sums_statistics(sums)
+  condition_a = numpy.array([sums['conditions'].index(pair[0]) for pair in comparisons], dtype = numpy.int64)
+  condition_b = numpy.array([sums['conditions'].index(pair[1]) for pair in comparisons], dtype = numpy.int64)
+
+  mean_a, mean_b = tpm_mean[:, condition_a], tpm_mean[:, condition_b]
+  count_a, count_b = sums['count'][:, condition_a], sums['count'][:, condition_b]
+  with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+    squared_error_a = tpm_variance[:, condition_a] / count_a
+    squared_error_b = tpm_variance[:, condition_b] / count_b
+    log2_fold_change = numpy.log2((mean_a + pseudocount) / (mean_b + pseudocount))
+    welch_t = (mean_a - mean_b) / numpy.sqrt(squared_error_a + squared_error_b)
+    welch_degrees_of_freedom = ((squared_error_a + squared_error_b) ** 2 /
+                                (squared_error_a ** 2 / (count_a - 1) + squared_error_b ** 2 / (count_b - 1)))
+
+  genes = len(merged_data)
+  differential_table = pandas.DataFrame({'geneName': numpy.tile(merged_data['geneName'].to_numpy(), len(comparisons)),
+                                         'gene': numpy.tile(merged_data['gene'].to_numpy(), len(comparisons)),
+                                         'condition_a': numpy.repeat([pair[0] for pair in comparisons], genes),
+                                         'condition_b': numpy.repeat([pair[1] for pair in comparisons], genes),
+                                         'tpm_mean_a': mean_a.ravel(order = 'F'),
+                                         'tpm_mean_b': mean_b.ravel(order = 'F'),
+                                         'log2_fold_change': log2_fold_change.ravel(order = 'F'),
+                                         'welch_t': welch_t.ravel(order = 'F'),
+                                         'welch_degrees_of_freedom': welch_degrees_of_freedom.ravel(order = 'F')})
+
+  differential_file = os.path.join(working_directory, TPM_DIFFERENTIAL_FILE)
+  differential_table.to_csv(differential_file, sep = '\t', index = False, float_format = '%.6g') # Text formatting dominates the run time
+  util.info('log2 fold changes and Welch t statistics for {0} condition pairs written to {1}'.format(len(comparisons), differential_file))
+  return(differential_file)
+
+
+@instrumentation.timed
+def output_file_creator(working_directory, tpm_read, sample_conditions, gene_ids, incremental = False, comparisons = None):
   '''Create output files (one for each condition)
   Each file contains the gene ID, gene abbreviation, the TPM values for each replicate and the TPM mean and standard deviations across the replicates
+  A summary table of every condition's mean and standard deviation is also written. In incremental mode only
+  conditions whose samples, TPM values or gene reference changed since the last run are recomputed and rewritten,
+  and the summary table is updated in place. With comparisons, log2 fold changes and Welch t statistics
+  between condition pairs are computed from the same per-condition sums.
   
   Parameters
   ----------
+  working_directory (string / os.path):
+    Folder the output files (and the incremental cache) are written to
+  
   tpm_read (pandas object):
     Pandas object containing TPM data
   
@@ -169,6 +510,12 @@ def output_file_creator(tpm_read, sample_conditions, gene_ids):
   gene_ids (pandas csv object):
     Pandas object containing wormbase geneIDs and corresponding gene name abbreviations
   
+  incremental (Boolean):
+    Only recompute the conditions that are out of date
+  
+  comparisons (list / None):
+    (condition_a, condition_b) tuples from "comparison_pairs"
+  
   Returns
   -------
   Output files (Microsoft Excel files)
@@ -176,29 +523,56 @@ def output_file_creator(tpm_read, sample_conditions, gene_ids):
     
   '''
 
+  import pandas
+
   merged_data = pandas.merge(tpm_read, gene_ids, left_on = 'geneName', right_index = True)
   util.info('Merging data with gene name/ID references')
 
-  number_of_files = len(sample_conditions)
-  output_file_list = '\n'.join(sample_conditions)
+  cache_file = os.path.join(working_directory, TPM_CACHE_FILE)
+  summary_file = os.path.join(working_directory, TPM_SUMMARY_FILE)
+  fingerprints = condition_fingerprints(tpm_read, sample_conditions, gene_ids)
+  cached_fingerprints = read_tpm_cache(cache_file)
+
+  if incremental == True:
+    conditions = stale_conditions(sample_conditions, fingerprints, cached_fingerprints, summary_file)
+    util.info('{0} of {1} conditions out of date'.format(len(conditions), len(sample_conditions)))
+  else:
+    conditions = list(sample_conditions)
+
+  number_of_files = len(conditions)
+  output_file_list = '\n'.join(conditions)
   util.info('Creating {0} files; for each condition:\n{1}'.format(number_of_files, output_file_list))
 
-  for condition in sample_conditions:
+  summed_conditions = list(conditions)
+  for pair in comparisons or []:
+    summed_conditions += [condition for condition in pair if condition not in summed_conditions]
+  util.info('Calculating mean averages and standard deviations')
+  sums = condition_sums(merged_data, sample_conditions, summed_conditions)
+  tpm_mean, tpm_variance = sums_statistics(sums)
+
+  condition_statistics = {}
+  for condition in conditions:
     conditioned_samples = sample_conditions[condition]
     new_dataframe = merged_data.filter(items = ['geneName', 'gene'] + conditioned_samples)
 
-    util.info('Calculating mean average for {0}'.format(condition))
-    new_dataframe['tpm_mean'] = new_dataframe.reindex(columns = conditioned_samples).mean(axis = 1)
-
-    util.info('Calculating standard_deviation for {0}'.format(condition))
-    new_dataframe['tpm_standard_deviation'] = new_dataframe.reindex(columns = conditioned_samples).std(axis = 1)
+    condition_number = summed_conditions.index(condition)
+    new_dataframe['tpm_mean'] = tpm_mean[:, condition_number]
+    new_dataframe['tpm_standard_deviation'] = tpm_variance[:, condition_number] ** 0.5
+    condition_statistics[condition] = (new_dataframe['tpm_mean'], new_dataframe['tpm_standard_deviation'])
 
     new_file_name = 'TPM_std_dev_{0}.xlsx'.format(condition)
     new_file_path = os.path.join(working_directory, new_file_name)
     util.info('Creating output file for condition {0} as {1}'.format(condition, new_file_path))
-    new_dataframe.to_excel(new_file_name)
+    new_dataframe.to_excel(new_file_path)
     util.info('File saved')
 
+  if len(conditions) > 0 or set(cached_fingerprints) != set(sample_conditions):
+    summary_file_update(summary_file, merged_data, sample_conditions, condition_statistics)
+  write_tpm_cache(cache_file, fingerprints)
+
+  if comparisons:
+    differential_summary(working_directory, merged_data, sums, comparisons)
+
 
 if __name__ == '__main__':
 
@@ -209,7 +583,21 @@ if __name__ == '__main__':
                         metavar = 'FILENAME',
                         help = 'Full path for the tpm.txt file of interest')
 
+  parser.add_argument('-i', '--incremental', action = 'store_true',
+                      help = 'Only recompute and rewrite conditions whose samples, TPM values or gene reference changed since the last run, and update the summary table in place.')
+
+  parser.add_argument('-c', '--compare', type = str, nargs = '+', metavar = '<CONDITION_A:CONDITION_B>',
+                      help = 'Condition pairs to compare, or "all" for every pair. log2 fold changes ((mean A + 1) / (mean B + 1)) and Welch t statistics are written to {0}.'.format(TPM_DIFFERENTIAL_FILE))
+
+  run_history.add_arguments(parser)
+
+  parser.add_argument('--profile', type = str, metavar = '<FILE>',
+                      help = 'Record wall time, CPU time, bytes read/written and child process peak memory for each step. Written as a Chrome trace if FILE ends in .json, otherwise as JSON lines.')
+
   user_args = parser.parse_args()
+  if user_args.profile is not None:
+    instrumentation.enable_profile(user_args.profile)
+  run_history.start_run('tpm_standard_deviation_mean_calculator', user_args)
   tpm_file_path = check_file(user_args.tpm_file)
 
   working_directory, tpm_file_name = working_directory_finder(tpm_file_path)
@@ -217,7 +605,11 @@ if __name__ == '__main__':
 
   read_tpm = read_in_tpm(tpm_file_path)
   gene_ids = gene_name_converter()
-  sample_conditions = samples_file_conditions_finder(tpm_file_name)
-  output_file_creator(read_tpm, sample_conditions, gene_ids)
+  sample_conditions = samples_file_conditions_finder(working_directory, tpm_file_name)
+  comparisons = None
+  if user_args.compare is not None:
+    comparisons = comparison_pairs(user_args.compare, sample_conditions)
+  output_file_creator(working_directory, read_tpm, sample_conditions, gene_ids, user_args.incremental, comparisons)
 
+  run_history.finish_run()
   util.info('Task complete')